@@ -0,0 +1,349 @@
+import io
+import os
+import hashlib
+import zipfile
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+import config
+from instrumentation import timed_iter
+
+CHUNK_SIZE = 256 * 1024
+
+# Formats that are already compressed; deflating them again burns CPU for no gain.
+STORED_EXTENSIONS = frozenset(getattr(config, 'ZIP_STORED_EXTENSIONS', {
+    'pdf', 'zip', 'rar', '7z', 'gz', 'tgz', 'bz2', 'xz', 'zst',
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic',
+    'mp3', 'm4a', 'aac', 'ogg', 'flac', 'mp4', 'm4v', 'mkv', 'mov', 'avi', 'webm',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub',
+}))
+
+
+class _StreamSink(io.RawIOBase):
+    """
+    Unseekable, write-only target for zipfile. Whatever zipfile writes is held
+    until the generator drains it, so only one chunk is buffered at a time.
+    Being unseekable makes zipfile emit data descriptors instead of seeking
+    back to patch local headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._buffered = 0
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._buffered += len(b)
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    @property
+    def buffered(self):
+        return self._buffered
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        return data
+
+
+def iter_folder_files(folder):
+    """Yields (absolute_path, archive_name) for every file under `folder`, in a stable order."""
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            yield file_path, os.path.relpath(file_path, folder).replace(os.sep, '/')
+
+
+def compression_for(filename):
+    """Returns the zipfile compression method to use for a file name."""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def stream_zip(folder, chunk_size=CHUNK_SIZE):
+    """
+    Generates a ZIP archive of `folder` as a sequence of byte chunks.
+
+    Source files are read `chunk_size` bytes at a time and the archive is
+    yielded as soon as about that much output is ready, so memory use does
+    not depend on the folder size. ZIP64 records are written automatically
+    for large entries and archives.
+    """
+    return timed_iter('zip_build', stream_zip_members(_folder_members(folder, chunk_size), chunk_size))
+
+
+def stream_zip_members(members, chunk_size=CHUNK_SIZE):
+    """
+    Generates a ZIP archive of `members`, (ZipInfo, iterable of bytes)
+    pairs, yielding about `chunk_size` bytes at a time while each member's
+    data is still being produced.
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for zinfo, data in members:
+            with zf.open(zinfo, 'w') as target:
+                for chunk in data:
+                    target.write(chunk)
+                    if sink.buffered >= chunk_size:
+                        yield sink.drain()
+            if sink.buffered >= chunk_size:
+                yield sink.drain()
+    tail = sink.drain()
+    if tail:
+        yield tail
+
+
+def _folder_members(folder, chunk_size):
+    for file_path, arcname in iter_folder_files(folder):
+        try:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname, strict_timestamps=False)
+            source = open(file_path, 'rb')
+        except OSError:
+            continue  # Removed or unreadable since the walk listed it
+        zinfo.compress_type = compression_for(arcname)
+        yield zinfo, _read_chunks(source, chunk_size)
+
+
+def _read_chunks(source, chunk_size):
+    with source:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def content_disposition(filename):
+    """Builds an attachment Content-Disposition header that survives non-ASCII (e.g. Hebrew) names."""
+    fallback = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+    if fallback == filename:
+        return f'attachment; filename="{fallback}"'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+# --- Folder Archive Cache ---
+def fingerprint_folder(folder):
+    """
+    Returns (key, total_bytes) for a folder tree. The key is a hash of every
+    file's relative path, size and mtime, so any change inside the tree
+    produces a new key. Costs one stat per file, no file reads.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    total_bytes = 0
+    for file_path, arcname in iter_folder_files(folder):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        total_bytes += st.st_size
+        digest.update(f"{arcname}\0{st.st_size}\0{st.st_mtime_ns}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest(), total_bytes
+
+
+class ArchiveCache:
+    """
+    Disk-backed, LRU-evicted cache of folder ZIPs keyed by fingerprint_folder().
+
+    A hit is an existing `<key>.zip` file. On a miss, the archive is built
+    into a temporary file on a background thread, and the request and any
+    concurrent ones for the same key stream that file as it grows. Folders
+    larger than `max_entry_bytes`, and misses while `max_builds` builds are
+    already running, are streamed straight to the client without caching.
+    """
+
+    def __init__(self, cache_dir, max_bytes, max_entry_bytes, max_builds=2, build_wait=600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_builds = max_builds
+        self.build_wait = build_wait  # seconds a response waits for a stalled build
+        self._lock = threading.Lock()
+        self._entries = None       # key -> size, least recently used first
+        self._building = {}        # key -> _ArchiveBuild
+        self._folders = {}         # absolute folder path -> key last served for it
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.zip")
+
+    def _load_entries(self):
+        """Builds the LRU index from the cache directory on first use (caller holds the lock)."""
+        if self._entries is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.zip'):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name[:-4], st.st_size))
+            elif entry.name.startswith('.tmp_') and entry.stat().st_mtime < time.time() - self.build_wait:
+                _remove_quietly(entry.path)  # Left over from an interrupted build, not one still being written
+        found.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in found)
+
+    def open(self, folder):
+        """
+        Returns (path, None) when a cached archive can be sent as a file, or
+        (None, iterable) with archive chunks to stream.
+        """
+        key, total_bytes = fingerprint_folder(folder)
+        if total_bytes > self.max_entry_bytes:
+            return None, stream_zip(folder)
+
+        path = self._entry_path(key)
+        with self._lock:
+            self._load_entries()
+            self._folders[os.path.abspath(folder)] = key
+            if os.path.exists(path):
+                if key not in self._entries:
+                    self._entries[key] = os.path.getsize(path)  # Built by another server process
+                self._touch(key, path)
+                return path, None
+            build = self._building.get(key)
+            if build is None:
+                if len(self._building) >= self.max_builds:
+                    return None, stream_zip(folder)
+                build = self._building[key] = _ArchiveBuild(self, folder, key)
+                build.start()
+            # Opened while holding the lock, which the build also takes to move the file into place
+            return None, build.tail()
+
+    def invalidate(self, path):
+        """Drops cached archives of any folder that contains, or lies inside, `path`."""
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._entries is None:
+                return
+            for folder, key in list(self._folders.items()):
+                if folder == path or path.startswith(folder + os.sep) or folder.startswith(path + os.sep):
+                    del self._folders[folder]
+                    if self._entries.pop(key, None) is not None:
+                        _remove_quietly(self._entry_path(key))
+
+    def _touch(self, key, path):
+        self._entries.move_to_end(key)
+        try:
+            os.utime(path)  # Persist recency for the next process start
+        except OSError:
+            pass
+
+    def _commit(self, key, tmp_path):
+        path = self._entry_path(key)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            try:
+                os.replace(tmp_path, path)
+            except OSError:  # e.g. Windows, while the file is open or another worker serves the same key
+                if not os.path.exists(path):
+                    return
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if _remove_quietly(self._entry_path(key)):
+                total -= self._entries.pop(key)
+
+    def _finish_build(self, key):
+        with self._lock:
+            self._building.pop(key, None)
+
+
+class _ArchiveBuild:
+    """
+    Writes a folder's archive to a temporary file on its own thread and
+    commits it to the cache. Responses tail the file as it grows, so no
+    client sets the pace and a client that goes away only ends its own
+    response.
+    """
+
+    def __init__(self, cache, folder, key):
+        self.cache = cache
+        self.folder = folder
+        self.key = key
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.cache_dir, prefix='.tmp_', suffix='.zip')
+        self._out = os.fdopen(fd, 'wb')
+        self._changed = threading.Condition()
+        self.written = 0
+        self.done = False
+        self.failed = False
+
+    def start(self):
+        threading.Thread(target=self._run, name="archive-build", daemon=True).start()
+
+    def _run(self):
+        try:
+            with self._out:
+                for chunk in stream_zip(self.folder):
+                    self._out.write(chunk)
+                    self._out.flush()  # Readers only get as far as `written`
+                    with self._changed:
+                        self.written += len(chunk)
+                        self._changed.notify_all()
+            self.cache._commit(self.key, self.tmp_path)
+        except Exception as e:
+            print(f"Error building archive of {self.folder}: {e}")
+            self.failed = True
+        finally:
+            with self._changed:
+                self.done = True
+                self._changed.notify_all()
+            self.cache._finish_build(self.key)
+            _remove_quietly(self.tmp_path)
+
+    def tail(self, chunk_size=CHUNK_SIZE):
+        """Returns the archive's chunks, read from the file as the build writes it."""
+        return self._tail(open(self.tmp_path, 'rb'), chunk_size)
+
+    def _tail(self, source, chunk_size):
+        with source:
+            sent = 0
+            while True:
+                with self._changed:
+                    if self.written == sent and not self.done:
+                        self._changed.wait(self.cache.build_wait)
+                    written, done, failed = self.written, self.done, self.failed
+                if failed or (written == sent and not done):
+                    raise RuntimeError(f"Archive build of {self.folder} failed or stalled")
+                while sent < written:
+                    chunk = source.read(min(chunk_size, written - sent))
+                    if not chunk:
+                        raise RuntimeError(f"Archive build of {self.folder} was cut short")
+                    sent += len(chunk)
+                    yield chunk
+                if done and sent == written:
+                    return
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+
+
+_project_dir = os.path.dirname(os.path.abspath(__file__))
+archive_cache = ArchiveCache(
+    os.path.join(_project_dir, getattr(config, 'ARCHIVE_CACHE_FOLDER', 'archive_cache')),
+    max_bytes=getattr(config, 'ARCHIVE_CACHE_MAX_BYTES', 5 * 1024 ** 3),
+    max_entry_bytes=getattr(config, 'ARCHIVE_CACHE_MAX_ENTRY_BYTES', 1024 ** 3),
+    max_builds=getattr(config, 'ARCHIVE_CACHE_MAX_BUILDS', 2),
+)
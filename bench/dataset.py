@@ -0,0 +1,198 @@
+"""
+Generates a synthetic library for benchmarks: users in the auth, pending
+and denied CSVs, a tree of folders and files in the share folder, large
+session and download logs, and a config.py pointing the app at all of it.
+
+Nothing here imports the app, so the generated config.py can be put on
+sys.path before the first `import config`.
+
+Usage: python -m bench.dataset DIR [--users 1000] [--files 1000] [--fanout 8] [--depth 3]
+                               [--file-kb 4-64] [--log-rows 200000] [--log-days 90]
+"""
+import os
+import csv
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+PASSWORD = "benchpass"
+ADMIN_EMAIL = "admin@bench.local"
+EXTENSIONS = ("txt", "pdf", "docx", "png")
+
+CONFIG_TEMPLATE = '''\
+# Generated by bench.dataset; settings for benchmark runs only.
+import os
+D = {root!r}
+SUPER_SECRET_KEY = "bench-secret"
+TOKEN_SECRET_KEY = "bench-token-secret"
+SHARE_FOLDER = os.path.join(D, "share")
+TRASH_FOLDER = os.path.join(D, "trash")
+UPLOAD_FOLDER = os.path.join(D, "uploads")
+AUTH_USER_DATABASE = os.path.join(D, "db", "auth_users.csv")
+NEW_USER_DATABASE = os.path.join(D, "db", "new_users.csv")
+DENIED_USER_DATABASE = os.path.join(D, "db", "denied_users.csv")
+PASSWORD_RESET_DATABASE = os.path.join(D, "db", "password_reset.csv")
+SESSION_LOG_FILE = os.path.join(D, "logs", "session_log.csv")
+DOWNLOAD_LOG_FILE = os.path.join(D, "logs", "download_log.csv")
+SUGGESTION_LOG_FILE = os.path.join(D, "logs", "suggestion_log.csv")
+UPLOAD_LOG_FILE = os.path.join(D, "logs", "upload_log.csv")
+DECLINED_UPLOAD_LOG_FILE = os.path.join(D, "logs", "declined_upload_log.csv")
+ARCHIVE_CACHE_FOLDER = os.path.join(D, "archive_cache")
+SEARCH_INDEX_FILE = os.path.join(D, "search_index.pickle")
+ALLOWED_EXTENSIONS = {{"txt", "pdf", "png", "jpg", "docx", "zip", "mp4"}}
+MAIL_SERVER = "127.0.0.1"
+MAIL_PORT = 2525
+MAIL_USERNAME = None
+MAIL_PASSWORD = None
+MAIL_USE_TLS = False
+MAIL_USE_SSL = False
+MAIL_DEFAULT_SENDER = "bench@localhost"
+USER_STORAGE_BACKEND = {backend!r}
+# Measure the endpoints, not the limiter
+RATE_LIMITS = {{"download": None, "download_bytes": None, "login": None, "register": None, "forgot_password": None}}
+MAX_CONCURRENT_DOWNLOADS = 0
+'''
+
+HEADERS = {
+    ("db", "auth_users.csv"): ["email", "password", "role", "status"],
+    ("db", "new_users.csv"): ["email", "password", "role"],
+    ("db", "denied_users.csv"): ["email", "password", "role"],
+    ("db", "password_reset.csv"): ["email", "token", "timestamp"],
+    ("logs", "session_log.csv"): ["timestamp", "email", "event"],
+    ("logs", "download_log.csv"): ["timestamp", "email", "type", "path"],
+    ("logs", "suggestion_log.csv"): ["timestamp", "email", "suggestion"],
+    ("logs", "upload_log.csv"): ["timestamp", "email", "filename", "path"],
+    ("logs", "declined_upload_log.csv"): ["timestamp", "email", "filename"],
+}
+
+
+def user_email(i):
+    return f"user{i}@bench.local"
+
+
+def _writer(root, *parts):
+    f = open(os.path.join(root, *parts), "w", newline="", encoding="utf-8")
+    writer = csv.writer(f)
+    writer.writerow(HEADERS[parts])
+    return f, writer
+
+
+def write_users(root, users, pw_hash):
+    f, writer = _writer(root, "db", "auth_users.csv")
+    with f:
+        writer.writerow([ADMIN_EMAIL, pw_hash, "admin", "active"])
+        for i in range(users):
+            writer.writerow([user_email(i), pw_hash, "user", "active"])
+    for name, count in (("new_users.csv", users // 10), ("denied_users.csv", users // 20)):
+        f, writer = _writer(root, "db", name)
+        with f:
+            for i in range(count):
+                writer.writerow([f"{name.split('_')[0]}{i}@bench.local", pw_hash, "user"])
+
+
+def write_library(root, files, fanout, depth, size_range, rng):
+    """Spreads `files` files over a tree `depth` folders deep with `fanout` subfolders per level."""
+    folders, level = [], [""]
+    for depth_index in range(depth):
+        prefix = "folder" if depth_index == 0 else "sub"
+        level = [os.path.join(parent, f"{prefix}{i}") for parent in level for i in range(fanout)]
+        folders += level
+    share = os.path.join(root, "share")
+    for folder in folders:
+        os.makedirs(os.path.join(share, folder), exist_ok=True)
+    paths = []
+    for i in range(files):
+        ext = EXTENSIONS[i % len(EXTENSIONS)]
+        relpath = os.path.join(rng.choice(folders), f"file{i}.{ext}")
+        size = rng.randint(*size_range)
+        with open(os.path.join(share, relpath), "wb") as f:
+            if ext == "txt":
+                f.write((b"lorem ipsum dolor sit amet " * (size // 27 + 1))[:size])
+            else:
+                f.write(os.urandom(size))
+        paths.append(relpath.replace(os.sep, "/"))
+    return folders, paths
+
+
+def write_logs(root, rows, days, users, paths, rng):
+    """Writes `rows` download events and as many session events, oldest first, over the last `days` days."""
+    end = datetime.now()
+    step = timedelta(days=days) / max(rows, 1)
+    start = end - timedelta(days=days)
+    f_dl, downloads = _writer(root, "logs", "download_log.csv")
+    f_se, sessions = _writer(root, "logs", "session_log.csv")
+    with f_dl, f_se:
+        for i in range(rows):
+            timestamp = (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+            email = user_email(rng.randrange(users)) if users else ADMIN_EMAIL
+            path = rng.choice(paths) if paths else "file.txt"
+            if rng.random() < 0.1:
+                downloads.writerow([timestamp, email, "FOLDER", path.split("/")[0]])
+            else:
+                downloads.writerow([timestamp, email, "FILE", path])
+            sessions.writerow([timestamp, email, "LOGIN_FAIL" if rng.random() < 0.05 else "LOGIN_SUCCESS"])
+
+
+def generate(root, users=1000, files=1000, fanout=8, depth=3, file_kb=(4, 64), log_rows=200000, log_days=90,
+             backend="csv", seed=1):
+    """Creates the dataset under `root` (which must not exist yet); returns a description of it."""
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(seed)
+    root = os.path.abspath(root)
+    for sub in ("db", "logs", "share", "trash", "uploads"):
+        os.makedirs(os.path.join(root, sub))
+    for parts in HEADERS:
+        if not os.path.exists(os.path.join(root, *parts)):
+            _writer(root, *parts)[0].close()
+
+    # Every user shares one hash; hashing each of them would dominate the setup time
+    write_users(root, users, generate_password_hash(PASSWORD))
+    folders, paths = write_library(root, files, fanout, depth, (file_kb[0] * 1024, file_kb[1] * 1024), rng)
+    write_logs(root, log_rows, log_days, users, paths, rng)
+    with open(os.path.join(root, "config.py"), "w", encoding="utf-8") as f:
+        f.write(CONFIG_TEMPLATE.format(root=root, backend=backend))
+
+    info = {"root": root, "users": users, "files": files, "folders": len(folders), "log_rows": log_rows,
+            "top_folders": sorted({folder.split(os.sep)[0] for folder in folders}),
+            "paths": paths, "subfolders": [folder.replace(os.sep, "/") for folder in folders]}
+    with open(os.path.join(root, "dataset.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return info
+
+
+def load(root):
+    """Description of a dataset generated earlier."""
+    with open(os.path.join(root, "dataset.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_range(value):
+    low, _, high = value.partition("-")
+    return int(low), int(high or low)
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--fanout", type=int, default=8, help="subfolders per folder")
+    parser.add_argument("--depth", type=int, default=3, help="folder levels")
+    parser.add_argument("--file-kb", type=parse_range, default=(4, 64), help="file size range in KiB, e.g. 4-64")
+    parser.add_argument("--log-rows", type=int, default=200000, help="rows in the session and download logs")
+    parser.add_argument("--log-days", type=int, default=90)
+    parser.add_argument("--backend", choices=("csv", "sqlite"), default="csv", help="USER_STORAGE_BACKEND")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("dir")
+    add_arguments(parser)
+    args = parser.parse_args()
+    info = generate(args.dir, args.users, args.files, args.fanout, args.depth, args.file_kb, args.log_rows,
+                    args.log_days, args.backend)
+    print(json.dumps({key: value for key, value in info.items() if not isinstance(value, list)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+End-to-end load benchmark: generates a synthetic library (bench.dataset),
+starts the app with create_app() and drives its main endpoints with
+concurrent logged-in clients, in-process through the Flask test client
+and over a real waitress socket. Reports p50/p95/p99 latency, throughput
+and peak RSS per scenario and writes them to JSON for comparing commits.
+
+Usage: python -m bench.load [--mode both|inprocess|socket] [--scenarios login,browse,...]
+                            [--requests 200] [--concurrency 8] [--threads 8] [--data DIR]
+                            [--json out.json] [--compare previous.json] [dataset options]
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import uuid
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import dataset
+
+# Share of --requests run by expensive scenarios
+REQUEST_SHARE = {"download_folder": 0.25, "export_xlsx": 0.05}
+ADMIN_SCENARIOS = {"admin_uploads", "export_xlsx"}
+UPLOAD_BYTES = os.urandom(16 * 1024).hex().encode()[:16 * 1024]
+
+
+# --- Clients ---
+class InProcessClient:
+    """Calls the app directly through the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, form=None, files=None):
+        data = dict(form or {})
+        for field, (filename, content) in (files or {}).items():
+            data[field] = (io.BytesIO(content), filename)
+        response = self.client.open(path, method=method, json=json_body, data=data or None,
+                                    content_type="multipart/form-data" if files else None)
+        size = len(response.get_data())
+        response.close()
+        return response.status_code, size
+
+
+class HttpClient:
+    """Keep-alive HTTP/1.1 client with a single cookie jar entry per cookie name."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.conn = http.client.HTTPConnection(host, port, timeout=120)
+        self.cookies = {}
+
+    def request(self, method, path, json_body=None, form=None, files=None):
+        headers = {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        elif files:
+            body, headers["Content-Type"] = _multipart(form or {}, files)
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        for attempt in (1, 2):
+            try:
+                self.conn.request(method, quote(path, safe="/?=&"), body, headers)
+                response = self.conn.getresponse()
+                size = 0
+                while True:
+                    chunk = response.read(256 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle keep-alive connection; retry once on a new one
+                self.conn.close()
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+                if attempt == 2:
+                    raise
+        for cookie in response.headers.get_all("Set-Cookie") or []:
+            name, _, value = cookie.split(";", 1)[0].partition("=")
+            if value and "expires=thu, 01 jan 1970" not in cookie.lower():
+                self.cookies[name] = value
+            else:
+                self.cookies.pop(name, None)
+        return response.status, size
+
+
+def _multipart(form, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in form.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# --- Scenarios ---
+# Each takes (data, client, rng) and returns (status, response bytes).
+
+def login(data, client, rng):
+    email = dataset.user_email(rng.randrange(data["users"]))
+    return client.request("POST", "/login", json_body={"email": email, "password": dataset.PASSWORD})
+
+
+def browse(data, client, rng):
+    return client.request("GET", "/browse/" + rng.choice(data["subfolders"]))
+
+
+def download_file(data, client, rng):
+    return client.request("GET", "/download/file/" + rng.choice(data["paths"]))
+
+
+def download_folder(data, client, rng):
+    return client.request("GET", "/download/folder/" + rng.choice(data["top_folders"]))
+
+
+def upload(data, client, rng):
+    folder = rng.choice(data["top_folders"])
+    return client.request("POST", f"/upload/{folder}", form={"subpath": folder},
+                          files={"file": (f"bench-{uuid.uuid4().hex[:12]}.txt", UPLOAD_BYTES)})
+
+
+def my_uploads(data, client, rng):
+    return client.request("GET", "/my_uploads")
+
+
+def admin_uploads(data, client, rng):
+    return client.request("GET", "/admin/uploads")
+
+
+def export_xlsx(data, client, rng):
+    return client.request("GET", "/admin/metrics/download/download?format=xlsx")
+
+
+SCENARIOS = {scenario.__name__: scenario for scenario in
+             (login, browse, download_file, download_folder, upload, my_uploads, admin_uploads, export_xlsx)}
+
+
+# --- Runner ---
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def logged_in_clients(make_client, data, count, admin):
+    clients = []
+    for i in range(count):
+        client = make_client()
+        email = dataset.ADMIN_EMAIL if admin else dataset.user_email(i % data["users"])
+        status, _ = client.request("POST", "/login", json_body={"email": email, "password": dataset.PASSWORD})
+        if status != 200:
+            raise RuntimeError(f"Benchmark login for {email} failed with {status}")
+        clients.append(client)
+    return clients
+
+
+def run_scenario(mode, name, data, clients, requests):
+    scenario = SCENARIOS[name]
+    # One untimed request warms caches (archive cache, templates, password pool)
+    scenario(data, clients[0], random.Random(0))
+
+    latencies, errors, sent = [], [], [0]
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(index)
+        client = clients[index]
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            t = time.perf_counter()
+            try:
+                status, size = scenario(data, client, rng)
+            except Exception as e:
+                status, size = repr(e), 0
+            elapsed = time.perf_counter() - t
+            with lock:
+                latencies.append(elapsed)
+                sent[0] += size
+                if not isinstance(status, int) or status >= 400:
+                    errors.append(status)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        list(pool.map(worker, range(len(clients))))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "mode": mode,
+        "scenario": name,
+        "requests": requests,
+        "concurrency": len(clients),
+        "errors": len(errors),
+        "error_samples": [str(e) for e in errors[:3]],
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(requests / elapsed, 1),
+        "mb_per_sec": round(sent[0] / elapsed / 1024 / 1024, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(json.dumps(result))
+    return result
+
+
+def run_mode(mode, make_client, data, scenarios, requests, concurrency):
+    user_clients = logged_in_clients(make_client, data, concurrency, admin=False)
+    admin_clients = logged_in_clients(make_client, data, concurrency, admin=True)
+    results = []
+    for name in scenarios:
+        count = max(1, int(requests * REQUEST_SHARE.get(name, 1)))
+        clients = admin_clients if name in ADMIN_SCENARIOS else user_clients
+        results.append(run_scenario(mode, name, data, clients, count))
+    return results
+
+
+def stop_server(server, thread):
+    """Closes the listener and every connection from inside waitress's loop, which then returns."""
+    server.trigger.pull_trigger(lambda: [channel.close() for channel in list(server._map.values())])
+    thread.join(10)
+    server.task_dispatcher.shutdown()
+
+
+def compare(previous_path, results):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = {(r["mode"], r["scenario"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {previous_path}:")
+    print(f"{'mode':10} {'scenario':16} {'p95 ms':>22} {'req/s':>22}")
+    for r in results:
+        old = previous.get((r["mode"], r["scenario"]))
+        if old is None:
+            continue
+        p95 = f"{old['p95_ms']} -> {r['p95_ms']}"
+        rps = f"{old['requests_per_sec']} -> {r['requests_per_sec']}"
+        print(f"{r['mode']:10} {r['scenario']:16} {p95:>22} {rps:>22}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mode", choices=("both", "inprocess", "socket"), default="both")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of: " +
+                        ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario (fewer for heavy ones)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--threads", type=int, default=8, help="waitress threads in socket mode")
+    parser.add_argument("--data", help="dataset directory; generated there if missing, kept afterwards")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="print changes against an earlier --json file")
+    dataset.add_arguments(parser)
+    args = parser.parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    root = args.data or os.path.join(tempfile.mkdtemp(prefix="bench-load-"), "data")
+    started = time.perf_counter()
+    if os.path.exists(os.path.join(root, "dataset.json")):
+        data = dataset.load(root)
+    else:
+        data = dataset.generate(root, args.users, args.files, args.fanout, args.depth, args.file_kb,
+                                args.log_rows, args.log_days, args.backend)
+    print(f"Dataset in {root} ({round(time.perf_counter() - started, 1)}s)", file=sys.stderr)
+
+    # The generated config.py must win over any config.py in the project
+    sys.path.insert(0, root)
+    import config
+    assert os.path.dirname(os.path.abspath(config.__file__)) == os.path.abspath(root), config.__file__
+    if args.backend == "sqlite":
+        import user_store
+        user_store.migrate_csv_to_sqlite()
+    from main import create_app
+    from waitress import create_server
+
+    app = create_app()
+    app.config["MAIL_SUPPRESS_SEND"] = True
+    results = []
+    if args.mode in ("both", "inprocess"):
+        results += run_mode("inprocess", lambda: InProcessClient(app), data, scenarios, args.requests,
+                            args.concurrency)
+    if args.mode in ("both", "socket"):
+        # Queue depth warnings are expected when clients outnumber threads
+        logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+        server = create_server(app, host="127.0.0.1", port=0, threads=args.threads)
+        thread = threading.Thread(target=server.run, name="bench-waitress", daemon=True)
+        thread.start()
+        try:
+            results += run_mode("socket", lambda: HttpClient("127.0.0.1", server.effective_port), data, scenarios,
+                                args.requests, args.concurrency)
+        finally:
+            stop_server(server, thread)
+
+    report = {
+        "commit": git_commit(),
+        "started": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "args": {key: value for key, value in vars(args).items() if key not in ("json", "compare")},
+        "dataset": {key: value for key, value in data.items() if not isinstance(value, list)},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
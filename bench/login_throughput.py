@@ -0,0 +1,99 @@
+"""
+Measures password verification throughput during a login burst, inline on
+request threads (as api_login used to do) versus through the password
+process pool, and how long a cheap request (a directory listing) waits
+while the burst is running.
+
+Usage: python -m bench.login_throughput [--logins 200] [--threads 16] [--workers N]
+                                         [--max-pending N] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from password_pool import PasswordPool, PasswordPoolBusy
+from bench.mail_throughput import percentile
+
+
+def probe_latencies(stop, results):
+    """Stands in for browsing requests: short, mostly-CPU work repeated while logins run."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while not stop.is_set():
+        t = time.perf_counter()
+        sorted(entry.name for entry in os.scandir(directory))
+        results.append(time.perf_counter() - t)
+        time.sleep(0.005)
+
+
+def run(name, verify, logins, threads, pw_hash):
+    latencies, rejected = [], []
+    probes, stop = [], threading.Event()
+    prober = threading.Thread(target=probe_latencies, args=(stop, probes))
+    prober.start()
+
+    def login(i):
+        t = time.perf_counter()
+        try:
+            verify(pw_hash, "correct horse battery staple")
+        except PasswordPoolBusy:
+            rejected.append(i)
+            return
+        latencies.append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as request_threads:
+        list(request_threads.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    prober.join()
+
+    result = {
+        "mode": name,
+        "logins": logins,
+        "accepted": len(latencies),
+        "rejected_503": len(rejected),
+        "seconds": round(elapsed, 3),
+        "logins_per_sec": round(len(latencies) / elapsed, 1),
+        "login_p50_ms": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        "login_p99_ms": round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+        "probe_p50_ms": round(percentile(probes, 50) * 1000, 3) if probes else None,
+        "probe_p99_ms": round(percentile(probes, 99) * 1000, 3) if probes else None,
+    }
+    print(json.dumps(result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16, help="concurrent request threads (waitress default: 4)")
+    parser.add_argument("--workers", type=int, default=None, help="pool processes (default: CPU count)")
+    parser.add_argument("--max-pending", type=int, default=None, help="admission limit (default: 16 per worker)")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    pool = PasswordPool(workers=args.workers, max_pending=args.max_pending)
+    pw_hash = generate_password_hash("correct horse battery staple", pool.method)
+    pool.verify(pw_hash, "warm up the worker processes")
+
+    results = [
+        run("inline", lambda h, p: (check_password_hash(h, p), None), args.logins, args.threads, pw_hash),
+        run("pool", pool.verify, args.logins, args.threads, pw_hash),
+    ]
+    pool.close()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Compares synchronous Flask-Mail sends (one SMTP connection per message, as
+the request handlers used to do) with the background mail queue, against
+the in-process SMTP stand-in.
+
+Usage: python -m bench.mail_throughput [--messages 200] [--connect-delay 0.05]
+                                        [--message-delay 0.005] [--fail-every 0] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask_mail import Message
+
+import mailer
+from bench.smtp_standin import SMTPStandIn
+
+
+def make_app(port):
+    app = Flask(__name__)
+    app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False,
+                      MAIL_DEFAULT_SENDER="bench@localhost", SERVER_NAME="localhost")
+    mailer.mail.init_app(app)
+    return app
+
+
+def make_message(i):
+    msg = Message(f"Benchmark message {i}", sender="bench@localhost", recipients=[f"user{i}@example.com"])
+    msg.body = "Benchmark body"
+    return msg
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_sync(app, count):
+    latencies = []
+    start = time.perf_counter()
+    with app.app_context():
+        for i in range(count):
+            t = time.perf_counter()
+            mailer.mail.send(make_message(i))
+            latencies.append(time.perf_counter() - t)
+    return time.perf_counter() - start, latencies
+
+
+def run_queued(app, count):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        mailer.mail_queue.enqueue(app, make_message(i))
+        latencies.append(time.perf_counter() - t)
+    mailer.mail_queue.join()
+    return time.perf_counter() - start, latencies
+
+
+def report(name, server, count, elapsed, latencies):
+    result = {
+        "mode": name,
+        "messages": count,
+        "delivered": server.received,
+        "smtp_connections": server.connections,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(count / elapsed, 1),
+        "caller_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "caller_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+    print(json.dumps(result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--connect-delay", type=float, default=0.05, help="seconds per SMTP handshake")
+    parser.add_argument("--message-delay", type=float, default=0.005, help="seconds per message DATA")
+    parser.add_argument("--fail-every", type=int, default=0, help="answer 451 to every n-th message")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for name, runner in (("sync", run_sync), ("queued", run_queued)):
+        server = SMTPStandIn(connect_delay=args.connect_delay, message_delay=args.message_delay,
+                             fail_every=args.fail_every if name == "queued" else 0).start()
+        mailer.mail_queue.retry_base = 0.05
+        app = make_app(server.port)
+        elapsed, latencies = runner(app, args.messages)
+        results.append(report(name, server, args.messages, elapsed, latencies))
+        mailer.mail_queue._close_connection()
+        server.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Measures search latency over a large synthetic library: builds the index in
+memory from generated course/lecture/exam paths (nothing is written to the
+share folder) and times a mix of common, prefix, multi-term, Hebrew and rare
+queries (with the result cache cleared before each run, and again cached),
+plus index updates.
+
+Usage: python -m bench.search_latency [--paths 500000] [--repeat 50] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex
+from bench.mail_throughput import percentile
+
+COURSES = ["Intro_to_CS", "Data_Structures", "Algorithms", "Linear_Algebra", "Calculus_1", "Calculus_2",
+           "Operating_Systems", "Computer_Networks", "Databases", "Machine_Learning",
+           "מבוא_למדעי_המחשב", "אלגברה_לינארית", "חדו\"א_1", "מבני_נתונים"]
+KINDS = {
+    "lectures": ["lecture{n:02d}.pdf", "lecture{n:02d}_slides.pptx", "Lecture {n} notes.docx", "הרצאה_{n}.pdf"],
+    "exams": ["exam_{year}_moed_a.pdf", "exam_{year}_moed_b.pdf", "exam_{year}_solution.pdf", "מבחן_{year}_מועד_א.pdf"],
+    "homework": ["hw{n}.pdf", "hw{n}_solution.pdf", "hw{n}_solution.py", "ex{n}.zip"],
+    "summaries": ["summary_{year}.pdf", "summary_by_student{n}.docx", "סיכום_{year}.pdf", "cheat_sheet_{n}.pdf"],
+}
+QUERIES = ["pdf", "lecture", "lec", "solution", "exam 2021", "hw3 solution", "מבוא", "סיכום", "moed b 2019",
+           "calculus summary", "data structures lecture05", "zzzz"]
+
+
+def generate_paths(count, seed=1):
+    """Yields (relative path, is_folder) like a library of course material, folders before their files."""
+    rng = random.Random(seed)
+    produced = 0
+    group = 0
+    while produced < count:
+        course = f"{COURSES[group % len(COURSES)]}/{2010 + group // len(COURSES) % 15}/group_{group}"
+        group += 1
+        yield course, True
+        produced += 1
+        for kind, patterns in KINDS.items():
+            folder = f"{course}/{kind}"
+            yield folder, True
+            produced += 1
+            for i in range(rng.randint(5, 60)):
+                name = rng.choice(patterns).format(n=i + 1, year=rng.randint(2010, 2024))
+                yield f"{folder}/{i}_{name}", False
+                produced += 1
+
+
+def time_calls(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--paths", type=int, default=500000)
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per query")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(tmp, os.path.join(tmp, "search_index.pickle"))
+        start = time.perf_counter()
+        index._bulk_load(generate_paths(args.paths))
+        build_seconds = time.perf_counter() - start
+        print(json.dumps({"paths": len(index._ids), "build_seconds": round(build_seconds, 2)}))
+
+        results = []
+        for query in QUERIES:
+            for page in (1, 5):
+                # Cold: as after any index update; cached: the same query again
+                cold = time_calls(lambda: (index._results.clear(), index.search(query, page=page)), args.repeat)
+                cached = time_calls(lambda: index.search(query, page=page), args.repeat)
+                _, total = index.search(query, page=page)
+                result = {
+                    "query": query,
+                    "page": page,
+                    "hits": total,
+                    "p50_ms": round(percentile(cold, 50) * 1000, 2),
+                    "p95_ms": round(percentile(cold, 95) * 1000, 2),
+                    "cached_p50_ms": round(percentile(cached, 50) * 1000, 3),
+                }
+                print(json.dumps(result, ensure_ascii=False))
+                results.append(result)
+
+        # Publishing and deleting items: a folder of 60 files at a time
+        folder = os.path.join(tmp, "Intro_to_CS", "new_uploads")
+        os.makedirs(folder)
+        for i in range(60):
+            open(os.path.join(folder, f"lecture{i:02d}_recording_notes.pdf"), "w").close()
+        add, remove = [], []
+        for _ in range(args.repeat):
+            add.extend(time_calls(lambda: index._add_path(folder), 1))
+            remove.extend(time_calls(lambda: index._remove_path(folder), 1))
+        for name, latencies in (("add_folder", add), ("remove_folder", remove)):
+            result = {"update": name, "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                      "p95_ms": round(percentile(latencies, 95) * 1000, 2)}
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Minimal in-process SMTP server for benchmarks.
+
+Speaks just enough SMTP (EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for
+smtplib and Flask-Mail, counts connections and messages, and can simulate a
+slow server (`connect_delay`, `message_delay`) or transient failures
+(`fail_every`: every n-th message gets a 451 reply).
+"""
+import time
+import threading
+import socketserver
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode('ascii') + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.connect_delay)
+        self._reply("220 standin ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self._reply("250 standin")
+            elif verb == "MAIL":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:])
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                time.sleep(server.message_delay)
+                with server.lock:
+                    server.attempts += 1
+                    fail = server.fail_every and server.attempts % server.fail_every == 0
+                    if not fail:
+                        server.received += 1
+                        server.recipients += len(recipients)
+                self._reply("451 Try again later" if fail else "250 Queued")
+            elif verb == "RSET":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "NOOP":
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, connect_delay=0.0, message_delay=0.0, fail_every=0):
+        super().__init__((host, port), _SMTPHandler)
+        self.connect_delay = connect_delay
+        self.message_delay = message_delay
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.attempts = 0
+        self.received = 0
+        self.recipients = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="smtp-standin", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
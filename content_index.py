@@ -0,0 +1,226 @@
+import os
+import shutil
+import hashlib
+import threading
+import config
+from utils import sqlite_connect, sqlite_transaction
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """Returns the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_and_hash(stream, save_path):
+    """Copies an upload stream to `save_path`, hashing it on the way. Returns (sha256, size)."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(save_path, 'wb') as out:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _prefix_range(relpath):
+    """SQL bounds matching `relpath` itself and everything below it ('/' + 1 == '0')."""
+    return relpath, relpath + '/', relpath + '0'
+
+
+class ContentIndex:
+    """
+    Persistent SHA-256 index of the shared library and of pending uploads.
+
+    `library` maps every file under SHARE_FOLDER (relative path) to its hash,
+    size and mtime; `uploads` does the same for files waiting in
+    UPLOAD_FOLDER. Admins see which uploads are already in the library, and
+    approving an exact duplicate hardlinks the existing library file instead
+    of storing another copy.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS library (
+            path     TEXT NOT NULL PRIMARY KEY,
+            sha256   TEXT NOT NULL,
+            size     INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_library_sha256 ON library (sha256);
+        CREATE TABLE IF NOT EXISTS uploads (
+            path   TEXT NOT NULL PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size   INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, share_dir, upload_dir):
+        self.db_path = db_path
+        self.share_dir = os.path.abspath(share_dir)
+        self.upload_dir = os.path.abspath(upload_dir)
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    def _library_relpath(self, abs_path):
+        return os.path.relpath(os.path.abspath(abs_path), self.share_dir).replace(os.sep, '/')
+
+    def _upload_relpath(self, abs_path):
+        return os.path.relpath(os.path.abspath(abs_path), self.upload_dir).replace(os.sep, '/')
+
+    # --- Uploads ---
+    def record_upload(self, abs_path, sha256, size):
+        self._conn().execute("INSERT OR REPLACE INTO uploads (path, sha256, size) VALUES (?, ?, ?)",
+                             (self._upload_relpath(abs_path), sha256, size))
+
+    def forget_upload(self, abs_path):
+        """Drops the hashes of a declined upload (file or folder)."""
+        self._conn().execute("DELETE FROM uploads WHERE path = ? OR (path >= ? AND path < ?)",
+                             _prefix_range(self._upload_relpath(abs_path)))
+
+    def upload_duplicates(self, abs_path):
+        """
+        Returns (file_count, [(upload path, library path), ...]) for a pending
+        upload item, listing each file that already exists in the library.
+        """
+        rows = self._conn().execute(
+            """SELECT u.path, (SELECT l.path FROM library l WHERE l.sha256 = u.sha256 AND l.size = u.size LIMIT 1)
+               FROM uploads u WHERE u.path = ? OR (u.path >= ? AND u.path < ?)""",
+            _prefix_range(self._upload_relpath(abs_path))).fetchall()
+        return len(rows), [(path, library_path) for path, library_path in rows if library_path]
+
+    def _upload_hash(self, abs_path):
+        row = self._conn().execute("SELECT sha256, size FROM uploads WHERE path = ?",
+                                   (self._upload_relpath(abs_path),)).fetchone()
+        if row and row[1] == os.path.getsize(abs_path):
+            return row[0]
+        return hash_file(abs_path)
+
+    # --- Library ---
+    def find_in_library(self, sha256, size):
+        """Returns the absolute path of an existing library file with this content, or None."""
+        rows = self._conn().execute("SELECT path FROM library WHERE sha256 = ? AND size = ?", (sha256, size))
+        for (relpath,) in rows:
+            candidate = os.path.join(self.share_dir, relpath)
+            if os.path.isfile(candidate) and os.path.getsize(candidate) == size:
+                return candidate
+        return None
+
+    def record_library_file(self, abs_path, sha256):
+        st = os.stat(abs_path)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO library (path, sha256, size, mtime_ns) VALUES (?, ?, ?, ?)",
+            (self._library_relpath(abs_path), sha256, st.st_size, st.st_mtime_ns))
+
+    def remove_library_path(self, abs_path):
+        """Forgets a deleted library file or folder."""
+        self._conn().execute("DELETE FROM library WHERE path = ? OR (path >= ? AND path < ?)",
+                             _prefix_range(self._library_relpath(abs_path)))
+
+    def publish(self, source, destination):
+        """
+        Moves an approved upload (file or folder) into the library. Files whose
+        content is already in the library become hardlinks of the existing copy
+        and the uploaded bytes are dropped. Returns the number of files linked.
+        """
+        if os.path.exists(destination):
+            # Merging into an existing item keeps shutil.move's semantics.
+            moved_to = shutil.move(source, destination)
+            self.index_tree(moved_to)
+            self.forget_upload(source)
+            return 0
+
+        if os.path.isdir(source):
+            files = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names]
+        else:
+            files = [source]
+        linked = 0
+        for src in files:
+            dst = destination if src == source else os.path.join(destination, os.path.relpath(src, source))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            sha256 = self._upload_hash(src)
+            existing = self.find_in_library(sha256, os.path.getsize(src))
+            if existing and _link(existing, dst):
+                os.remove(src)
+                linked += 1
+            else:
+                shutil.move(src, dst)
+            self.record_library_file(dst, sha256)
+        if os.path.isdir(source):
+            # Keep empty sub-folders, then drop what is left of the upload.
+            for root, dirs, _ in os.walk(source):
+                for name in dirs:
+                    os.makedirs(os.path.join(destination, os.path.relpath(os.path.join(root, name), source)), exist_ok=True)
+            shutil.rmtree(source)
+        self.forget_upload(source)
+        return linked
+
+    def index_tree(self, abs_path):
+        """Hashes every file under `abs_path` whose size or mtime changed since it was indexed."""
+        conn = self._conn()
+        if os.path.isfile(abs_path):
+            paths = [abs_path]
+        else:
+            paths = (os.path.join(root, name) for root, _, names in os.walk(abs_path) for name in names)
+        for path in paths:
+            try:
+                st = os.stat(path)
+                row = conn.execute("SELECT size, mtime_ns FROM library WHERE path = ?",
+                                   (self._library_relpath(path),)).fetchone()
+                if row != (st.st_size, st.st_mtime_ns):
+                    self.record_library_file(path, hash_file(path))
+            except OSError:
+                continue  # Removed while indexing
+
+    def sync_library(self):
+        """Brings the library table in line with SHARE_FOLDER: hash new or changed files, drop missing ones."""
+        if not os.path.isdir(self.share_dir):
+            return
+        self.index_tree(self.share_dir)
+        conn = self._conn()
+        missing = [(path,) for (path,) in conn.execute("SELECT path FROM library")
+                   if not os.path.isfile(os.path.join(self.share_dir, path))]
+        with sqlite_transaction(conn):
+            conn.executemany("DELETE FROM library WHERE path = ?", missing)
+
+    def start(self):
+        """Indexes the library in a background thread."""
+        threading.Thread(target=self.sync_library, name="content-index", daemon=True).start()
+
+
+def _link(existing, destination):
+    """Hardlinks `destination` to `existing`; False where the filesystem cannot (e.g. across devices)."""
+    try:
+        os.link(existing, destination)
+        return True
+    except OSError:
+        return False
+
+
+_project_dir = os.path.dirname(os.path.abspath(__file__))
+content_index = ContentIndex(
+    getattr(config, 'CONTENT_INDEX_DATABASE', None) or
+    os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'content_index.sqlite3'),
+    os.path.join(_project_dir, config.SHARE_FOLDER),
+    os.path.join(_project_dir, config.UPLOAD_FOLDER),
+)
@@ -0,0 +1,171 @@
+import os
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.http import http_date, parse_range_header
+import config
+from archive import content_disposition
+
+CHUNK_SIZE = 256 * 1024
+
+# None (serve bytes from Python), 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd)
+DOWNLOAD_OFFLOAD = getattr(config, 'DOWNLOAD_OFFLOAD', None)
+# nginx `internal` location that maps onto SHARE_FOLDER, used with 'x-accel'
+X_ACCEL_PREFIX = getattr(config, 'X_ACCEL_PREFIX', '/protected-share/')
+
+
+def file_etag(st):
+    """Strong validator built from inode, size and mtime; changes whenever the file is replaced or edited."""
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+def is_new_download(response):
+    """
+    True when `response` (from send_share_file) starts sending the file: a
+    full 200 response or a byte range from 0. Revalidations (304), resumed
+    downloads and unsatisfiable ranges are not logged, so a download split
+    into many requests is logged once.
+    """
+    if response.status_code == 206:
+        if 'Content-Range' in response.headers:
+            return response.content_range.start == 0
+        return _range_starts_at_zero()  # multipart/byteranges
+    if response.status_code != 200:
+        return False
+    if DOWNLOAD_OFFLOAD:
+        # The proxy answers conditionals and ranges itself, so judge the request the way it will
+        etag, _ = response.get_etag()
+        if _not_modified(etag, response.last_modified):
+            return False
+        return request.headers.get('Range') is None or _range_starts_at_zero()
+    return True
+
+
+def _range_starts_at_zero():
+    ranges = parse_range_header(request.headers.get('Range'))
+    return ranges is None or any(start == 0 for start, _ in ranges.ranges)
+
+
+def send_share_file(abs_path, relative_path, download_name):
+    """
+    Serves a file from the shared library with conditional GET (ETag,
+    Last-Modified), single and multi-part byte ranges, and optional
+    X-Accel-Redirect / X-Sendfile offload to a fronting proxy.
+    """
+    st = os.stat(abs_path)
+    etag = file_etag(st)
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), tz=timezone.utc)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(download_name),
+        'Cache-Control': 'private, no-cache',
+    }
+
+    if DOWNLOAD_OFFLOAD:
+        # The proxy handles ranges and conditionals itself from the headers we pass on.
+        response = Response(status=200, headers=headers, mimetype='application/octet-stream')
+        if DOWNLOAD_OFFLOAD == 'x-accel':
+            response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + quote(relative_path)
+        else:
+            response.headers['X-Sendfile'] = abs_path
+        return response
+
+    if _not_modified(etag, last_modified):
+        return Response(status=304, headers=headers)
+
+    size = st.st_size
+    ranges = _requested_ranges(etag, last_modified, size)
+    if ranges == []:
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if ranges is None:
+        headers['Content-Length'] = str(size)
+        return Response(_read_range(abs_path, 0, size), status=200, headers=headers,
+                        mimetype='application/octet-stream', direct_passthrough=True)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        headers['Content-Length'] = str(end - start)
+        return Response(_read_range(abs_path, start, end), status=206, headers=headers,
+                        mimetype='application/octet-stream', direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    parts = [(f"\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+              f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode('ascii')
+             for start, end in ranges]
+    closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+    headers['Content-Length'] = str(sum(len(p) for p in parts) + sum(e - s for s, e in ranges) + len(closing))
+    return Response(_read_multipart(abs_path, ranges, parts, closing), status=206, headers=headers,
+                    content_type=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified <= since
+
+
+def _requested_ranges(etag, last_modified, size):
+    """
+    Returns None for a full response, [] when no requested range is
+    satisfiable, or a list of (start, end_exclusive) byte ranges.
+    """
+    parsed = parse_range_header(request.headers.get('Range'))
+    if parsed is None or parsed.units != 'bytes':
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        # Resume only if the client's copy is still current; otherwise send everything.
+        if if_range.startswith(('"', 'W/')):
+            if if_range.strip('"') != etag:
+                return None
+        elif request.if_range.date is None or request.if_range.date < last_modified:
+            return None
+
+    ranges = []
+    for start, end in parsed.ranges:
+        if start < 0:
+            start, end = max(size + start, 0), size
+        else:
+            end = size if end is None else min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    if len(ranges) > 1:
+        ranges = _coalesce(ranges)
+    return ranges
+
+
+def _coalesce(ranges):
+    """Merges overlapping or adjacent ranges so a client cannot make us re-read the same bytes."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _read_multipart(path, ranges, parts, closing):
+    for (start, end), part_header in zip(ranges, parts):
+        yield part_header
+        yield from _read_range(path, start, end)
+    yield closing
@@ -0,0 +1,286 @@
+import os
+import time
+import bisect
+import weakref
+import functools
+import threading
+from contextlib import contextmanager
+from flask import request
+
+# Upper bounds in seconds of the latency histogram buckets (the last one is +Inf).
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ENDPOINT_KEY = 'instrumentation.endpoint'
+
+
+class Histogram:
+    """Cumulative-style latency histogram with fixed buckets, like Prometheus's."""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate by linear interpolation inside the bucket holding the q-th observation."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+    def summary(self):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 2)
+        return {"count": self.count, "mean_ms": ms(self.total / self.count) if self.count else None,
+                "p50_ms": ms(self.quantile(0.5)), "p95_ms": ms(self.quantile(0.95)), "p99_ms": ms(self.quantile(0.99))}
+
+
+class _EndpointStats:
+    __slots__ = ('latency', 'statuses', 'bytes')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.bytes = 0
+
+
+class Instrumentation:
+    """
+    Process-wide request and operation timings.
+
+    Requests are timed by a WSGI middleware from the call into Flask until
+    the server closes the response body, so streamed downloads count in
+    full, and are grouped by blueprint endpoint. Operations (CSV I/O,
+    hashing, ZIP building, mail) are timed with `timed()`. Gauges are
+    callables sampled when the metrics are read.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._endpoints = {}    # (endpoint, method) -> _EndpointStats
+        self._operations = {}   # name -> Histogram
+        self._gauges = {}       # name -> (help, callable)
+
+    # --- Recording ---
+    def observe_request(self, endpoint, method, status, seconds, sent):
+        with self._lock:
+            stats = self._endpoints.get((endpoint, method))
+            if stats is None:
+                stats = self._endpoints[(endpoint, method)] = _EndpointStats()
+            stats.latency.observe(seconds)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes += sent
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            histogram = self._operations.get(operation)
+            if histogram is None:
+                histogram = self._operations[operation] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, operation):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - started)
+
+    def gauge(self, name, help_text, read):
+        self._gauges[name] = (help_text, read)
+
+    def watch_waitress(self, task_dispatcher):
+        """Adds thread-pool gauges for a waitress server's task dispatcher."""
+        self.gauge('waitress_threads', "Worker threads of the waitress server",
+                   lambda: len(task_dispatcher.threads))
+        self.gauge('waitress_threads_busy', "Worker threads running a request",
+                   lambda: task_dispatcher.active_count)
+        self.gauge('waitress_queue_depth', "Requests waiting for a free worker thread",
+                   lambda: len(task_dispatcher.queue))
+
+    def init_app(self, app):
+        @app.before_request
+        def _remember_endpoint():
+            request.environ[ENDPOINT_KEY] = request.endpoint or 'unmatched'
+        app.wsgi_app = _TimingMiddleware(app.wsgi_app, self)
+
+    # --- Reading ---
+    def requests_total(self):
+        with self._lock:
+            return sum(stats.latency.count for stats in self._endpoints.values())
+
+    def _gauge_values(self):
+        values = {}
+        for name, (_, read) in self._gauges.items():
+            try:
+                values[name] = read()
+            except Exception:
+                values[name] = None
+        return values
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = [{"endpoint": endpoint, "method": method, **stats.latency.summary(),
+                          "statuses": {str(status): n for status, n in sorted(stats.statuses.items())},
+                          "bytes": stats.bytes}
+                         for (endpoint, method), stats in sorted(self._endpoints.items())]
+            operations = {name: histogram.summary() for name, histogram in sorted(self._operations.items())}
+        return {"pid": os.getpid(), "uptime_seconds": round(time.time() - self.started, 1),
+                "endpoints": endpoints, "operations": operations, "gauges": self._gauge_values()}
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            operations = sorted(self._operations.items())
+            _histogram_lines(lines, 'http_request_duration_seconds', "Request latency until the response was closed",
+                             [(f'endpoint="{e}",method="{m}"', stats.latency) for (e, m), stats in endpoints])
+            lines.append("# HELP http_requests_total Responses by status code")
+            lines.append("# TYPE http_requests_total counter")
+            for (endpoint, method), stats in endpoints:
+                for status, n in sorted(stats.statuses.items()):
+                    lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {n}')
+            lines.append("# HELP http_response_bytes_total Response body bytes sent")
+            lines.append("# TYPE http_response_bytes_total counter")
+            for (endpoint, method), stats in endpoints:
+                lines.append(f'http_response_bytes_total{{endpoint="{endpoint}",method="{method}"}} {stats.bytes}')
+            _histogram_lines(lines, 'operation_duration_seconds', "Time spent in instrumented operations",
+                             [(f'operation="{name}"', histogram) for name, histogram in operations])
+        for name, value in self._gauge_values().items():
+            lines.append(f"# HELP {name} {self._gauges[name][0]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {'NaN' if value is None else value}")
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(lines, name, help_text, series):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in series:
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.total:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+class _TimingMiddleware:
+    def __init__(self, wsgi_app, registry):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        status = [500]
+        content_length = [0]
+
+        def timed_start_response(status_line, headers, exc_info=None):
+            status[0] = int(status_line.split(' ', 1)[0])
+            for name, value in headers:
+                if name.lower() == 'content-length' and value.isdigit():
+                    content_length[0] = int(value)
+            return start_response(status_line, headers, exc_info)
+
+        def done(sent):
+            self.registry.observe_request(environ.get(ENDPOINT_KEY, 'unmatched'), environ.get('REQUEST_METHOD'),
+                                          status[0], time.perf_counter() - started, sent)
+
+        try:
+            body = self.wsgi_app(environ, timed_start_response)
+        except BaseException:
+            done(0)
+            raise
+        if is_file_wrapper(environ, body):
+            # Wrapping it would take waitress off its fast path, which sends the file from the event loop
+            # instead of a request thread; report once the server has sent and dropped it
+            weakref.finalize(body, done, content_length[0])
+            return body
+        return _CountingBody(body, done)
+
+
+def is_file_wrapper(environ, body):
+    """True for a body made by the server's wsgi.file_wrapper, which must reach the server unwrapped."""
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    return isinstance(file_wrapper, type) and isinstance(body, file_wrapper)
+
+
+class _CountingBody:
+    """Passes the response body through, counting bytes, and reports once it is exhausted or closed."""
+
+    def __init__(self, body, done):
+        self.body = body
+        self.done = done
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+        self._report()
+
+    def _report(self):
+        done, self.done = self.done, None
+        if done is not None:
+            done(self.sent)
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._report()
+
+
+instrumentation = Instrumentation()
+
+
+def timed(operation):
+    """Decorator recording the run time of a function under `operation`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with instrumentation.timer(operation):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(operation, iterable):
+    """
+    Yields from `iterable`, recording the time spent producing items (not
+    the time the consumer held on to them) once it is exhausted or closed.
+    """
+    busy = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                busy += time.perf_counter() - started
+                return
+            busy += time.perf_counter() - started
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        instrumentation.observe(operation, busy)
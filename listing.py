@@ -0,0 +1,103 @@
+import os
+import threading
+from collections import OrderedDict
+import config
+
+SORT_KEYS = {
+    'name': lambda entry: entry[0].lower(),
+    'size': lambda entry: entry[2],
+    'mtime': lambda entry: entry[3],
+}
+
+
+class ListingIndex:
+    """
+    In-memory cache of directory listings under the shared library.
+
+    Each directory is read once with os.scandir(), which yields the entry type
+    without an extra stat, and is re-read only when the directory's own mtime
+    changes or the app invalidates it after a mutation. Entries are compact
+    (name, is_folder, size, mtime) tuples; sorted views are built once per
+    sort order and reused until the listing changes.
+    """
+
+    def __init__(self, max_dirs=2048):
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        self._dirs = OrderedDict()   # absolute path -> _Listing
+
+    def list(self, directory, sort='name', reverse=False):
+        """Returns the sorted (name, is_folder, size, mtime) entries of a directory, folders first."""
+        directory = os.path.abspath(directory)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            self.invalidate(directory)
+            return []
+        with self._lock:
+            listing = self._dirs.get(directory)
+            if listing is not None and listing.mtime == mtime:
+                self._dirs.move_to_end(directory)
+                return listing.sorted(sort, reverse)
+
+        listing = _Listing(mtime, _scan(directory))
+        with self._lock:
+            self._dirs[directory] = listing
+            self._dirs.move_to_end(directory)
+            while len(self._dirs) > self.max_dirs:
+                self._dirs.popitem(last=False)
+        return listing.sorted(sort, reverse)
+
+    def page(self, directory, page=1, per_page=200, sort='name', reverse=False):
+        """Returns (entries on the page, total number of entries)."""
+        entries = self.list(directory, sort, reverse)
+        start = (max(page, 1) - 1) * per_page
+        return entries[start:start + per_page], len(entries)
+
+    def invalidate(self, path):
+        """Forgets the listing of `path`, its parent, and anything cached beneath it."""
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        with self._lock:
+            for directory in list(self._dirs):
+                if directory in (path, parent) or directory.startswith(path + os.sep):
+                    del self._dirs[directory]
+
+
+class _Listing:
+    __slots__ = ('mtime', 'entries', '_views')
+
+    def __init__(self, mtime, entries):
+        self.mtime = mtime
+        self.entries = entries
+        self._views = {}
+
+    def sorted(self, sort, reverse):
+        view = self._views.get((sort, reverse))
+        if view is None:
+            key = SORT_KEYS.get(sort, SORT_KEYS['name'])
+            folders = sorted((e for e in self.entries if e[1]), key=key, reverse=reverse)
+            files = sorted((e for e in self.entries if not e[1]), key=key, reverse=reverse)
+            view = self._views[(sort, reverse)] = folders + files
+        return view
+
+
+def _scan(directory):
+    entries = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    is_folder = entry.is_dir()
+                    st = entry.stat()
+                except OSError:
+                    continue  # Removed while scanning
+                entries.append((entry.name, is_folder, 0 if is_folder else st.st_size, int(st.st_mtime)))
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return entries
+
+
+listing_index = ListingIndex(max_dirs=getattr(config, 'LISTING_CACHE_MAX_DIRS', 2048))
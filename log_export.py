@@ -0,0 +1,178 @@
+import io
+import os
+import re
+import csv
+import json
+import zipfile
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape as xml_escape
+import config
+import log_segments
+from utils import flush_logs
+from archive import stream_zip_members
+
+EXPORT_FORMATS = ('xlsx', 'csv', 'ndjson')
+# One below Excel's sheet limit of 1,048,576 rows, leaving room for the header.
+MAX_EXPORT_ROWS = min(getattr(config, 'MAX_EXPORT_ROWS', 1_048_575), 1_048_575)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class LogFilter:
+    """Date-range / email filter over log rows whose first two columns are timestamp and email."""
+
+    def __init__(self, since=None, until=None, email=None, limit=None):
+        # Timestamps are zero-padded "%Y-%m-%d %H:%M:%S" strings, so string comparison is chronological.
+        self.since = since.strftime(TIMESTAMP_FORMAT) if since else None
+        self.until = until.strftime(TIMESTAMP_FORMAT) if until else None
+        self.email = email.strip().lower() if email else None
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be a positive number of rows")
+        self.limit = min(limit, MAX_EXPORT_ROWS) if limit else MAX_EXPORT_ROWS
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Builds a filter from request arguments: `from` and `to` as YYYY-MM-DD
+        (both inclusive), `email`, and `limit`. Raises ValueError on bad dates
+        or a limit below 1.
+        """
+        since = datetime.strptime(args['from'], "%Y-%m-%d") if args.get('from') else None
+        until = datetime.strptime(args['to'], "%Y-%m-%d") + timedelta(days=1) if args.get('to') else None
+        return cls(since, until, args.get('email'), args.get('limit', type=int))
+
+    def matches(self, row):
+        if not row:
+            return False
+        timestamp = row[0]
+        if self.since and timestamp < self.since:
+            return False
+        if self.until and timestamp >= self.until:
+            return False
+        if self.email and (len(row) < 2 or row[1].lower() != self.email):
+            return False
+        return True
+
+
+def iter_log_rows(csv_filepath, log_filter):
+    """
+    Yields the header row and then up to `log_filter.limit` matching rows.
+    Only the log segments overlapping the date range are read.
+    """
+    flush_logs()
+    header = log_segments.header(csv_filepath)
+    if header is None:
+        return
+    yield header
+    emitted = 0
+    for row in log_segments.iter_rows(csv_filepath, log_filter.since, log_filter.until):
+        if log_filter.matches(row):
+            yield row
+            emitted += 1
+            if emitted >= log_filter.limit:
+                return
+
+
+def stream_csv(rows):
+    """Encodes rows as CSV, yielding one chunk per batch of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % 1000 == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def stream_ndjson(rows):
+    """Encodes rows as newline-delimited JSON objects keyed by the header."""
+    header = None
+    lines = []
+    for row in rows:
+        if header is None:
+            header = row
+            continue
+        lines.append(json.dumps(dict(zip(header, row)), ensure_ascii=False))
+        if len(lines) == 1000:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def stream_xlsx(rows, title):
+    """
+    Encodes rows as a one-sheet XLSX workbook. The sheet XML is produced
+    row by row and compressed into the package as it goes, so the download
+    starts right away and neither the rows nor the workbook are held.
+    """
+    title = _xml_text(title[:31])
+    parts = [
+        ('[Content_Types].xml', _XLSX_CONTENT_TYPES),
+        ('_rels/.rels', _XLSX_ROOT_RELS),
+        ('xl/workbook.xml', _XLSX_WORKBOOK.replace('{title}', title)),
+        ('xl/_rels/workbook.xml.rels', _XLSX_WORKBOOK_RELS),
+    ]
+    members = [(_xlsx_member(name), [content.encode('utf-8')]) for name, content in parts]
+    members.append((_xlsx_member('xl/worksheets/sheet1.xml'), _sheet_xml(rows)))
+    return stream_zip_members(members)
+
+
+def _sheet_xml(rows):
+    """Yields the worksheet XML in batches of rows; every cell is an inline string."""
+    lines = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>']
+    for i, row in enumerate(rows, 1):
+        lines.append('<row>' + ''.join(f'<c t="inlineStr"><is><t xml:space="preserve">{_xml_text(value)}</t></is></c>'
+                                       for value in row) + '</row>')
+        if i % 1000 == 0:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+    lines.append('</sheetData></worksheet>')
+    yield ''.join(lines).encode('utf-8')
+
+
+def _xml_text(value):
+    # Control characters are not allowed in XML at all, so they are dropped
+    return xml_escape(_ILLEGAL_XML_CHARS.sub('', str(value)))
+
+
+def _xlsx_member(name):
+    zinfo = zipfile.ZipInfo(name, datetime.now().timetuple()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+
+_ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>')
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="xl/workbook.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>')
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{title}" sheetId="1" r:id="rId1"/></sheets></workbook>')
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+    '</Relationships>')
+
+
+def sheet_title(csv_filepath):
+    return os.path.basename(csv_filepath).replace('.csv', '').title()
@@ -0,0 +1,434 @@
+"""
+Segmented CSV logs.
+
+A log such as logs/session_log.csv is the *active* segment. When it grows
+past LOG_ROTATE_BYTES, or the LOG_ROTATE_INTERVAL period (a day by default)
+it was last written in is over, it is renamed into logs/session_log_segments/
+and a fresh active file with the same header takes its place. The renamed
+file is then *sealed*: compressed into a gzip file made of one member per
+LOG_INDEX_ROWS rows, next to a JSON index holding the header, the segment's
+first and last timestamps and, per member, its timestamp range and its
+compressed and uncompressed offsets. iter_rows() uses the indexes to open
+only the segments and members that overlap a requested time range.
+"""
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import threading
+from datetime import datetime
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows: rotation is only coordinated between threads
+    fcntl = None
+
+ROTATE_BYTES = getattr(config, 'LOG_ROTATE_BYTES', 64 * 1024 * 1024)
+ROTATE_INTERVAL = getattr(config, 'LOG_ROTATE_INTERVAL', 24 * 60 * 60)
+INDEX_EVERY_ROWS = getattr(config, 'LOG_INDEX_ROWS', 1000)
+# Writers in other processes notice a rotation on their next batch; sealing waits for them.
+SEAL_DELAY = 2.0
+
+SEGMENT_SUFFIX = '.csv.gz'
+INDEX_SUFFIX = '.idx.json'
+SEALING_SUFFIX = '.csv'
+
+
+class Source:
+    """One piece of a log in chronological order: a sealed segment, a renamed file awaiting sealing, or the active file."""
+
+    __slots__ = ('key', 'path', 'inode', 'size', 'index')
+
+    def __init__(self, key, path, inode, size, index=None):
+        self.key = key
+        self.path = path
+        self.inode = inode
+        self.size = size
+        self.index = index
+
+    @property
+    def active(self):
+        return self.key.startswith('active:')
+
+
+def segments_dir(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(path), stem + '_segments')
+
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def _load_index(idx_path):
+    with _index_lock:
+        index = _index_cache.get(idx_path)
+    if index is None:
+        with open(idx_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        with _index_lock:
+            _index_cache[idx_path] = index  # Sealed segments never change
+    return index
+
+
+def sources(path):
+    """Lists every part of a log, oldest first, ending with the active file."""
+    directory = segments_dir(path)
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        names = []
+
+    parts = {}
+    sealed_inodes = set()
+    for name in names:
+        if name.endswith(INDEX_SUFFIX):
+            base = name[:-len(INDEX_SUFFIX)]
+            try:
+                index = _load_index(os.path.join(directory, name))
+            except (OSError, ValueError):
+                continue
+            parts[base] = Source(base, os.path.join(directory, base + SEGMENT_SUFFIX),
+                                 index['source_inode'], index['size'], index)
+            sealed_inodes.add(index['source_inode'])
+    for name in names:
+        if name.endswith(SEALING_SUFFIX) and not name.endswith(SEGMENT_SUFFIX):
+            base = name[:-len(SEALING_SUFFIX)]
+            if base in parts:
+                continue
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue  # Sealed in the meantime
+            if st.st_ino not in sealed_inodes:
+                parts[base] = Source(base, os.path.join(directory, name), st.st_ino, st.st_size)
+
+    result = [parts[base] for base in sorted(parts)]
+    try:
+        st = os.stat(path)
+        result.append(Source(f"active:{st.st_ino}", path, st.st_ino, st.st_size))
+    except FileNotFoundError:
+        pass
+    return result
+
+
+def open_at(source, position):
+    """Opens a source for binary reading at an uncompressed byte offset."""
+    if source.index is None:
+        f = open(source.path, 'rb')
+        f.seek(position)
+        return f
+    raw = open(source.path, 'rb')
+    start_compressed, start_uncompressed = 0, 0
+    for _, _, compressed, uncompressed, _ in source.index['blocks']:
+        if uncompressed > position:
+            break
+        start_compressed, start_uncompressed = compressed, uncompressed
+    raw.seek(start_compressed)
+    stream = gzip.GzipFile(fileobj=raw, mode='rb')
+    stream.seek(position - start_uncompressed)
+    return _ClosingStream(stream, raw)
+
+
+class _ClosingStream(io.BufferedIOBase):
+    """A gzip stream that also closes the file underneath it."""
+
+    def __init__(self, stream, raw):
+        self._stream = stream
+        self._raw = raw
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._stream.close()
+        self._raw.close()
+        super().close()
+
+
+def header(path):
+    """The column names of a log, from the active file or its newest sealed segment."""
+    for source in reversed(sources(path)):
+        if source.index is not None:
+            return source.index['header']
+        try:
+            with open(source.path, 'r', encoding='utf-8', newline='') as f:
+                return next(csv.reader(f), None)
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def _normalize(ts):
+    return ts.strftime("%Y-%m-%d %H:%M:%S") if isinstance(ts, datetime) else ts
+
+
+def _in_range(timestamp, since, until):
+    return (since is None or timestamp >= since) and (until is None or timestamp < until)
+
+
+def iter_rows(path, since=None, until=None):
+    """
+    Yields the data rows of a log (header excluded) in write order, limited
+    to since <= timestamp < until when given (datetimes or "%Y-%m-%d %H:%M:%S"
+    strings). Sealed segments and index blocks outside the range are skipped
+    without being read.
+    """
+    since, until = _normalize(since), _normalize(until)
+    for source in sources(path):
+        try:
+            yield from _iter_source(source, since, until)
+        except FileNotFoundError:
+            # A rotated file sealed since it was listed is read from its segment instead.
+            sealed = _sealed_source(source)
+            if sealed is not None:
+                yield from _iter_source(sealed, since, until)
+
+
+def _sealed_source(source):
+    if source.active or source.index is not None:
+        return None
+    base = source.path[:-len(SEALING_SUFFIX)]
+    try:
+        index = _load_index(base + INDEX_SUFFIX)
+    except (OSError, ValueError):
+        return None
+    return Source(source.key, base + SEGMENT_SUFFIX, index['source_inode'], index['size'], index)
+
+
+def _iter_source(source, since, until):
+    if source.index is None:
+        with open(source.path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if row and _in_range(row[0], since, until):
+                    yield row
+        return
+
+    index = source.index
+    if not index['rows'] or (since and index['last'] < since) or (until and index['first'] >= until):
+        return
+    with open(source.path, 'rb') as raw:
+        for low, high, compressed, _, length in index['blocks']:
+            if (since and high < since) or (until and low >= until):
+                continue
+            raw.seek(compressed)
+            data = gzip.GzipFile(fileobj=raw, mode='rb').read(length)
+            for row in csv.reader(io.StringIO(data.decode('utf-8', errors='replace'), newline='')):
+                if row and _in_range(row[0], since, until):
+                    yield row
+
+
+# --- Rotation (called by the log writer thread) ---
+_header_lengths = {}
+_rotation_lock = threading.Lock()
+
+
+def _header_length(path, inode):
+    key = (path, inode)
+    length = _header_lengths.get(key)
+    if length is None:
+        with open(path, 'rb') as f:
+            length = _header_lengths[key] = len(f.readline())
+    return length
+
+
+def _period(timestamp):
+    """Index of the local-time LOG_ROTATE_INTERVAL period a timestamp falls in."""
+    offset = datetime.fromtimestamp(timestamp).astimezone().utcoffset().total_seconds()
+    return int((timestamp + offset) // ROTATE_INTERVAL)
+
+
+def should_rotate(path, st, incoming):
+    """Whether the active file described by `st` should be sealed before `incoming` more bytes are appended."""
+    if not ROTATE_BYTES and not ROTATE_INTERVAL:
+        return False
+    try:
+        if st.st_size <= _header_length(path, st.st_ino):
+            return False  # Never seal a segment without rows
+    except OSError:
+        return False
+    if ROTATE_BYTES and st.st_size + incoming > ROTATE_BYTES:
+        return True
+    return bool(ROTATE_INTERVAL) and _period(st.st_mtime) != _period(time.time())
+
+
+class _RotationLock:
+    """Serializes rotations of one log across threads and, where fcntl exists, processes."""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, '.rotate.lock')
+        self.fd = None
+
+    def __enter__(self):
+        _rotation_lock.acquire()
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        _rotation_lock.release()
+
+
+def rotate(path, inode):
+    """
+    Moves the active file (if it is still the one with `inode`) aside and
+    replaces it with a file holding only the header. Sealing happens
+    SEAL_DELAY seconds later on a background thread.
+    """
+    directory = segments_dir(path)
+    os.makedirs(directory, exist_ok=True)
+    with _RotationLock(directory):
+        try:
+            if os.stat(path).st_ino != inode:
+                return  # Another process rotated it already
+            with open(path, 'rb') as f:
+                header_line = f.readline()
+        except FileNotFoundError:
+            return
+        stem = os.path.splitext(os.path.basename(path))[0]
+        sealing_path = os.path.join(directory, f"{stem}.{datetime.now().strftime('%Y%m%dT%H%M%S%f')}{SEALING_SUFFIX}")
+        os.rename(path, sealing_path)
+        _create_with_header(path, header_line)
+    _header_lengths.pop((path, inode), None)
+    timer = threading.Timer(SEAL_DELAY, _seal_quietly, (sealing_path,))
+    timer.daemon = True
+    timer.start()
+
+
+def open_for_append(path):
+    """Opens a log for appending, recreating a missing file with its header when the header is known."""
+    try:
+        return os.open(path, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+        pass
+    known = header(path)
+    if known:
+        out = io.StringIO()
+        csv.writer(out).writerow(known)
+        _create_with_header(path, out.getvalue().encode('utf-8'))
+    return os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def _create_with_header(path, header_line):
+    """Creates `path` containing only `header_line` unless another writer created it first."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header_line)
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(fd, header_line)
+            os.close(fd)
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(tmp_path)
+
+
+# --- Sealing ---
+def _records(stream):
+    """Yields (raw bytes, timestamp) per CSV record of a binary stream; quoted fields may span lines."""
+    pending = []
+
+    def lines():
+        for line in stream:
+            pending.append(line)
+            yield line.decode('utf-8', errors='replace')
+
+    for row in csv.reader(lines()):
+        raw = b''.join(pending)
+        pending.clear()
+        yield raw, (row[0] if row else '')
+
+
+def seal(sealing_path):
+    """Compresses a rotated file into an indexed gzip segment and removes it."""
+    base = sealing_path[:-len(SEALING_SUFFIX)]
+    segment_path, index_path = base + SEGMENT_SUFFIX, base + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        _remove_quietly(sealing_path)
+        return
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    blocks = []
+    first = last = None
+    rows = 0
+    st = os.stat(sealing_path)
+    with open(sealing_path, 'rb') as src, open(segment_path + suffix, 'wb') as out:
+        header_line = src.readline()
+        out.write(gzip.compress(header_line))
+        position = len(header_line)
+        block, low, high = [], None, None
+
+        def write_block():
+            data = b''.join(block)
+            blocks.append([low or '', high or '', out.tell(), position - len(data), len(data)])
+            out.write(gzip.compress(data))
+
+        for raw, timestamp in _records(src):
+            block.append(raw)
+            position += len(raw)
+            if timestamp:
+                low = timestamp if low is None or timestamp < low else low
+                high = timestamp if high is None or timestamp > high else high
+                first = timestamp if first is None or timestamp < first else first
+                last = timestamp if last is None or timestamp > last else last
+            rows += 1
+            if len(block) >= INDEX_EVERY_ROWS:
+                write_block()
+                block, low, high = [], None, None
+        if block:
+            write_block()
+
+    headers = next(csv.reader([header_line.decode('utf-8', errors='replace')]), [])
+    index = {"header": headers, "source_inode": st.st_ino, "size": position, "rows": rows,
+             "first": first or '', "last": last or '', "blocks": blocks}
+    with open(index_path + suffix, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(segment_path + suffix, segment_path)
+    os.replace(index_path + suffix, index_path)
+    _remove_quietly(sealing_path)
+
+
+def _seal_quietly(sealing_path):
+    try:
+        seal(sealing_path)
+    except FileNotFoundError:
+        pass  # Sealed by another process
+    except OSError as e:
+        print(f"Error sealing log segment {sealing_path}: {e}")
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def seal_leftovers(path):
+    """Seals files that were rotated but not sealed, e.g. because the process exited first."""
+    directory = segments_dir(path)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in sorted(names):
+        if name.endswith(SEALING_SUFFIX) and not name.endswith(SEGMENT_SUFFIX):
+            _seal_quietly(os.path.join(directory, name))
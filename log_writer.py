@@ -0,0 +1,175 @@
+import io
+import os
+import csv
+import time
+import queue
+import atexit
+import threading
+import config
+import log_segments
+from instrumentation import instrumentation
+
+_FLUSH = object()
+_STOP = object()
+
+
+class LogWriter:
+    """
+    Background, batched appender for the CSV log files.
+
+    log_event() only pushes (filename, row) onto a bounded queue; a single
+    writer thread keeps one O_APPEND descriptor per log file and commits the
+    rows it has collected with one write() per file once `batch_size` rows are
+    pending or `flush_interval` seconds have passed. When the queue is full,
+    callers block until the writer catches up instead of growing memory.
+
+    Before each write the active file is checked for rotation (see
+    log_segments); a file rotated by another process is reopened.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=256, flush_interval=0.5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._fds = {}
+        self._seen = set()     # files checked for unsealed segments
+        self._pending = {}     # filename -> list of encoded rows
+        self._pending_rows = 0
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    # --- Producer API ---
+    def write(self, filename, row):
+        """Queues one CSV row for `filename`; blocks only while the queue is full."""
+        self._ensure_started()
+        self._queue.put((filename, row))
+
+    def flush(self, timeout=5.0):
+        """Waits until every row queued before this call is on disk."""
+        if not self._running():
+            return True
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=10.0):
+        """Writes out everything still queued and stops the writer thread."""
+        if not self._running():
+            return
+        self._queue.put((_STOP, None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    # --- Writer Thread ---
+    def _running(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def _ensure_started(self):
+        if self._running():
+            return
+        with self._start_lock:
+            if self._running():
+                return
+            if self._pid != os.getpid():
+                # A forked child inherits the queue and descriptors but not the thread.
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._fds = {}
+                self._pending = {}
+                self._pending_rows = 0
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        last_commit = time.monotonic()
+        while True:
+            timeout = None
+            if self._pending_rows:
+                timeout = max(0.0, last_commit + self.flush_interval - time.monotonic())
+            try:
+                filename, payload = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._commit()
+                last_commit = time.monotonic()
+                continue
+
+            if filename is _FLUSH:
+                self._commit()
+                last_commit = time.monotonic()
+                payload.set()
+            elif filename is _STOP:
+                self._commit()
+                self._close_fds()
+                return
+            else:
+                self._buffer(filename, payload)
+                if self._pending_rows >= self.batch_size:
+                    self._commit()
+                    last_commit = time.monotonic()
+
+    def _buffer(self, filename, row):
+        out = io.StringIO()
+        csv.writer(out).writerow(row)
+        self._pending.setdefault(filename, []).append(out.getvalue())
+        self._pending_rows += 1
+
+    def _commit(self):
+        with instrumentation.timer('log_write'):
+            self._write_pending()
+        self._pending = {}
+        self._pending_rows = 0
+
+    def _write_pending(self):
+        for filename, rows in self._pending.items():
+            data = memoryview(''.join(rows).encode('utf-8'))
+            try:
+                fd = self._rotated_fd(filename, self._fd(filename), len(data))
+                while data:
+                    data = data[os.write(fd, data):]
+            except OSError as e:
+                print(f"Error writing to log {filename}: {e}")
+                fd = self._fds.pop(filename, None)
+                if fd is not None:
+                    os.close(fd)
+
+    def _fd(self, filename):
+        fd = self._fds.get(filename)
+        if fd is None:
+            if filename not in self._seen:
+                self._seen.add(filename)
+                threading.Thread(target=log_segments.seal_leftovers, args=(filename,),
+                                 name="log-sealer", daemon=True).start()
+            fd = log_segments.open_for_append(filename)
+            self._fds[filename] = fd
+        return fd
+
+    def _rotated_fd(self, filename, fd, incoming):
+        """Returns the descriptor to append `incoming` bytes to, rotating the file first if it is due."""
+        st = os.fstat(fd)
+        try:
+            current = os.stat(filename).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == st.st_ino:
+            if not log_segments.should_rotate(filename, st, incoming):
+                return fd
+            log_segments.rotate(filename, st.st_ino)
+        os.close(self._fds.pop(filename))
+        return self._fd(filename)
+
+    def _close_fds(self):
+        for fd in self._fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._fds = {}
+
+
+writer = LogWriter(
+    max_queue=getattr(config, 'LOG_QUEUE_SIZE', 10000),
+    batch_size=getattr(config, 'LOG_BATCH_SIZE', 256),
+    flush_interval=getattr(config, 'LOG_FLUSH_INTERVAL', 0.5),
+)
+atexit.register(writer.close)
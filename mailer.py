@@ -1,10 +1,229 @@
-from flask_mail import Mail, Message
+import os
+import time
+import heapq
+import queue
+import atexit
+import smtplib
+import itertools
+import threading
+from datetime import datetime
+from flask_mail import Mail, Message, BadHeaderError
 from flask import url_for
 import config
 from user import User
+from utils import log_event
+from instrumentation import instrumentation
 
 mail = Mail()
 
+# Delivery-status log: one row per sent, retried, failed or dropped message.
+MAIL_LOG_FILE = getattr(config, 'MAIL_LOG_FILE', None) or \
+    os.path.join(os.path.dirname(config.SESSION_LOG_FILE), 'mail_log.csv')
+MAIL_LOG_HEADER = ["timestamp", "recipients", "subject", "status", "attempts", "error"]
+
+# Errors the SMTP server will keep giving for this message; retrying cannot help.
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPNotSupportedError,
+                    BadHeaderError, AssertionError, UnicodeError)
+
+
+class _MailJob:
+    __slots__ = ('app', 'message', 'batch_key', 'attempts', 'parts')
+
+    def __init__(self, app, message, batch_key=None):
+        self.app = app
+        self.message = message
+        self.batch_key = batch_key
+        self.attempts = 0
+        self.parts = 1
+
+
+class MailQueue:
+    """
+    Background delivery for outgoing mail.
+
+    Request handlers build a Message and enqueue it; one worker thread sends
+    everything over a single SMTP connection that is kept open between
+    messages and closed after `idle_timeout` seconds without mail. Failed
+    sends are retried with exponential backoff. Messages enqueued with the
+    same `batch_key` and recipients within `batch_window` seconds are merged
+    into one mail. Every outcome is written to MAIL_LOG_FILE.
+    """
+
+    def __init__(self, max_queue=1000, max_retries=5, retry_base=2.0, retry_max=300.0,
+                 batch_window=2.0, idle_timeout=60.0, enqueue_timeout=2.0):
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.batch_window = batch_window
+        self.idle_timeout = idle_timeout
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._retries = []      # heap of (due, seq, job)
+        self._batches = {}      # (batch_key, recipients) -> (due, [jobs])
+        self._seq = itertools.count()
+        self._connection = None
+        self._connection_app = None
+        self._last_used = 0.0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._idle = threading.Condition()
+        self._in_flight = 0
+
+    # --- Producer API ---
+    def enqueue(self, app, message, batch_key=None):
+        """Queues a message for delivery. Returns False if the queue stayed full (the message is dropped)."""
+        self._ensure_started()
+        with self._idle:
+            self._in_flight += 1
+        try:
+            self._queue.put(_MailJob(app, message, batch_key), timeout=self.enqueue_timeout)
+            return True
+        except queue.Full:
+            self._log(message, "DROPPED", 0, "mail queue full")
+            self._done()
+            return False
+
+    def join(self, timeout=None):
+        """Waits until every queued message was sent or gave up. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout=10.0):
+        """Flushes pending batches, waits briefly for delivery and stops the worker."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    # --- Worker ---
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mail-queue", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while True:
+            now = time.monotonic()
+            self._send_due_batches(now, flush_all=stopping)
+            while self._retries and (self._retries[0][0] <= now or stopping):
+                self._deliver(heapq.heappop(self._retries)[2])
+            if stopping and self._queue.empty() and not self._batches:
+                self._close_connection()
+                return
+
+            try:
+                job = self._queue.get(timeout=self._next_wakeup())
+            except queue.Empty:
+                if self._connection is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                    self._close_connection()
+                continue
+            if job is None:
+                stopping = True
+            elif job.batch_key is not None:
+                key = (job.batch_key, tuple(job.message.recipients))
+                due, jobs = self._batches.get(key, (time.monotonic() + self.batch_window, []))
+                jobs.append(job)
+                self._batches[key] = (due, jobs)
+            else:
+                self._deliver(job)
+
+    def _next_wakeup(self):
+        dues = [due for due, _ in self._batches.values()]
+        if self._retries:
+            dues.append(self._retries[0][0])
+        if not dues:
+            return self.idle_timeout if self._connection is not None else None
+        return max(0.0, min(dues) - time.monotonic())
+
+    def _send_due_batches(self, now, flush_all=False):
+        for key, (due, jobs) in list(self._batches.items()):
+            if flush_all or due <= now:
+                del self._batches[key]
+                self._deliver(_merge(jobs))
+
+    def _deliver(self, job):
+        job.attempts += 1
+        try:
+            with job.app.app_context(), instrumentation.timer('mail_send'):
+                self._connect(job.app).send(job.message)
+            self._last_used = time.monotonic()
+            self._log(job.message, "SENT", job.attempts)
+            self._done(job.parts)
+        except PERMANENT_ERRORS as e:
+            self._log(job.message, "FAILED", job.attempts, e)
+            self._done(job.parts)
+        except Exception as e:
+            self._close_connection()  # The connection is suspect after any transport error
+            if job.attempts > self.max_retries:
+                self._log(job.message, "FAILED", job.attempts, e)
+                self._done(job.parts)
+                return
+            delay = min(self.retry_base * (2 ** (job.attempts - 1)), self.retry_max)
+            self._log(job.message, "RETRY", job.attempts, e)
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._seq), job))
+
+    def _connect(self, app):
+        if self._connection is not None and self._connection_app is not app:
+            self._close_connection()
+        if self._connection is None:
+            connection = mail.connect()
+            connection.__enter__()
+            self._connection, self._connection_app = connection, app
+        return self._connection
+
+    def _close_connection(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.__exit__(None, None, None)
+        except Exception:
+            pass
+        self._connection = self._connection_app = None
+
+    def _done(self, count=1):
+        with self._idle:
+            self._in_flight -= count
+            self._idle.notify_all()
+
+    @staticmethod
+    def _log(message, status, attempts, error=""):
+        log_event(MAIL_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), ";".join(message.recipients),
+                                  message.subject, status, attempts, str(error)])
+        if status in ("FAILED", "DROPPED"):
+            print(f"Error sending '{message.subject}' to {', '.join(message.recipients)}: {error}")
+
+
+def _merge(jobs):
+    """Combines batched jobs for the same recipients into one message."""
+    if len(jobs) == 1:
+        return jobs[0]
+    first = jobs[0].message
+    merged = Message(f"{first.subject} ({len(jobs)})", sender=first.sender, recipients=first.recipients)
+    merged.body = "\n\n".join(job.message.body for job in jobs)
+    job = _MailJob(jobs[0].app, merged, jobs[0].batch_key)
+    job.parts = len(jobs)
+    return job
+
+
+mail_queue = MailQueue(
+    max_queue=getattr(config, 'MAIL_QUEUE_SIZE', 1000),
+    max_retries=getattr(config, 'MAIL_MAX_RETRIES', 5),
+    batch_window=getattr(config, 'MAIL_BATCH_WINDOW', 2.0),
+    idle_timeout=getattr(config, 'MAIL_IDLE_TIMEOUT', 60.0),
+)
+atexit.register(mail_queue.close)
+
+
 def send_new_user_notification(app, user_email):
     """Notifies all admins that a new user has registered."""
     with app.app_context():
@@ -19,11 +238,7 @@ def send_new_user_notification(app, user_email):
             recipients=admin_emails
         )
         msg.body = f"A new user with the email {user_email} has registered and is waiting for approval."
-        try:
-            mail.send(msg)
-            print(f"Admin notification sent for {user_email} to: {', '.join(admin_emails)}")
-        except Exception as e:
-            print(f"Error sending admin notification: {e}")
+        mail_queue.enqueue(app, msg, batch_key='new_user')
 
 def send_approval_email(app, user_email):
     """Sends an email to the user when their account is approved."""
@@ -34,11 +249,7 @@ def send_approval_email(app, user_email):
             recipients=[user_email]
         )
         msg.body = "Congratulations! Your account has been approved by an administrator. You can now log in."
-        try:
-            mail.send(msg)
-            print(f"Approval email sent to {user_email}")
-        except Exception as e:
-            print(f"Error sending approval email: {e}")
+        mail_queue.enqueue(app, msg)
 
 def send_denial_email(app, user_email):
     """Sends an email to the user when their account is denied."""
@@ -49,11 +260,7 @@ def send_denial_email(app, user_email):
             recipients=[user_email]
         )
         msg.body = "We regret to inform you that your registration has been denied at this time."
-        try:
-            mail.send(msg)
-            print(f"Denial email sent to {user_email}")
-        except Exception as e:
-            print(f"Error sending denial email: {e}")
+        mail_queue.enqueue(app, msg)
 
 def send_password_reset_email(app, user_email, token):
     """Sends a password reset email to the user."""
@@ -65,8 +272,4 @@ def send_password_reset_email(app, user_email, token):
             recipients=[user_email]
         )
         msg.body = f"Click the following link to reset your password: {reset_url}"
-        try:
-            mail.send(msg)
-            print(f"Password reset email sent to {user_email}")
-        except Exception as e:
-            print(f"Error sending password reset email: {e}")
+        mail_queue.enqueue(app, msg)
@@ -1,11 +1,27 @@
 import os
+import sys
+import socket
+import logging
+import argparse
 from flask import Flask
-from waitress import serve
+from werkzeug.middleware.proxy_fix import ProxyFix
+from waitress import create_server
 from datetime import datetime, timedelta
 
 import config
 from utils import create_file_with_header
-from mailer import mail
+from mailer import mail, MAIL_LOG_FILE, MAIL_LOG_HEADER
+from search import search_index
+from content_index import content_index
+from metrics import metrics
+from upload_status import upload_status
+from scanner import upload_scanner
+from session_store import session_store, ServerSessionInterface
+from instrumentation import instrumentation
+from profiler import profiler
+from rate_limit import limiter, download_slots
+import prefork
+from resumable import STAGING_DIRNAME
 from flask_cors import CORS
 
 # Import and register blueprints
@@ -19,6 +35,8 @@ def create_app():
     app = Flask(__name__)
     app.secret_key = config.SUPER_SECRET_KEY
     app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=15)
+    # Session data stays on the server; the cookie only holds an opaque id
+    app.session_interface = ServerSessionInterface(session_store)
 
     # --- Mail Configuration ---
     app.config['MAIL_SERVER'] = config.MAIL_SERVER
@@ -29,16 +47,43 @@ def create_app():
     app.config['MAIL_USE_SSL'] = config.MAIL_USE_SSL
     mail.init_app(app)
 
+    # Per-endpoint timings, served at /admin/metrics/runtime, and slow request tracing for the profiler
+    instrumentation.init_app(app)
+    profiler.init_app(app)
+
+    # Behind reverse proxies, take the client address and scheme from their X-Forwarded-* headers
+    proxy_hops = getattr(config, 'TRUSTED_PROXY_HOPS', 0)
+    if proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops)
+
     # Register blueprints
     app.register_blueprint(auth_bp)
     app.register_blueprint(files_bp)
     app.register_blueprint(uploads_bp)
     app.register_blueprint(admin_bp)
 
+    # Every process keeps its own filename search index
+    search_index.start()
+
+    # The remaining startup jobs work on shared files and databases; with several workers, worker 0 runs them
+    if prefork.is_primary():
+        # Carry over upload history and the review queue from before the upload status store existed (runs once)
+        upload_status.import_logs(config.UPLOAD_LOG_FILE, config.DECLINED_UPLOAD_LOG_FILE,
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), config.UPLOAD_FOLDER))
+        upload_status.build_queue()
+
+        # Build the content hash index and catch up on log metrics in the background
+        content_index.start()
+        metrics.start()
+        session_store.start()
+
+        # Resume upload scans interrupted by a restart
+        upload_scanner.start(skip_dirs=(STAGING_DIRNAME,))
+
     return app
 
-if __name__ == "__main__":
-    # --- Directory and File Initialization ---
+def init_files():
+    """Creates the library folders and the CSV files with their headers if they don't exist."""
     share_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.SHARE_FOLDER)
     trash_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.TRASH_FOLDER)
     upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.UPLOAD_FOLDER)
@@ -57,10 +102,50 @@ if __name__ == "__main__":
     create_file_with_header(config.SUGGESTION_LOG_FILE, ["timestamp", "email", "suggestion"])
     create_file_with_header(config.UPLOAD_LOG_FILE, ["timestamp", "email", "filename", "path"])
     create_file_with_header(config.DECLINED_UPLOAD_LOG_FILE, ["timestamp", "email", "filename"])
+    create_file_with_header(MAIL_LOG_FILE, MAIL_LOG_HEADER)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the file library with waitress.")
+    parser.add_argument("--bind", default=getattr(config, 'SERVER_BIND', "0.0.0.0:8000"),
+                        help="HOST:PORT to listen on (default %(default)s)")
+    parser.add_argument("--threads", type=int, default=getattr(config, 'WAITRESS_THREADS', 4),
+                        help="request threads per process (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=getattr(config, 'SERVER_WORKERS', 1),
+                        help="server processes, 0 for one per CPU (default %(default)s)")
+    # Set by the supervisor for its worker processes
+    parser.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--health-fd", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not prefork.SUPPORTED:
+        print("Multiple workers need a POSIX system; serving from a single process.")
+        workers = 1
+    if args.listen_fd is None:
+        init_files()
+        if workers > 1:
+            sock = prefork.listen(*prefork.parse_bind(args.bind))
+            command = [sys.executable, os.path.abspath(__file__), "--threads", str(args.threads)]
+            prefork.Supervisor(command, sock, workers).run()
+            sys.exit(0)
 
     app = create_app()
+    limiter.max_concurrent_downloads = download_slots(args.threads)
     CORS(app, resources={r"/*": {"origins": "http://localhost:4200"}}, supports_credentials=True)
 
-
-    print("Starting server with Waitress...")
-    serve(app, host="0.0.0.0", port=8000)
+    logging.basicConfig()
+    if args.listen_fd is not None:
+        server = create_server(app, sockets=[socket.socket(fileno=args.listen_fd)], threads=args.threads)
+        instrumentation.watch_waitress(server.task_dispatcher)
+        instrumentation.gauge('server_workers_ready', "Worker processes the supervisor reports as ready",
+                              lambda: sum(w["state"] == "ready" for w in prefork.read_status()["workers"]))
+        prefork.serve_worker(server, args.health_fd, instrumentation.requests_total)
+    else:
+        print("Starting server with Waitress...")
+        host, port = prefork.parse_bind(args.bind)
+        server = create_server(app, host=host, port=port, threads=args.threads)
+        instrumentation.watch_waitress(server.task_dispatcher)
+        server.print_listen("Serving on http://{}:{}")
+        server.run()
@@ -0,0 +1,309 @@
+import io
+import os
+import csv
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+import config
+import log_segments
+from utils import sqlite_connect, sqlite_transaction, flush_logs
+
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_TYPES = ('FILE', 'FOLDER')
+
+
+class _Batch:
+    """Counters accumulated from one slice of a log before they are written in a single transaction."""
+
+    def __init__(self):
+        self.daily = Counter()        # (day, log, event) -> count
+        self.files = Counter()        # (path, type) -> count
+        self.file_last = {}           # (path, type) -> last timestamp
+        self.users = {}               # email -> [logins, failed, downloads, uploads, last_seen]
+
+    def user(self, email, timestamp):
+        activity = self.users.get(email)
+        if activity is None:
+            activity = self.users[email] = [0, 0, 0, 0, timestamp]
+        elif timestamp > activity[4]:
+            activity[4] = timestamp
+        return activity
+
+
+def _session_row(batch, row):
+    timestamp, email, event = row[0], row[1], row[2]
+    batch.daily[(timestamp[:10], 'session', event)] += 1
+    activity = batch.user(email, timestamp)
+    if event == 'LOGIN_SUCCESS':
+        activity[0] += 1
+    elif event == 'LOGIN_FAIL':
+        activity[1] += 1
+
+
+def _download_row(batch, row):
+    timestamp, email, kind, path = row[0], row[1], row[2], row[3]
+    batch.daily[(timestamp[:10], 'download', kind)] += 1
+    if kind in DOWNLOAD_TYPES:
+        batch.files[(path, kind)] += 1
+        batch.file_last[(path, kind)] = timestamp
+        batch.user(email, timestamp)[2] += 1
+
+
+def _upload_row(batch, row):
+    timestamp, email = row[0], row[1]
+    batch.daily[(timestamp[:10], 'upload', 'UPLOAD')] += 1
+    batch.user(email, timestamp)[3] += 1
+
+
+def _locate(parts, stored):
+    """Index of the source a stored (source key, offset) position points at, and the offset in it."""
+    if stored is None:
+        return 0, 0  # First run: fold in the whole history
+    key, offset = stored
+    for i, part in enumerate(parts):
+        if part.key == key:
+            return i, offset
+    if key.startswith('active:'):
+        # The active file was rotated since; its rows are now in the newest segment made from it.
+        inode = int(key.split(':', 1)[1])
+        for i in range(len(parts) - 2, -1, -1):
+            if not parts[i].active and parts[i].inode == inode:
+                return i, offset
+    return len(parts) - 1, 0
+
+
+class MetricsAggregator:
+    """
+    Incremental rollups over the session, download and upload logs.
+
+    Each log is tailed from a position stored alongside the rollups: a log
+    source (the active file or a rotated segment, see log_segments) and a
+    byte offset in it. The new rows and the advanced position are committed
+    in one transaction, so a restart resumes exactly where the last refresh
+    stopped and history is never read twice. Rotated segments are finished
+    before moving on to the next one; a log whose position can no longer be
+    found is read again from the start of its active file.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS log_offsets (
+            log      TEXT NOT NULL PRIMARY KEY,
+            source   TEXT NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_counts (
+            day   TEXT NOT NULL,
+            log   TEXT NOT NULL,
+            event TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, log, event)
+        );
+        CREATE TABLE IF NOT EXISTS file_downloads (
+            path    TEXT NOT NULL,
+            type    TEXT NOT NULL,
+            count   INTEGER NOT NULL,
+            last_at TEXT NOT NULL,
+            PRIMARY KEY (path, type)
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_downloads_count ON file_downloads (count);
+        CREATE TABLE IF NOT EXISTS user_activity (
+            email         TEXT NOT NULL PRIMARY KEY,
+            logins        INTEGER NOT NULL,
+            failed_logins INTEGER NOT NULL,
+            downloads     INTEGER NOT NULL,
+            uploads       INTEGER NOT NULL,
+            last_seen     TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, logs):
+        """`logs` maps a log name ('session', 'download', 'upload') to its CSV path."""
+        self.db_path = db_path
+        self.logs = logs
+        self._handlers = {'session': (_session_row, 3), 'download': (_download_row, 4), 'upload': (_upload_row, 2)}
+        self._local = threading.local()
+        self._schema_ready = False
+        self._refresh_lock = threading.Lock()
+        self._guard = threading.Lock()
+        self._refreshing = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    # --- Tailing ---
+    def refresh(self):
+        """Folds every row appended to the logs since the last refresh into the rollups."""
+        flush_logs()
+        with self._refresh_lock:
+            for log in self.logs:
+                try:
+                    while self._consume(log):
+                        pass
+                except OSError as e:
+                    print(f"Error aggregating {log} log: {e}")
+
+    def _consume(self, log):
+        """Applies at most READ_CHUNK_SIZE bytes of complete lines; returns True if more may follow."""
+        path = self.logs[log]
+        handler, min_columns = self._handlers[log]
+        conn = self._conn()
+        # The position is re-read inside the write transaction, so concurrent refreshes
+        # (threads or worker processes) never apply the same bytes twice.
+        with sqlite_transaction(conn):
+            parts = log_segments.sources(path)
+            if not parts:
+                return False
+            stored = conn.execute("SELECT source, position FROM log_offsets WHERE log = ?", (log,)).fetchone()
+            current, offset = _locate(parts, stored)
+            source = parts[current]
+            if offset > source.size:
+                offset = 0  # The file shrank; start it over
+            if offset >= source.size:
+                if current + 1 == len(parts):
+                    return False
+                # Finished a rotated segment; continue with the next one.
+                self._save_position(conn, log, parts[current + 1].key, 0)
+                return True
+            try:
+                with log_segments.open_at(source, offset) as f:
+                    data = f.read(READ_CHUNK_SIZE)
+            except FileNotFoundError:
+                return False  # Sealed while listing; picked up on the next refresh
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                return False  # Only a partial line so far; wait for the rest
+            batch = _Batch()
+            text = data[:end].decode('utf-8', errors='replace')
+            for row in csv.reader(io.StringIO(text, newline='')):
+                if len(row) < min_columns or row[0] == 'timestamp':
+                    continue
+                handler(batch, row)
+            self._apply(conn, batch)
+            self._save_position(conn, log, source.key, offset + end)
+            return True
+
+    @staticmethod
+    def _save_position(conn, log, source_key, position):
+        conn.execute("INSERT OR REPLACE INTO log_offsets (log, source, position) VALUES (?, ?, ?)",
+                     (log, source_key, position))
+
+    def _apply(self, conn, batch):
+        conn.executemany("""
+            INSERT INTO daily_counts (day, log, event, count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (day, log, event) DO UPDATE SET count = count + excluded.count
+        """, [(day, log, event, count) for (day, log, event), count in batch.daily.items()])
+        conn.executemany("""
+            INSERT INTO file_downloads (path, type, count, last_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (path, type) DO UPDATE SET
+                count = count + excluded.count, last_at = max(last_at, excluded.last_at)
+        """, [(path, kind, count, batch.file_last[(path, kind)]) for (path, kind), count in batch.files.items()])
+        conn.executemany("""
+            INSERT INTO user_activity (email, logins, failed_logins, downloads, uploads, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (email) DO UPDATE SET
+                logins = logins + excluded.logins,
+                failed_logins = failed_logins + excluded.failed_logins,
+                downloads = downloads + excluded.downloads,
+                uploads = uploads + excluded.uploads,
+                last_seen = max(last_seen, excluded.last_seen)
+        """, [(email, *activity) for email, activity in batch.users.items()])
+
+    def rebuild(self):
+        """Drops all rollups and offsets so the next refresh re-reads the logs from the start."""
+        conn = self._conn()
+        with self._refresh_lock, sqlite_transaction(conn):
+            for table in ('log_offsets', 'daily_counts', 'file_downloads', 'user_activity'):
+                conn.execute(f"DELETE FROM {table}")
+
+    # --- Queries ---
+    def daily(self, days):
+        """Per-day event counts for the last `days` days: {day: {"session": {...}, "download": {...}, ...}}."""
+        since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        result = {}
+        for day, log, event, count in self._conn().execute(
+                "SELECT day, log, event, count FROM daily_counts WHERE day >= ? ORDER BY day", (since,)):
+            result.setdefault(day, {}).setdefault(log, {})[event] = count
+        return result
+
+    def failed_login_rates(self, days):
+        """Per-day login attempts, failures and failure rate for the last `days` days."""
+        rates = {}
+        for day, logs in self.daily(days).items():
+            session_counts = logs.get('session', {})
+            failed = session_counts.get('LOGIN_FAIL', 0)
+            attempts = failed + session_counts.get('LOGIN_SUCCESS', 0)
+            if attempts:
+                rates[day] = {"attempts": attempts, "failed": failed, "rate": round(failed / attempts, 4)}
+        return rates
+
+    def top_files(self, limit, kind=None):
+        query = "SELECT path, type, count, last_at FROM file_downloads"
+        params = ()
+        if kind:
+            query += " WHERE type = ?"
+            params = (kind,)
+        query += " ORDER BY count DESC, path LIMIT ?"
+        return [{"path": path, "type": file_type, "downloads": count, "last_download": last_at}
+                for path, file_type, count, last_at in self._conn().execute(query, params + (limit,))]
+
+    def top_users(self, limit):
+        rows = self._conn().execute("""
+            SELECT email, logins, failed_logins, downloads, uploads, last_seen FROM user_activity
+            ORDER BY downloads + uploads + logins DESC, email LIMIT ?
+        """, (limit,))
+        return [{"email": email, "logins": logins, "failed_logins": failed, "downloads": downloads,
+                 "uploads": uploads, "last_seen": last_seen}
+                for email, logins, failed, downloads, uploads, last_seen in rows]
+
+    def user(self, email):
+        row = self._conn().execute("""
+            SELECT logins, failed_logins, downloads, uploads, last_seen FROM user_activity WHERE email = ?
+        """, (email,)).fetchone()
+        if row is None:
+            return None
+        logins, failed, downloads, uploads, last_seen = row
+        return {"email": email, "logins": logins, "failed_logins": failed, "downloads": downloads,
+                "uploads": uploads, "last_seen": last_seen}
+
+    def summary(self, days=30, top=10):
+        return {
+            "days": self.daily(days),
+            "failed_logins": self.failed_login_rates(days),
+            "top_files": self.top_files(top),
+            "top_users": self.top_users(top),
+        }
+
+    def start(self):
+        """Catches up on the logs in a background thread."""
+        self.refresh_in_background()
+
+    def refresh_in_background(self):
+        """Starts a refresh in a background thread unless one is already running; returns at once."""
+        with self._guard:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+        threading.Thread(target=run, name="metrics-aggregator", daemon=True).start()
+
+
+metrics = MetricsAggregator(
+    getattr(config, 'METRICS_DATABASE', None) or
+    os.path.join(os.path.dirname(config.SESSION_LOG_FILE), 'metrics.sqlite3'),
+    {
+        'session': config.SESSION_LOG_FILE,
+        'download': config.DOWNLOAD_LOG_FILE,
+        'upload': config.UPLOAD_LOG_FILE,
+    },
+)
@@ -0,0 +1,135 @@
+import os
+import math
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+import config
+from instrumentation import instrumentation
+from prefork import worker_count
+
+HASH_METHOD = getattr(config, 'PASSWORD_HASH_METHOD', 'scrypt')
+
+
+class PasswordPoolBusy(Exception):
+    """Raised instead of queueing when too many hashing jobs are already waiting."""
+
+    def __init__(self, retry_after):
+        super().__init__("Too many password checks in progress")
+        self.retry_after = retry_after
+
+
+def hash_parameters(pw_hash):
+    """The method/parameter part of a werkzeug hash, e.g. 'scrypt:32768:8:1'."""
+    return pw_hash.split('$', 1)[0]
+
+
+def _verify(pw_hash, password, method, parameters):
+    """Runs in a pool process: checks a password and rehashes it when the hash parameters are outdated."""
+    if not check_password_hash(pw_hash, password):
+        return False, None
+    if hash_parameters(pw_hash) != parameters:
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method)
+
+
+class PasswordPool:
+    """
+    Runs password hashing and verification in a process pool sized to the CPU.
+
+    scrypt/pbkdf2 hold a core for tens of milliseconds per call; doing that
+    on waitress threads lets a login burst starve browsing and downloads.
+    Jobs go to separate processes instead, and at most `max_pending` may be
+    in flight: beyond that callers get PasswordPoolBusy with a Retry-After
+    estimate rather than an ever-growing wait.
+    """
+
+    def __init__(self, workers=None, max_pending=None, timeout=30.0, method=HASH_METHOD):
+        # Server worker processes split the CPUs between their pools
+        self.workers = workers or max((os.cpu_count() or 1) // worker_count(), 1)
+        self.max_pending = max_pending or self.workers * 16
+        self.timeout = timeout
+        self.method = method
+        self._parameters = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._avg_seconds = 0.1
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # A forked child cannot use its parent's pool.
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset_executor(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    @property
+    def parameters(self):
+        """Hash parameters new hashes are made with; stored hashes with others are upgraded on login."""
+        if self._parameters is None:
+            self._parameters = hash_parameters(generate_password_hash('', self.method))
+        return self._parameters
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained."""
+        return max(1, math.ceil(self._pending / self.workers * self._avg_seconds))
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PasswordPoolBusy(self.retry_after())
+            self._pending += 1
+        started = time.monotonic()
+        executor = self._get_executor()
+        try:
+            return executor.submit(fn, *args).result(timeout=self.timeout)
+        except FutureTimeout:
+            raise PasswordPoolBusy(self.retry_after())
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OS); start a fresh pool for the next call.
+            self._reset_executor(executor)
+            return fn(*args)
+        finally:
+            elapsed = time.monotonic() - started
+            instrumentation.observe('password' + fn.__name__, elapsed)
+            with self._lock:
+                self._pending -= 1
+                self._avg_seconds = 0.9 * self._avg_seconds + 0.1 * elapsed
+
+    def verify(self, pw_hash, password):
+        """Returns (valid, new_hash); new_hash is set when the stored hash should be replaced."""
+        if not pw_hash or password is None:
+            return False, None
+        return self._run(_verify, pw_hash, password, self.method, self.parameters)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_pool = PasswordPool(
+    workers=getattr(config, 'PASSWORD_HASH_WORKERS', None),
+    max_pending=getattr(config, 'PASSWORD_HASH_MAX_PENDING', None),
+)
@@ -0,0 +1,354 @@
+"""
+Multi-process serving.
+
+`python main.py --workers N` runs a supervisor that binds the listening
+socket once and starts N worker processes which inherit it, so the kernel
+hands each new connection to whichever worker accepts it first. Workers
+are started as fresh interpreters rather than forked, so no threads,
+SQLite connections or process pools are copied across a fork and a reload
+picks up changed code.
+
+Each worker sends a heartbeat line over a pipe every HEARTBEAT_INTERVAL
+seconds from waitress's main loop, so a worker whose loop stops turning
+is killed and restarted like one that crashed. SIGHUP starts a new
+generation of workers and retires the old ones once their replacements
+are up; SIGTERM or SIGINT stops every worker gracefully. The supervisor
+writes the state of every worker to SERVER_STATUS_FILE.
+"""
+import os
+import json
+import time
+import signal
+import socket
+import tempfile
+import selectors
+import threading
+import subprocess
+import config
+
+try:
+    import resource
+except ImportError:  # Windows, where only a single server process is supported
+    resource = None
+
+WORKER_ENV = 'SERVER_WORKER'  # "index/count", set by the supervisor for its workers
+HEARTBEAT_INTERVAL = 2.0
+HEALTH_TIMEOUT = getattr(config, 'WORKER_HEALTH_TIMEOUT', 30)
+STARTUP_TIMEOUT = getattr(config, 'WORKER_STARTUP_TIMEOUT', 120)
+GRACEFUL_TIMEOUT = getattr(config, 'WORKER_GRACEFUL_TIMEOUT', 30)
+MAX_RESTART_DELAY = 30
+# Workers inherit the listening socket through pass_fds, which needs POSIX
+SUPPORTED = os.name == 'posix'
+# A worker that exits sooner than this after starting counts as a crash loop and is restarted with a backoff.
+STABLE_SECONDS = 10
+
+
+def worker_slot():
+    """(index, count) of this worker process; (0, 1) when not run by the supervisor."""
+    value = os.environ.get(WORKER_ENV)
+    if not value:
+        return 0, 1
+    index, _, count = value.partition('/')
+    return int(index), int(count)
+
+
+def worker_count():
+    return worker_slot()[1]
+
+
+def is_primary():
+    """True in the process that runs once-per-server background jobs (worker 0, or the only process)."""
+    return worker_slot()[0] == 0
+
+
+def status_path():
+    return getattr(config, 'SERVER_STATUS_FILE', None) or \
+        os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'server_status.json')
+
+
+def read_status():
+    """The supervisor's last report on its workers, or None when not running under one."""
+    if WORKER_ENV not in os.environ:
+        return None
+    try:
+        with open(status_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def parse_bind(value):
+    """Splits "host:port" ("[::1]:8000" for IPv6, ":8000" for every interface)."""
+    host, _, port = value.rpartition(':')
+    if not port.isdigit():
+        raise ValueError(f"Expected HOST:PORT, got {value!r}")
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+def listen(host, port, backlog=1024):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+
+# --- Supervisor ---
+class _Worker:
+    def __init__(self, slot, generation, process, health_fd):
+        self.slot = slot
+        self.generation = generation
+        self.process = process
+        self.health_fd = health_fd
+        self.buffer = b''
+        self.started = time.time()
+        self.ready = False
+        self.stopping = None      # time SIGTERM was sent
+        self.killed = False
+        self.last_beat = None
+        self.stats = {}
+
+    def describe(self, now):
+        return {"slot": self.slot, "pid": self.process.pid, "generation": self.generation,
+                "state": "stopping" if self.stopping else "ready" if self.ready else "starting",
+                "started": _timestamp(self.started),
+                "heartbeat_age": None if self.last_beat is None else round(now - self.last_beat, 1),
+                **self.stats}
+
+
+class Supervisor:
+    """Keeps `workers` copies of `command` serving on `sock`, restarting them when they die or hang."""
+
+    def __init__(self, command, sock, workers):
+        self.command = command
+        self.sock = sock
+        self.workers = workers
+        self.generation = 0
+        self._live = []
+        self._restarts = {}       # slot -> (restart count, consecutive quick exits, next start time)
+        self._selector = selectors.DefaultSelector()
+        self._signals = []
+        self._stopping = False
+        self._status_written = 0.0
+
+    def run(self):
+        wakeup_r, wakeup_w = socket.socketpair()
+        wakeup_r.setblocking(False)
+        wakeup_w.setblocking(False)
+        signal.set_wakeup_fd(wakeup_w.fileno())
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+        self._selector.register(wakeup_r, selectors.EVENT_READ, None)
+
+        host, port = self.sock.getsockname()[:2]
+        print(f"Supervisor {os.getpid()} serving on http://{host}:{port} with {self.workers} workers")
+        for slot in range(self.workers):
+            self._spawn(slot)
+        while self._live or not self._stopping:
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.data is None:
+                    try:
+                        wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._read_health(key.data)
+            while self._signals:
+                self._handle_signal(self._signals.pop(0))
+            self._reap()
+            self._check_health()
+            self._respawn_due()
+            self._write_status()
+        try:
+            os.remove(status_path())
+        except OSError:
+            pass
+        print("Supervisor stopped")
+
+    def _spawn(self, slot):
+        health_r, health_w = os.pipe()
+        env = dict(os.environ, **{WORKER_ENV: f"{slot}/{self.workers}"})
+        try:
+            process = subprocess.Popen(
+                self.command + ['--listen-fd', str(self.sock.fileno()), '--health-fd', str(health_w)],
+                pass_fds=(self.sock.fileno(), health_w), env=env)
+        finally:
+            os.close(health_w)
+        os.set_blocking(health_r, False)
+        worker = _Worker(slot, self.generation, process, health_r)
+        self._live.append(worker)
+        self._selector.register(health_r, selectors.EVENT_READ, worker)
+        return worker
+
+    def _read_health(self, worker):
+        try:
+            data = os.read(worker.health_fd, 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            self._selector.unregister(worker.health_fd)
+            os.close(worker.health_fd)
+            worker.health_fd = None
+            return
+        lines = (worker.buffer + data).split(b'\n')
+        worker.buffer = lines.pop()
+        for line in lines:
+            try:
+                worker.stats = json.loads(line)
+            except ValueError:
+                continue
+            worker.last_beat = time.time()
+            if not worker.ready:
+                worker.ready = True
+                print(f"Worker {worker.slot} (pid {worker.process.pid}) ready")
+                self._retire_older(worker)
+
+    def _retire_older(self, worker):
+        """Stops the workers of the same slot that `worker` replaces after a reload."""
+        for other in self._live:
+            if other.slot == worker.slot and other.generation < worker.generation:
+                self._stop(other)
+
+    def _stop(self, worker):
+        if worker.stopping is None:
+            worker.stopping = time.time()
+            try:
+                worker.process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def _handle_signal(self, signum):
+        if signum == signal.SIGHUP and not self._stopping:
+            self.generation += 1
+            print(f"Reloading: starting generation {self.generation}")
+            for slot in range(self.workers):
+                self._spawn(slot)
+        elif signum in (signal.SIGTERM, signal.SIGINT):
+            self._stopping = True
+            for worker in self._live:
+                self._stop(worker)
+
+    def _reap(self):
+        now = time.time()
+        for worker in list(self._live):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            self._live.remove(worker)
+            if worker.health_fd is not None:
+                self._selector.unregister(worker.health_fd)
+                os.close(worker.health_fd)
+            if worker.stopping is not None or self._stopping:
+                continue
+            if not worker.ready and any(other.slot == worker.slot and other.stopping is None for other in self._live):
+                # A replacement from a reload failed to start; its predecessor keeps serving
+                print(f"Worker {worker.slot} (pid {worker.process.pid}) of generation {worker.generation} "
+                      f"failed to start (exit code {code}); keeping the running worker")
+                continue
+            restarts, quick_exits, _ = self._restarts.get(worker.slot, (0, 0, 0))
+            quick_exits = quick_exits + 1 if now - worker.started < STABLE_SECONDS else 0
+            delay = min(2 ** quick_exits - 1, MAX_RESTART_DELAY)
+            print(f"Worker {worker.slot} (pid {worker.process.pid}) exited with code {code}; "
+                  f"restarting in {delay}s")
+            self._restarts[worker.slot] = (restarts + 1, quick_exits, now + delay)
+
+    def _respawn_due(self):
+        if self._stopping:
+            return
+        now = time.time()
+        for slot, (restarts, quick_exits, due) in list(self._restarts.items()):
+            if due and due <= now and not any(w.slot == slot and w.stopping is None for w in self._live):
+                self._restarts[slot] = (restarts, quick_exits, 0)
+                self._spawn(slot)
+
+    def _check_health(self):
+        now = time.time()
+        for worker in self._live:
+            if worker.stopping is not None:
+                overdue = now - worker.stopping > GRACEFUL_TIMEOUT + 5
+                reason = "did not stop in time"
+            elif worker.ready:
+                overdue = now - worker.last_beat > HEALTH_TIMEOUT
+                reason = f"sent no heartbeat for {HEALTH_TIMEOUT}s"
+            else:
+                overdue = now - worker.started > STARTUP_TIMEOUT
+                reason = f"did not start within {STARTUP_TIMEOUT}s"
+            if overdue and not worker.killed and worker.process.poll() is None:
+                worker.killed = True
+                print(f"Worker {worker.slot} (pid {worker.process.pid}) {reason}; killing it")
+                worker.process.kill()
+
+    def _write_status(self):
+        now = time.time()
+        if now - self._status_written < 1.0:
+            return
+        self._status_written = now
+        status = {"supervisor_pid": os.getpid(), "generation": self.generation, "workers_wanted": self.workers,
+                  "updated": _timestamp(now),
+                  "workers": [dict(worker.describe(now), restarts=self._restarts.get(worker.slot, (0,))[0])
+                              for worker in sorted(self._live, key=lambda w: (w.slot, w.generation))]}
+        path = status_path()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp_', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(status, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing server status: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def _timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+# --- Worker ---
+def serve_worker(server, health_fd, requests_total):
+    """
+    Runs a waitress server as a supervised worker: heartbeats go to
+    `health_fd`, and SIGTERM (or losing the supervisor) stops accepting
+    connections, lets requests in progress finish for up to
+    GRACEFUL_TIMEOUT seconds, then returns from server.run().
+    """
+    health = os.fdopen(health_fd, 'wb', buffering=0)
+    stopping = threading.Event()
+    dispatcher = server.task_dispatcher
+
+    def beat():
+        # Runs on waitress's main loop, so a heartbeat also proves the loop is responsive
+        stats = {"requests": requests_total(), "threads": len(dispatcher.threads),
+                 "busy": dispatcher.active_count, "queue_depth": len(dispatcher.queue),
+                 "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None}
+        try:
+            health.write((json.dumps(stats) + '\n').encode())
+        except OSError:
+            stopping.set()  # The supervisor is gone
+
+    def busy_channels():
+        return [channel for channel in list(server._map.values())
+                if getattr(channel, 'requests', None) or getattr(channel, 'request', None) is not None
+                or getattr(channel, 'total_outbufs_len', 0)]
+
+    def stop_accepting():
+        # Not server.close(), which also closes the trigger the remaining steps need
+        server.del_channel()
+        server.socket.close()
+
+    def heartbeat_loop():
+        while not stopping.wait(HEARTBEAT_INTERVAL):
+            server.trigger.pull_trigger(beat)
+        # Draining: stop accepting, then wait for the requests already taken
+        server.trigger.pull_trigger(stop_accepting)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while time.monotonic() < deadline:
+            if not dispatcher.active_count and not dispatcher.queue and not busy_channels():
+                break
+            time.sleep(0.1)
+        server.trigger.pull_trigger(lambda: [channel.close() for channel in list(server._map.values())])
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group; the supervisor sends SIGTERM
+    server.trigger.pull_trigger(beat)
+    thread = threading.Thread(target=heartbeat_loop, name="worker-heartbeat", daemon=True)
+    thread.start()
+    server.run()
+    dispatcher.shutdown()
+    health.close()
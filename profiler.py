@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import time
+import uuid
+import weakref
+import tempfile
+import threading
+from collections import Counter
+import config
+from instrumentation import ENDPOINT_KEY, is_file_wrapper
+from prefork import worker_count
+
+DEFAULT_INTERVAL = 0.01
+MAX_SECONDS = 600
+MAX_SLOW_REQUESTS = 200
+WORKER_THREAD_PREFIX = 'waitress-'
+FOLLOW_INTERVAL = 1.0  # How often worker processes pick up runs started in another worker and share their samples
+CONTROL_FILE = 'control.json'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    filename = code.co_filename
+    short = os.path.join(os.path.basename(os.path.dirname(filename)), os.path.basename(filename))
+    return f"{code.co_name} ({short}:{code.co_firstlineno})".replace(';', ':')
+
+
+def _stack(frame):
+    """Frame names from the outermost call to `frame`."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the running server.
+
+    A background thread snapshots the stacks of the waitress worker threads
+    (or of every thread) every `interval` seconds for a fixed time and
+    counts identical stacks, so the cost is one sys._current_frames() call
+    per tick regardless of the request load. With `slow_ms` set, samples
+    are buffered per request and only kept for requests that end up taking
+    at least that long, rooted under the request's endpoint.
+
+    With several worker processes, starting or stopping a run in one worker
+    is passed on to the others through a control file in `shared_dir`, each
+    worker writes its samples there, and results merge those of every worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._active = {}   # thread ident -> (ident, started, samples) of requests while tracing slow requests
+        self._detached = {}  # id -> request whose file_wrapper body the server is still sending
+        self.shared_dir = None
+        self._run_id = None
+        self._reset({})
+
+    def _reset(self, settings):
+        self.settings = settings
+        self.stacks = Counter()
+        self.samples = 0
+        self.slow_requests = []
+        self.started = None
+        self.finished = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def tracing(self):
+        return self.running and self.settings.get('slow_ms') is not None
+
+    def start(self, seconds, interval=DEFAULT_INTERVAL, slow_ms=None, all_threads=False):
+        """Starts a run, discarding the previous results; returns False if one is already running."""
+        settings = {"seconds": min(max(seconds, 1), MAX_SECONDS), "interval": max(interval, 0.001),
+                    "slow_ms": slow_ms, "all_threads": all_threads}
+        control = self._read_control()
+        if control is not None and _remaining(control) > 0:
+            return False  # Running in another worker
+        with self._lock:
+            if self.running:
+                return False
+            self._start_run(uuid.uuid4().hex, time.time(), settings, settings["seconds"])
+            control = {"run": self._run_id, "started": self.started, "settings": settings, "stopped": False}
+        if self.shared_dir:
+            for name in os.listdir(self.shared_dir):
+                if name.endswith('.json') and name != CONTROL_FILE:  # Samples of the previous run
+                    _remove(os.path.join(self.shared_dir, name))
+            self._write_control(control)
+        return True
+
+    def _start_run(self, run_id, started, settings, seconds):
+        self._reset(settings)
+        self._run_id = run_id
+        self.started = started
+        self._stop.clear()
+        self._active, self._detached = {}, {}
+        self._thread = threading.Thread(target=self._run, args=(seconds,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        control = self._read_control()
+        if control is not None and not control.get("stopped"):
+            control["stopped"] = True
+            self._write_control(control)
+        self._stop_here()
+
+    def _stop_here(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(5)
+
+    def _run(self, seconds):
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        interval = self.settings["interval"]
+        tracing = self.settings["slow_ms"] is not None
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = None if self.settings["all_threads"] else {
+                thread.ident: thread.name for thread in threading.enumerate()
+                if thread.name.startswith(WORKER_THREAD_PREFIX)}
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == own or (names is not None and ident not in names):
+                        continue
+                    if tracing:
+                        request = self._active.get(ident)
+                        if request is not None:
+                            request[2].append(';'.join(_stack(frame)))
+                    else:
+                        self.stacks[';'.join(_stack(frame))] += 1
+                self.samples += 1
+            self._stop.wait(interval)
+        with self._lock:
+            self._active, self._detached = {}, {}
+            self.finished = time.time()
+        self._share_samples()
+
+    # --- Slow request tracing ---
+    def request_started(self):
+        """Starts tracing the calling thread's request; returns the handle the other calls take."""
+        request = (threading.get_ident(), time.perf_counter(), [])
+        with self._lock:
+            self._active[request[0]] = request
+        return request
+
+    def request_detached(self, request):
+        """Stops sampling the request thread, which has moved on while the server sends the file itself."""
+        with self._lock:
+            if self._active.get(request[0]) is request:
+                del self._active[request[0]]
+                self._detached[id(request)] = request
+
+    def request_finished(self, request, endpoint, path):
+        with self._lock:
+            if self._active.get(request[0]) is request:
+                del self._active[request[0]]
+            elif self._detached.pop(id(request), None) is None:
+                return  # The run ended meanwhile
+            _, started, samples = request
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms < self.settings["slow_ms"]:
+                return
+            for stack in samples:
+                self.stacks[f"{endpoint};{stack}"] += 1
+            if len(self.slow_requests) < MAX_SLOW_REQUESTS:
+                self.slow_requests.append({"endpoint": endpoint, "path": path, "ms": round(elapsed_ms, 1),
+                                           "samples": len(samples)})
+
+    def init_app(self, app):
+        app.wsgi_app = _TracingMiddleware(app.wsgi_app, self)
+        if worker_count() > 1:
+            self.share(getattr(config, 'PROFILER_FOLDER', None) or
+                       os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'profiler'))
+
+    # --- Worker Processes ---
+    def share(self, directory):
+        """Coordinates runs with the other worker processes through `directory`."""
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory
+        threading.Thread(target=self._follow_loop, name="profiler-follow", daemon=True).start()
+
+    def _follow_loop(self):
+        while True:
+            time.sleep(FOLLOW_INTERVAL)
+            try:
+                self._follow()
+            except Exception as e:
+                print(f"Error following profiler runs: {e}")
+
+    def _follow(self):
+        """Joins or stops the run of the control file, and writes this worker's samples so far."""
+        control = self._read_control()
+        if control is not None:
+            stop = False
+            with self._lock:
+                if control["run"] != self._run_id and not self.running:
+                    remaining = _remaining(control)
+                    if remaining > 0:
+                        self._start_run(control["run"], control["started"], control["settings"], remaining)
+                    else:
+                        # Missed the run (e.g. started after it); still serve the other workers' results
+                        self._reset(control["settings"])
+                        self._run_id, self.started = control["run"], control["started"]
+                        self.finished = min(time.time(), control["started"] + control["settings"]["seconds"])
+                stop = control["run"] == self._run_id and control.get("stopped") and self.running
+            if stop:
+                self._stop_here()
+        if self.running:
+            self._share_samples()
+
+    def _read_control(self):
+        if not self.shared_dir:
+            return None
+        try:
+            with open(os.path.join(self.shared_dir, CONTROL_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_control(self, control):
+        _write_json(os.path.join(self.shared_dir, CONTROL_FILE), control)
+
+    def _share_samples(self):
+        if not self.shared_dir:
+            return
+        with self._lock:
+            if self._run_id is None:
+                return
+            state = {"run": self._run_id, "pid": os.getpid(), "samples": self.samples,
+                     "stacks": dict(self.stacks), "slow_requests": list(self.slow_requests)}
+        _write_json(os.path.join(self.shared_dir, f"{os.getpid()}.json"), state)
+
+    def _results(self):
+        """(stacks, samples, slow requests, workers) of the current run, merged over every worker."""
+        with self._lock:
+            stacks, samples, slow_requests = Counter(self.stacks), self.samples, list(self.slow_requests)
+            run_id = self._run_id
+        workers = 1
+        if self.shared_dir and run_id is not None:
+            own = f"{os.getpid()}.json"
+            for name in sorted(os.listdir(self.shared_dir)):
+                if not name.endswith('.json') or name in (CONTROL_FILE, own):
+                    continue
+                try:
+                    with open(os.path.join(self.shared_dir, name), 'r', encoding='utf-8') as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if state.get("run") == run_id:
+                    stacks.update(state["stacks"])
+                    samples += state["samples"]
+                    slow_requests.extend(state["slow_requests"])
+                    workers += 1
+        if workers > 1:
+            slow_requests.sort(key=lambda request: -request["ms"])
+        return stacks, samples, slow_requests[:MAX_SLOW_REQUESTS], workers
+
+    # --- Results ---
+    def status(self):
+        stacks, samples, slow_requests, workers = self._results()
+        control = self._read_control()
+        with self._lock:
+            status = {"running": self.running, "settings": self.settings, "samples": samples,
+                      "stacks": len(stacks), "started": _timestamp(self.started),
+                      "finished": _timestamp(self.finished), "slow_requests": slow_requests}
+        if self.shared_dir:
+            status["workers"] = workers
+            if control is not None and not control.get("stopped") and _remaining(control) > 0:
+                status["running"] = True  # Not picked up by this worker yet
+        return status
+
+    def collapsed(self):
+        """Folded stacks ("outer;inner count" per line) for flamegraph.pl, speedscope or inferno."""
+        return "".join(f"{stack} {count}\n" for stack, count in self._results()[0].most_common())
+
+    def top(self, limit=50):
+        """Functions by samples spent in them (self) and under them (total)."""
+        own, total = Counter(), Counter()
+        stacks = list(self._results()[0].items())
+        for stack, count in stacks:
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        samples = sum(count for _, count in stacks) or 1
+        lines = [f"{'self %':>8} {'total %':>8} {'self':>8} {'total':>8}  function"]
+        for name, _ in sorted(total.items(), key=lambda item: (-own[item[0]], -item[1]))[:limit]:
+            lines.append(f"{own[name] * 100 / samples:8.1f} {total[name] * 100 / samples:8.1f} "
+                         f"{own[name]:8d} {total[name]:8d}  {name}")
+        return "\n".join(lines) + "\n"
+
+
+def _remaining(control):
+    """Seconds left of the run in a control file; 0 once it is over or was stopped."""
+    if control.get("stopped"):
+        return 0
+    return max(0.0, control["started"] + control["settings"]["seconds"] - time.time())
+
+
+def _write_json(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing {path}: {e}")
+        _remove(tmp_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds)) if seconds else None
+
+
+class _TracingMiddleware:
+    """Brackets each request for slow request tracing; a plain pass-through while no trace runs."""
+
+    def __init__(self, wsgi_app, profiler):
+        self.wsgi_app = wsgi_app
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        if not self.profiler.tracing:
+            return self.wsgi_app(environ, start_response)
+        request = self.profiler.request_started()
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            _TracedBody((), environ, self.profiler, request).close()
+            raise
+        if is_file_wrapper(environ, body):
+            # Keeps waitress's fast path; the finalizer runs on its event loop thread, hence the handle
+            self.profiler.request_detached(request)
+            weakref.finalize(body, _TracedBody((), environ, self.profiler, request).close)
+            return body
+        return _TracedBody(body, environ, self.profiler, request)
+
+
+class _TracedBody:
+    """Ends the traced request once the body is exhausted or closed, whichever comes first."""
+
+    def __init__(self, body, environ, profiler, request):
+        self.body = body
+        self.environ = environ
+        self.profiler = profiler
+        self.request = request
+
+    def __iter__(self):
+        yield from self.body
+        self._finish()
+
+    def _finish(self):
+        environ, self.environ = self.environ, None
+        if environ is not None:
+            self.profiler.request_finished(self.request, environ.get(ENDPOINT_KEY, 'unmatched'),
+                                           environ.get('PATH_INFO', ''))
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._finish()
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,379 @@
+import os
+import time
+import uuid
+import weakref
+import ipaddress
+import functools
+import threading
+from collections import OrderedDict
+from flask import request, session, jsonify, Response, current_app
+import config
+from utils import sqlite_connect, sqlite_transaction
+from prefork import worker_count
+from instrumentation import is_file_wrapper
+
+# Token bucket rules: `rate` tokens are added per second up to `burst`. Every rule is
+# applied separately to each key it is checked with (user, IP, submitted email).
+DEFAULT_RULES = {
+    'download': {'rate': 2.0, 'burst': 30},            # download requests
+    'download_bytes': {'rate': 10 * 1024 * 1024, 'burst': 20 * 1024 * 1024},  # bytes/sec per user
+    'login': {'rate': 1 / 6, 'burst': 10},
+    'register': {'rate': 1 / 60, 'burst': 5},
+    'forgot_password': {'rate': 1 / 60, 'burst': 3},
+}
+RULES = {**DEFAULT_RULES, **getattr(config, 'RATE_LIMITS', {})}
+MAX_CONCURRENT_DOWNLOADS = getattr(config, 'MAX_CONCURRENT_DOWNLOADS', 3)
+# A throttled download holds a request thread, so one user never gets more than this share of them.
+DOWNLOAD_THREAD_SHARE = 4
+# Rather than sleep longer than this for the download_bytes bucket, a download is refused or cut off.
+MAX_DOWNLOAD_WAIT = getattr(config, 'MAX_DOWNLOAD_WAIT', 2)
+# Number of reverse proxies in front of the app (see main.create_app), and further proxy addresses
+# or networks; requests that still appear to come from a proxy are not limited per IP.
+TRUSTED_PROXY_HOPS = getattr(config, 'TRUSTED_PROXY_HOPS', 0)
+TRUSTED_PROXIES = [ipaddress.ip_network(proxy, strict=False) for proxy in getattr(config, 'TRUSTED_PROXIES', [])]
+# Streamed bytes are settled with the store in steps of this size rather than per chunk.
+BYTES_SETTLE_STEP = 256 * 1024
+
+
+# --- Stores ---
+class MemoryStore:
+    """Buckets and download slots of this process only; the default for a single server process."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> (tokens, updated)
+        self._slots = {}                # key -> set of slot tokens
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1, allow_debt=False):
+        """Takes `cost` tokens; returns seconds to wait (0 when allowed). With allow_debt the tokens are always taken."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = _take(tokens, rate, cost)
+            if wait == 0 or allow_debt:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def acquire_slot(self, key, limit):
+        with self._lock:
+            held = self._slots.setdefault(key, set())
+            if len(held) >= limit:
+                return None
+            token = uuid.uuid4().hex
+            held.add(token)
+            return token
+
+    def release_slot(self, key, token):
+        with self._lock:
+            held = self._slots.get(key)
+            if held is not None:
+                held.discard(token)
+                if not held:
+                    del self._slots[key]
+
+
+class SqliteStore:
+    """
+    Buckets and download slots shared by every server process through one
+    SQLite file. Slots record the owning pid, so those of a crashed worker
+    are reclaimed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key     TEXT NOT NULL PRIMARY KEY,
+            tokens  REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS slots (
+            token    TEXT NOT NULL PRIMARY KEY,
+            key      TEXT NOT NULL,
+            pid      INTEGER NOT NULL,
+            acquired REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_slots_key ON slots (key);
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._schema_ready = False
+        self._takes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    def take(self, key, rate, burst, cost=1, allow_debt=False):
+        now = time.time()
+        conn = self._conn()
+        with sqlite_transaction(conn):
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = _take(tokens, rate, cost)
+            if wait == 0 or allow_debt:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            self._takes += 1
+            if self._takes % self.PRUNE_EVERY == 0:
+                # A bucket idle for a day has long been full again; dropping it changes nothing.
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 86400,))
+        return wait
+
+    def acquire_slot(self, key, limit):
+        conn = self._conn()
+        with sqlite_transaction(conn):
+            for token, pid in conn.execute("SELECT token, pid FROM slots WHERE key = ?", (key,)).fetchall():
+                if not _pid_alive(pid):
+                    conn.execute("DELETE FROM slots WHERE token = ?", (token,))
+            held = conn.execute("SELECT COUNT(*) FROM slots WHERE key = ?", (key,)).fetchone()[0]
+            if held >= limit:
+                return None
+            token = uuid.uuid4().hex
+            conn.execute("INSERT INTO slots (token, key, pid, acquired) VALUES (?, ?, ?, ?)",
+                         (token, key, os.getpid(), time.time()))
+            return token
+
+    def release_slot(self, key, token):
+        self._conn().execute("DELETE FROM slots WHERE token = ?", (token,))
+
+
+def _take(tokens, rate, cost):
+    """Seconds until `cost` tokens are available given the current balance (0 if they are)."""
+    if tokens >= cost:
+        return 0.0
+    if rate <= 0:
+        return float('inf')
+    return (cost - tokens) / rate
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+# --- Limiter ---
+class RateLimiter:
+    """Applies the named RULES to request keys on top of a store."""
+
+    def __init__(self, store, rules, max_concurrent_downloads):
+        self.store = store
+        self.rules = rules
+        self.max_concurrent_downloads = max_concurrent_downloads
+
+    def check(self, rule, *keys):
+        """Takes one token of `rule` for every key; returns seconds to wait if any bucket is empty, else 0."""
+        limits = self.rules.get(rule)
+        if not limits:
+            return 0
+        wait = 0
+        for key in keys:
+            if key:
+                wait = max(wait, self.store.take(f"{rule}:{key}", limits['rate'], limits['burst']))
+        return wait
+
+    def acquire_download(self, user):
+        """Reserves one of the user's concurrent download slots; returns a token or None when all are taken."""
+        if not self.max_concurrent_downloads:
+            return ''
+        return self.store.acquire_slot(f"downloads:{user}", self.max_concurrent_downloads)
+
+    def release_download(self, user, token):
+        if token:
+            self.store.release_slot(f"downloads:{user}", token)
+
+    def download_debt(self, user):
+        """Seconds until the user's download_bytes bucket is out of debt (0 if it is not)."""
+        limits = self.rules.get('download_bytes')
+        if not limits:
+            return 0
+        return self.store.take(f"download_bytes:{user}", limits['rate'], limits['burst'], 0)
+
+    def limit_download(self, response, user, token):
+        """
+        Throttles a download response to the user's download_bytes rule and
+        frees its slot once the body has been sent. The body is wrapped
+        rather than using call_on_close, which direct_passthrough skips.
+
+        file_wrapper bodies are left untouched, so waitress still sends them
+        from its event loop instead of a request thread. Their full length
+        is charged up front, and the debt holds back the user's next
+        downloads instead.
+        """
+        key = f"download_bytes:{user}"
+        limits = self.rules.get('download_bytes')
+        if is_file_wrapper(request.environ, response.response):  # Has a length, so is_streamed is False
+            if limits:
+                self.store.take(key, limits['rate'], limits['burst'], response.content_length or 0, allow_debt=True)
+                limits = None
+        elif not response.is_streamed:
+            self.release_download(user, token)  # Nothing is left to send once the view returns
+            return response
+        if not limits:
+            try:  # The slot is freed when the server lets go of the body
+                weakref.finalize(response.response, self.release_download, user, token)
+                return response
+            except TypeError:  # Body type without weak references
+                pass
+        response.response = _DownloadBody(response.response, self.store, key, limits,
+                                          lambda: self.release_download(user, token))
+        return response
+
+
+class _DownloadBody:
+    """
+    Response body that sleeps whenever the byte bucket runs into debt and
+    runs `on_close` once. A debt of more than MAX_DOWNLOAD_WAIT seconds ends
+    the response with an error instead, and the client resumes later with a
+    Range request.
+    """
+
+    def __init__(self, chunks, store, key, limits, on_close):
+        self.chunks = chunks
+        self.store = store
+        self.key = key
+        self.limits = limits
+        self.on_close = on_close
+
+    def __iter__(self):
+        if not self.limits:
+            yield from self.chunks
+            return
+        rate, burst = self.limits['rate'], self.limits['burst']
+        unsettled = 0
+        for chunk in self.chunks:
+            yield chunk
+            unsettled += len(chunk)
+            if unsettled >= BYTES_SETTLE_STEP:
+                wait = self.store.take(self.key, rate, burst, unsettled, allow_debt=True)
+                if wait > MAX_DOWNLOAD_WAIT:
+                    raise RuntimeError(f"Download cut off: {self.key} is {wait:.0f}s in debt")
+                time.sleep(wait)
+                unsettled = 0
+        if unsettled:
+            self.store.take(self.key, rate, burst, unsettled, allow_debt=True)
+
+    def close(self):
+        try:
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close is not None:
+                on_close()
+
+
+def too_many_requests(wait, message="Too many requests, please try again later"):
+    retry_after = str(max(1, int(wait + 0.999)))
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return jsonify({"error": message}), 429, {"Retry-After": retry_after}
+    return Response(message + ".", 429, {"Retry-After": retry_after}, mimetype='text/plain')
+
+
+# Request keys rules can be checked with.
+def client_ip():
+    """
+    The client's address, or None when the request still appears to come
+    from a proxy (e.g. it sent no X-Forwarded-For), so that all clients
+    behind it do not share one bucket.
+    """
+    address = request.remote_addr
+    if TRUSTED_PROXY_HOPS and address == request.environ.get('werkzeug.proxy_fix.orig', {}).get('REMOTE_ADDR'):
+        return None
+    if TRUSTED_PROXIES and address:
+        try:
+            if any(ipaddress.ip_address(address) in network for network in TRUSTED_PROXIES):
+                return None
+        except ValueError:
+            pass
+    return address
+
+
+def session_user():
+    return session.get("email")
+
+
+def submitted_email():
+    data = request.get_json(silent=True) or {}
+    email = data.get("email")
+    return email.strip().lower() if isinstance(email, str) else None
+
+
+def limited_download(view):
+    """
+    Route decorator for downloads: applies the `download` request rule per
+    user and IP, caps concurrent downloads per user and throttles the body.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user = session_user()
+        if not user:
+            return view(*args, **kwargs)
+        wait = limiter.check('download', user, client_ip())
+        if wait:
+            return too_many_requests(wait)
+        wait = limiter.download_debt(user)
+        if wait > MAX_DOWNLOAD_WAIT:
+            return too_many_requests(wait, "Download limit reached, please try again later")
+        token = limiter.acquire_download(user)
+        if token is None:
+            return too_many_requests(5, "Too many downloads in progress, please wait for one to finish")
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            limiter.release_download(user, token)
+            raise
+        return limiter.limit_download(response, user, token)
+    return wrapper
+
+
+def rate_limited(rule, *key_functions):
+    """Route decorator: answers 429 with Retry-After when any of the keys has used up `rule`."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            wait = limiter.check(rule, *(key() for key in key_functions))
+            if wait:
+                return too_many_requests(wait)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_store():
+    # Worker processes must share their buckets and download slots, or each would grant the full limit
+    backend = getattr(config, 'RATE_LIMIT_BACKEND', None) or ('sqlite' if worker_count() > 1 else 'memory')
+    if backend == 'sqlite':
+        return SqliteStore(getattr(config, 'RATE_LIMIT_DATABASE', None) or
+                           os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'rate_limits.sqlite3'))
+    return MemoryStore()
+
+
+def download_slots(threads):
+    """Concurrent downloads per user with `threads` request threads per process (0 for no cap)."""
+    if not MAX_CONCURRENT_DOWNLOADS:
+        return 0
+    return min(MAX_CONCURRENT_DOWNLOADS, max(1, threads // DOWNLOAD_THREAD_SHARE))
+
+
+limiter = RateLimiter(get_store(), RULES, download_slots(getattr(config, 'WAITRESS_THREADS', 4)))
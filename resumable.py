@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows: chunks are only serialized between threads
+    fcntl = None
+
+CHUNK_SIZE = 256 * 1024
+MANIFEST = 'manifest.json'
+STAGING_DIRNAME = '.staging'  # inside UPLOAD_FOLDER
+
+
+class UploadSessionError(Exception):
+    """A protocol error in a resumable upload; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadSessionStore:
+    """
+    Resumable (tus-style) upload sessions staged under `staging_dir`.
+
+    A session is a folder holding a JSON manifest (owner, target subpath,
+    declared files) and one `<file_id>.part` staging file per declared file.
+    The size of a .part file on disk is its upload offset, so sessions survive
+    a server restart. Chunks for different files of a session may be written
+    in parallel; chunks for the same file are serialized and must arrive at
+    the current offset.
+
+    Each file's SHA-256 is updated as its chunks are written and saved as
+    `<file_id>.sha256` once the file is complete, so finalizing does not
+    read the files again. Only a chunk that continues a file this process
+    did not write the previous chunk of (after a restart, or in another
+    worker) first hashes the bytes already staged.
+    """
+
+    def __init__(self, staging_dir, ttl=24 * 3600):
+        self.staging_dir = staging_dir
+        self.ttl = ttl
+        self._locks = {}
+        self._digests = {}  # (session_id, file_id) -> (offset, sha256 of the bytes before it)
+        self._locks_guard = threading.Lock()
+
+    # --- Sessions ---
+    def create(self, owner, subpath, files):
+        """Creates a session for `files` ([(relative_name, size), ...]) and returns its status."""
+        self.expire()
+        session_id = uuid.uuid4().hex
+        manifest = {
+            "id": session_id,
+            "owner": owner,
+            "subpath": subpath,
+            "created": time.time(),
+            "files": {uuid.uuid4().hex[:16]: {"name": name, "size": size} for name, size in files},
+        }
+        session_dir = self._session_dir(session_id)
+        os.makedirs(session_dir)
+        for file_id, entry in manifest["files"].items():
+            open(os.path.join(session_dir, f"{file_id}.part"), 'wb').close()
+            if entry["size"] == 0:
+                _write_digest(session_dir, file_id, hashlib.sha256())
+        self._write_manifest(session_dir, manifest)
+        return self.status(session_id, owner)
+
+    def status(self, session_id, owner):
+        manifest = self._manifest(session_id, owner)
+        session_dir = self._session_dir(session_id)
+        return {
+            "session_id": session_id,
+            "subpath": manifest["subpath"],
+            "files": [{"file_id": file_id, "name": entry["name"], "size": entry["size"],
+                       "offset": _size_or_zero(os.path.join(session_dir, f"{file_id}.part"))}
+                      for file_id, entry in manifest["files"].items()],
+        }
+
+    def delete(self, session_id, owner):
+        self._manifest(session_id, owner)
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+        with self._locks_guard:
+            for key in [key for key in self._locks if key[0] == session_id]:
+                del self._locks[key]
+                self._digests.pop(key, None)
+
+    def expire(self):
+        """Removes sessions older than the TTL."""
+        if not os.path.isdir(self.staging_dir):
+            return
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.staging_dir):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        with self._locks_guard:  # Also drops those of sessions completed or removed by another process
+            for key in [key for key in self._locks if not os.path.isdir(self._session_dir(key[0]))]:
+                del self._locks[key]
+                self._digests.pop(key, None)
+
+    # --- Chunks ---
+    def write_chunk(self, session_id, owner, file_id, offset, stream, length=None):
+        """
+        Appends bytes read from `stream` to a staged file, starting at `offset`
+        (which must equal the current offset). Returns the new offset.
+        """
+        manifest = self._manifest(session_id, owner)
+        entry = manifest["files"].get(file_id)
+        if entry is None:
+            raise UploadSessionError("Unknown file id.", 404)
+        session_dir = self._session_dir(session_id)
+        part_path = os.path.join(session_dir, f"{file_id}.part")
+
+        lock = self._file_lock(session_id, file_id)
+        if not lock.acquire(blocking=False):
+            raise UploadSessionError("Another chunk for this file is in progress.", 409)
+        try:
+            with open(part_path, 'r+b') as f:
+                if not _try_flock(f):  # The same check across server processes
+                    raise UploadSessionError("Another chunk for this file is in progress.", 409)
+                current = os.fstat(f.fileno()).st_size
+                if offset != current:
+                    raise UploadSessionError(f"Offset mismatch; the upload is at {current}.", 409)
+                if length is not None and current + length > entry["size"]:
+                    raise UploadSessionError("Chunk extends past the declared file size.", 413)
+                key = (session_id, file_id)
+                offset_hashed, digest = self._digests.pop(key, (None, None))
+                if offset_hashed != current:
+                    digest = _hash_prefix(f, current)
+                f.seek(current)
+                written = 0
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if current + written + len(chunk) > entry["size"]:
+                        f.truncate(current + written)
+                        raise UploadSessionError("Chunk extends past the declared file size.", 413)
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+                if current + written == entry["size"]:
+                    _write_digest(session_dir, file_id, digest)
+                else:
+                    self._digests[key] = (current + written, digest)
+            os.utime(session_dir)  # Keeps active sessions from expiring
+            return current + written
+        finally:
+            lock.release()
+
+    # --- Finalize ---
+    def completed_files(self, session_id, owner):
+        """Returns (manifest, [(name, staged_path, sha256), ...]) once every file is fully uploaded."""
+        manifest = self._manifest(session_id, owner)
+        session_dir = self._session_dir(session_id)
+        staged = []
+        for file_id, entry in manifest["files"].items():
+            part_path = os.path.join(session_dir, f"{file_id}.part")
+            if _size_or_zero(part_path) != entry["size"]:
+                raise UploadSessionError(f"'{entry['name']}' is not fully uploaded yet.", 409)
+            try:
+                with open(os.path.join(session_dir, f"{file_id}.sha256"), 'r', encoding='ascii') as f:
+                    sha256 = f.read()
+            except FileNotFoundError:  # Staged by an older version, or stopped right after the last chunk
+                with open(part_path, 'rb') as f:
+                    sha256 = _hash_prefix(f, entry["size"]).hexdigest()
+            staged.append((entry["name"], part_path, sha256))
+        return manifest, staged
+
+    # --- Helpers ---
+    def _session_dir(self, session_id):
+        if not session_id.isalnum():
+            raise UploadSessionError("Unknown upload session.", 404)
+        return os.path.join(self.staging_dir, session_id)
+
+    def _manifest(self, session_id, owner):
+        try:
+            with open(os.path.join(self._session_dir(session_id), MANIFEST), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise UploadSessionError("Unknown upload session.", 404)
+        if manifest["owner"] != owner:
+            raise UploadSessionError("Unknown upload session.", 404)
+        return manifest
+
+    @staticmethod
+    def _write_manifest(session_dir, manifest):
+        tmp_path = os.path.join(session_dir, MANIFEST + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(session_dir, MANIFEST))
+
+    def _file_lock(self, session_id, file_id):
+        with self._locks_guard:
+            return self._locks.setdefault((session_id, file_id), threading.Lock())
+
+
+def _try_flock(f):
+    """Locks an open file for this process until it is closed; False if another process holds it."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _hash_prefix(f, length):
+    """SHA-256 state after the first `length` bytes of an open file."""
+    digest = hashlib.sha256()
+    f.seek(0)
+    while length > 0:
+        chunk = f.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        digest.update(chunk)
+        length -= len(chunk)
+    return digest
+
+
+def _write_digest(session_dir, file_id, digest):
+    with open(os.path.join(session_dir, f"{file_id}.sha256"), 'w', encoding='ascii') as f:
+        f.write(digest.hexdigest())
+
+
+def _size_or_zero(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+_project_dir = os.path.dirname(os.path.abspath(__file__))
+upload_sessions = UploadSessionStore(
+    os.path.join(_project_dir, config.UPLOAD_FOLDER, STAGING_DIRNAME),
+    ttl=getattr(config, 'RESUMABLE_UPLOAD_TTL', 24 * 3600),
+)
@@ -1,9 +1,15 @@
+import os
 from datetime import datetime
-from flask import Blueprint, render_template, session, abort, redirect, url_for, flash, send_file, current_app
+from flask import Blueprint, render_template, session, abort, redirect, url_for, flash, current_app, request, Response, jsonify
 
 import config
 from user import User
-from utils import csv_to_xlsx_in_memory
+from log_export import LogFilter, EXPORT_FORMATS, iter_log_rows, stream_csv, stream_ndjson, stream_xlsx, sheet_title
+from metrics import metrics
+from session_store import session_store
+from instrumentation import instrumentation
+from profiler import profiler, DEFAULT_INTERVAL
+import prefork
 from mailer import send_approval_email, send_denial_email
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -16,7 +22,90 @@ def admin_metrics():
         {"type": "download", "name": "Download Log (File/Folder/Delete)", "description": "Track all file, folder, and delete events."},
         {"type": "suggestion", "name": "Suggestion Log (User Feedback)", "description": "Records all user suggestions."},
     ]
-    return render_template("admin_metrics.html", log_files=log_files)
+    return render_template("admin_metrics.html", log_files=log_files, profiler=profiler.status())
+
+@admin_bp.route("/metrics/summary")
+def metrics_summary():
+    if not session.get("is_admin"): abort(403)
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    top = min(max(request.args.get('top', 10, type=int), 1), 100)
+    metrics.refresh_in_background()  # Answers from the rollups as they are; new log rows show up on a later call
+    return jsonify(metrics.summary(days, top)), 200
+
+@admin_bp.route("/metrics/files")
+def metrics_files():
+    if not session.get("is_admin"): abort(403)
+    metrics.refresh_in_background()
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+    file_type = request.args.get('type')
+    if file_type not in (None, 'FILE', 'FOLDER'): return abort(400)
+    return jsonify({"files": metrics.top_files(limit, file_type)}), 200
+
+@admin_bp.route("/metrics/users/<string:email>")
+def metrics_user(email):
+    if not session.get("is_admin"): abort(403)
+    metrics.refresh_in_background()
+    activity = metrics.user(email)
+    if activity is None:
+        return jsonify({"error": "No activity recorded"}), 404
+    return jsonify(activity), 200
+
+@admin_bp.route("/metrics/runtime")
+def metrics_runtime():
+    if not session.get("is_admin"): abort(403)
+    if request.args.get("format") == "prometheus" or request.accept_mimetypes.best == "text/plain":
+        return Response(instrumentation.prometheus(), mimetype="text/plain; version=0.0.4")
+    snapshot = instrumentation.snapshot()
+    # The numbers above are this worker's; the supervisor reports on every worker
+    snapshot["server"] = prefork.read_status()
+    return jsonify(snapshot), 200
+
+@admin_bp.route("/profiler")
+def profiler_status():
+    if not session.get("is_admin"): abort(403)
+    return jsonify(profiler.status()), 200
+
+@admin_bp.route("/profiler/start", methods=["POST"])
+def profiler_start():
+    if not session.get("is_admin"): abort(403)
+    params = request.get_json(silent=True) or request.form
+    try:
+        seconds = float(params.get("seconds", 30))
+        interval = float(params.get("interval_ms", DEFAULT_INTERVAL * 1000)) / 1000
+        slow_ms = float(params["slow_ms"]) if params.get("slow_ms") not in (None, "") else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "seconds, interval_ms and slow_ms must be numbers"}), 400
+    all_threads = str(params.get("all_threads", "")).lower() in ("1", "true", "on", "yes")
+    started = profiler.start(seconds, interval, slow_ms, all_threads)
+    if not request.is_json:
+        if started:
+            flash(f"Profiling for {int(profiler.settings['seconds'])} seconds.", "success")
+        else:
+            flash("The profiler is already running.", "error")
+        return redirect(url_for('admin.admin_metrics'))
+    if not started:
+        return jsonify({"error": "The profiler is already running"}), 409
+    return jsonify(profiler.status()), 202
+
+@admin_bp.route("/profiler/stop", methods=["POST"])
+def profiler_stop():
+    if not session.get("is_admin"): abort(403)
+    profiler.stop()
+    if not request.is_json:
+        return redirect(url_for('admin.admin_metrics'))
+    return jsonify(profiler.status()), 200
+
+@admin_bp.route("/profiler/download/<string:output>")
+def profiler_download(output):
+    if not session.get("is_admin"): abort(403)
+    if output not in ("collapsed", "top"):
+        abort(404)
+    if profiler.started is None:
+        return jsonify({"error": "The profiler has not been run"}), 404
+    body = profiler.collapsed() if output == "collapsed" else profiler.top(request.args.get("limit", 50, type=int))
+    stamp = datetime.fromtimestamp(profiler.started).strftime("%Y%m%d_%H%M%S")
+    return Response(body, mimetype="text/plain",
+                    headers={"Content-Disposition": f"attachment; filename=profile_{stamp}_{output}.txt"})
 
 @admin_bp.route("/users")
 def admin_users():
@@ -39,17 +128,9 @@ def admin_denied():
 @admin_bp.route("/approve/<string:email>", methods=["POST"])
 def approve_user(email):
     if not session.get("is_admin"): abort(403)
-    pending_users = User.get_pending()
-    user_to_approve = next((user for user in pending_users if user.email == email), None)
+    user_to_approve = User.approve(email)
 
     if user_to_approve:
-        auth_users = User.get_all()
-        user_to_approve.status = 'active'
-        auth_users.append(user_to_approve)
-        User.save_all(auth_users)
-
-        remaining_pending = [user for user in pending_users if user.email != email]
-        User.save_pending(remaining_pending)
         send_approval_email(current_app._get_current_object(), email)
         flash(f"User {email} has been approved.", "success")
     else:
@@ -59,16 +140,9 @@ def approve_user(email):
 @admin_bp.route("/deny/<string:email>", methods=["POST"])
 def deny_user(email):
     if not session.get("is_admin"): abort(403)
-    pending_users = User.get_pending()
-    user_to_deny = next((user for user in pending_users if user.email == email), None)
+    user_to_deny = User.deny(email)
 
     if user_to_deny:
-        denied_users = User.get_denied()
-        denied_users.append(user_to_deny)
-        User.save_denied(denied_users)
-
-        remaining_pending = [user for user in pending_users if user.email != email]
-        User.save_pending(remaining_pending)
         send_denial_email(current_app._get_current_object(), email)
         flash(f"Registration for {email} has been denied.", "success")
     else:
@@ -78,16 +152,9 @@ def deny_user(email):
 @admin_bp.route("/re_pend/<string:email>", methods=["POST"])
 def re_pend_user(email):
     if not session.get("is_admin"): abort(403)
-    denied_users = User.get_denied()
-    user_to_re_pend = next((user for user in denied_users if user.email == email), None)
+    user_to_re_pend = User.re_pend(email)
 
     if user_to_re_pend:
-        pending_users = User.get_pending()
-        pending_users.append(user_to_re_pend)
-        User.save_pending(pending_users)
-
-        remaining_denied = [user for user in denied_users if user.email != email]
-        User.save_denied(remaining_denied)
         flash(f"User {email} has been moved back to pending.", "success")
     else:
         flash(f"Could not find denied user {email}.", "error")
@@ -99,15 +166,9 @@ def toggle_role(email):
     if email == session.get('email'):
         flash("For security, you cannot change your own admin status.", "error")
         return redirect(url_for('admin.admin_users'))
-    users = User.get_all()
-    user_found = False
-    for user in users:
-        if user.email == email:
-            user.role = 'user' if user.is_admin else 'admin'
-            user_found = True
-            break
-    if user_found:
-        User.save_all(users)
+    if User.toggle_role(email):
+        # Open sessions still carry the old admin flag; make the user log in again
+        session_store.revoke_user(email)
         flash(f"Successfully updated role for {email}.", "success")
     else:
         flash(f"Could not find user {email}.", "error")
@@ -119,20 +180,32 @@ def toggle_status(email):
     if email == session.get('email'):
         flash("You cannot change your own status.", "error")
         return redirect(url_for('admin.admin_users'))
-    users = User.get_all()
-    user_found = False
-    for user in users:
-        if user.email == email:
-            user.status = 'inactive' if user.is_active else 'active'
-            user_found = True
-            break
-    if user_found:
-        User.save_all(users)
+    user = User.toggle_status(email)
+    if user:
+        if not user.is_active:
+            session_store.revoke_user(email)
         flash(f"Successfully updated status for {email}.", "success")
     else:
         flash(f"Could not find user {email}.", "error")
     return redirect(url_for('admin.admin_users'))
 
+@admin_bp.route("/api/sessions")
+def list_sessions():
+    if not session.get("is_admin"): abort(403)
+    return jsonify({"sessions": session_store.list(request.args.get("email"))}), 200
+
+@admin_bp.route("/api/sessions/<string:session_id>/revoke", methods=["POST"])
+def revoke_session(session_id):
+    if not session.get("is_admin"): abort(403)
+    if not session_store.revoke(session_id):
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"revoked": 1}), 200
+
+@admin_bp.route("/api/sessions/user/<string:email>/revoke", methods=["POST"])
+def revoke_user_sessions(email):
+    if not session.get("is_admin"): abort(403)
+    return jsonify({"revoked": session_store.revoke_user(email)}), 200
+
 @admin_bp.route("/metrics/download/<log_type>")
 def download_metrics_xlsx(log_type):
     if not session.get("is_admin"): abort(403)
@@ -144,13 +217,29 @@ def download_metrics_xlsx(log_type):
     if log_type not in log_map: return abort(404)
     
     csv_filepath, file_prefix = log_map[log_type]
+    export_format = request.args.get('format', 'xlsx')
+    if export_format not in EXPORT_FORMATS: return abort(400)
+    try:
+        log_filter = LogFilter.from_args(request.args)
+    except ValueError:
+        return abort(400)
+    if not os.path.exists(csv_filepath): return abort(404)
+
+    download_name = f"{file_prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    rows = iter_log_rows(csv_filepath, log_filter)
     try:
-        xlsx_data = csv_to_xlsx_in_memory(csv_filepath)
-        download_name = f"{file_prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        return send_file(xlsx_data, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                         download_name=download_name, as_attachment=True)
-    except FileNotFoundError:
-        return abort(404)
+        # Every format streams while the log is read, so only the cap is known up front.
+        if export_format == 'xlsx':
+            body = stream_xlsx(rows, sheet_title(csv_filepath))
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        elif export_format == 'csv':
+            body, mimetype = stream_csv(rows), 'text/csv'
+        else:
+            body, mimetype = stream_ndjson(rows), 'application/x-ndjson'
+        response = Response(body, mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        response.headers['X-Export-Row-Cap'] = str(log_filter.limit)
+        return response
     except Exception as e:
-        print(f"Error during XLSX conversion: {e}")
+        print(f"Error during log export: {e}")
         return abort(500)
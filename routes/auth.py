@@ -1,12 +1,12 @@
 import re
-import csv
 from datetime import datetime
 from flask import Blueprint, render_template, request, redirect, url_for, session, current_app, flash, jsonify
 from flask_cors import cross_origin
-from werkzeug.security import generate_password_hash
 import config
 from user import User
 from utils import log_event
+from password_pool import password_pool, PasswordPoolBusy
+from rate_limit import rate_limited, client_ip, submitted_email
 from mailer import send_new_user_notification, send_password_reset_email
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
 
@@ -14,15 +14,14 @@ auth_bp = Blueprint('auth', __name__)
 
 def email_exists(email):
     """Checks if an email exists in auth, pending, or denied users."""
-    return User.find_by_email(email) or User.find_pending_by_email(email) or User.find_denied_by_email(email)
+    return User.email_exists(email)
 
-@auth_bp.before_request
-def before_request():
-    """Reset the session timer with each request."""
-    session.permanent = True
+def busy_response(e):
+    return jsonify({"error": "Server is busy, please try again shortly"}), 503, {"Retry-After": str(e.retry_after)}
 
 @auth_bp.route("/login", methods=["POST"])
 @cross_origin()  # מאפשר גישה מ- http://localhost:4200
+@rate_limited('login', client_ip, submitted_email)
 def api_login():
     data = request.get_json()
     if not data:
@@ -34,8 +33,15 @@ def api_login():
 
 
     user = User.find_by_email(email)
-
-    if not user or not user.check_password(password):
+    valid, new_hash = False, None
+    if user:
+        # Verification runs in the password process pool, not on this request thread
+        try:
+            valid, new_hash = password_pool.verify(user.password, password)
+        except PasswordPoolBusy as e:
+            return busy_response(e)
+
+    if not valid:
         log_event(config.SESSION_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), email, "LOGIN_FAIL"])
         return jsonify({"error": "Invalid credentials"}), 401
 
@@ -43,6 +49,11 @@ def api_login():
         return jsonify({"error": "Account inactive"}), 403
 
 
+    if new_hash:
+        # The stored hash used outdated parameters; upgrade it now that the password is known
+        User.set_password(user.email, new_hash)
+
+    session.regenerate()
     session["logged_in"] = True
     session["email"] = user.email
     session["is_admin"] = user.is_admin
@@ -57,6 +68,7 @@ def api_login():
 
 @auth_bp.route("/register", methods=["POST"])
 @cross_origin()
+@rate_limited('register', client_ip, submitted_email)
 def api_register():
     data = request.get_json()
     if not data:
@@ -71,9 +83,14 @@ def api_register():
     if len(password) < 8:
         return jsonify({"error": "Password must be at least 8 characters long"}), 400
 
-    hashed_password = generate_password_hash(password)
-    with open(config.NEW_USER_DATABASE, mode='a', newline='', encoding='utf-8') as f:
-        csv.writer(f).writerow([email, hashed_password, 'user'])
+    try:
+        hashed_password = password_pool.hash(password)
+    except PasswordPoolBusy as e:
+        return busy_response(e)
+    try:
+        User.add_pending(User(email, hashed_password, 'user'))
+    except ValueError:
+        return jsonify({"error": "Email already registered or pending"}), 409
 
     send_new_user_notification(current_app._get_current_object(), email)
     return jsonify({"message": "Registration successful. Pending admin approval."}), 201
@@ -86,6 +103,7 @@ def logout():
 
 @auth_bp.route("/forgot-password", methods=["POST"])
 @cross_origin()
+@rate_limited('forgot_password', client_ip, submitted_email)
 def api_forgot_password():
     data = request.get_json()
     email = data.get("email")
@@ -113,16 +131,12 @@ def reset_password(token):
     if request.method == "POST":
         password = request.form["password"]
         # Add password validation logic here (same as registration)
-        users = User.get_all()
-        user_found = False
-        for user in users:
-            if user.email == email:
-                user.password = generate_password_hash(password)
-                user_found = True
-                break
-        
-        if user_found:
-            User.save_all(users)
+        try:
+            password_hash = password_pool.hash(password)
+        except PasswordPoolBusy as e:
+            flash("The server is busy. Please try again in a moment.", "error")
+            return render_template("reset_password.html", token=token), 503, {"Retry-After": str(e.retry_after)}
+        if User.set_password(email, password_hash):
             flash("Your password has been updated successfully.", "success")
             return redirect(url_for("auth.login"))
         else:
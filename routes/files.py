@@ -1,21 +1,26 @@
 import os
 import shutil
-import zipfile
-from io import BytesIO
 from datetime import datetime
-from flask import Blueprint, render_template, redirect, url_for, session, send_from_directory, send_file, abort, flash, request
+from flask import Blueprint, render_template, redirect, url_for, session, send_file, abort, flash, request, Response, jsonify
+from flask_cors import cross_origin
+from werkzeug.security import safe_join
 
 import config
 from utils import log_event
+from archive import archive_cache, content_disposition
+from listing import listing_index
+from search import search_index
+from content_index import content_index
+from file_response import send_share_file, is_new_download
+from rate_limit import limited_download
 
 files_bp = Blueprint('files', __name__)
 
-@files_bp.route('/')
-@files_bp.route('/browse/', defaults={'subpath': ''})
-@files_bp.route('/browse/<path:subpath>')
-def downloads(subpath=''):
-    if not session.get("logged_in"): return redirect(url_for("auth.login"))
-    
+BROWSE_PAGE_SIZE = getattr(config, 'BROWSE_PAGE_SIZE', 500)
+BROWSE_MAX_PAGE_SIZE = 5000
+
+def _resolve_browse_path(subpath):
+    """Returns (safe_subpath, absolute_path) for a browse request, or aborts."""
     share_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes",""), config.SHARE_FOLDER)
 
     safe_subpath = os.path.normpath(subpath).replace('\\', '/')
@@ -23,48 +28,73 @@ def downloads(subpath=''):
         safe_subpath = ''
         
     if '/.' in safe_subpath:
-        return abort(404)
+        abort(404)
         
     current_path = os.path.join(share_dir, safe_subpath)
     
     if not os.path.abspath(current_path).startswith(os.path.abspath(share_dir)):
-        return abort(403)
-
-    items = []
-    if os.path.exists(current_path) and os.path.isdir(current_path):
-        folders = []
-        files = []
-        for item_name in os.listdir(current_path):
-            if item_name.startswith('.'): continue
-            
-            item_path_os = os.path.join(current_path, item_name)
-            item_path_url = os.path.join(safe_subpath, item_name).replace('\\', '/')
-            
-            item_data = {"name": item_name, "path": item_path_url}
-            
-            if os.path.isdir(item_path_os):
-                item_data["is_folder"] = True
-                folders.append(item_data)
-            else:
-                item_data["is_folder"] = False
-                files.append(item_data)
-        
-        folders.sort(key=lambda x: x['name'].lower())
-        files.sort(key=lambda x: x['name'].lower())
-        
-        items = folders + files
-    
+        abort(403)
+    return safe_subpath, current_path
+
+def _browse_page(subpath):
+    """Reads paging and sort arguments and returns one page of the folder listing."""
+    safe_subpath, current_path = _resolve_browse_path(subpath)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', BROWSE_PAGE_SIZE, type=int), 1), BROWSE_MAX_PAGE_SIZE)
+    sort = request.args.get('sort', 'name')
+    if sort not in ('name', 'size', 'mtime'):
+        sort = 'name'
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+
+    entries, total = listing_index.page(current_path, page, per_page, sort, reverse=(order == 'desc'))
+    items = [{"name": name,
+              "path": os.path.join(safe_subpath, name).replace('\\', '/'),
+              "is_folder": is_folder,
+              "size": size,
+              "mtime": mtime} for name, is_folder, size, mtime in entries]
     back_path = os.path.dirname(safe_subpath).replace('\\', '/') if safe_subpath else None
+    return {"path": safe_subpath, "back_path": back_path, "items": items, "page": page, "per_page": per_page,
+            "total": total, "pages": max((total + per_page - 1) // per_page, 1), "sort": sort, "order": order}
+
+@files_bp.route('/')
+@files_bp.route('/browse/', defaults={'subpath': ''})
+@files_bp.route('/browse/<path:subpath>')
+def downloads(subpath=''):
+    if not session.get("logged_in"): return redirect(url_for("auth.login"))
+    listing = _browse_page(subpath)
 
     return render_template("downloads.html", 
-                           items=items, 
-                           current_path=safe_subpath, 
-                           back_path=back_path,
+                           items=listing["items"], 
+                           current_path=listing["path"], 
+                           back_path=listing["back_path"],
+                           listing=listing,
                            suggestion_error=session.pop('suggestion_error', None),
                            suggestion_success=session.pop('suggestion_success', None),
                            cooldown_level=session.get("cooldown_index", 0) + 1,
                            is_admin=session.get('is_admin', False))
 
+@files_bp.route('/api/browse/', defaults={'subpath': ''})
+@files_bp.route('/api/browse/<path:subpath>')
+@cross_origin()
+def api_browse(subpath=''):
+    """JSON form of the folder listing for the Angular frontend."""
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(_browse_page(subpath)), 200
+
+
+@files_bp.route('/api/search')
+@cross_origin()
+def api_search():
+    """Ranked, paginated filename search over the shared library."""
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    results, total = search_index.search(query, page, per_page)
+    return jsonify({"query": query, "results": results, "total": total, "page": page, "per_page": per_page}), 200
+
 
 @files_bp.route("/delete/<path:item_path>", methods=["POST"])
 def delete_item(item_path):
@@ -86,6 +116,10 @@ def delete_item(item_path):
 
     try:
         shutil.move(source_path, dest_path)
+        archive_cache.invalidate(source_path)
+        listing_index.invalidate(source_path)
+        search_index.remove_path(source_path)
+        content_index.remove_library_path(source_path)
         flash(f"Successfully moved '{base_name}' to trash.", "success")
         log_event(config.DOWNLOAD_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), session.get("email", "unknown"), "DELETE", item_path])
     except Exception as e:
@@ -97,17 +131,21 @@ def delete_item(item_path):
     return redirect(url_for('files.downloads'))
 
 @files_bp.route("/download/file/<path:file_path>")
+@limited_download
 def download_file(file_path):
     if not session.get("logged_in"): return redirect(url_for("auth.login"))
-    log_event(config.DOWNLOAD_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), session.get("email", "unknown"), "FILE", file_path])
     share_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes",""), config.SHARE_FOLDER)
 
-    directory, filename = os.path.split(file_path)
-    safe_dir = os.path.join(share_dir, directory)
-    if not safe_dir.startswith(share_dir) or not os.path.isdir(safe_dir): return abort(403)
-    return send_from_directory(safe_dir, filename, as_attachment=True)
+    absolute_file_path = safe_join(share_dir, file_path)
+    if absolute_file_path is None: return abort(403)
+    if not os.path.isfile(absolute_file_path): return abort(404)
+    response = send_share_file(absolute_file_path, file_path, os.path.basename(file_path))
+    if is_new_download(response):
+        log_event(config.DOWNLOAD_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), session.get("email", "unknown"), "FILE", file_path])
+    return response
 
 @files_bp.route("/download/folder/<path:folder_path>")
+@limited_download
 def download_folder(folder_path):
     if not session.get("logged_in"): return redirect(url_for("auth.login"))
     log_event(config.DOWNLOAD_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), session.get("email", "unknown"), "FOLDER", folder_path])
@@ -116,14 +154,13 @@ def download_folder(folder_path):
     absolute_folder_path = os.path.join(share_dir, folder_path)
     if not os.path.isdir(absolute_folder_path) or not absolute_folder_path.startswith(share_dir): return abort(404)
     
-    memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(absolute_folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                zf.write(file_path, os.path.relpath(file_path, absolute_folder_path))
-    memory_file.seek(0)
-    return send_file(memory_file, download_name=f'{os.path.basename(folder_path)}.zip', as_attachment=True)
+    download_name = f'{os.path.basename(folder_path)}.zip'
+    archive_path, chunks = archive_cache.open(absolute_folder_path)
+    if archive_path:
+        return send_file(archive_path, mimetype='application/zip', download_name=download_name, as_attachment=True)
+    response = Response(chunks, mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = content_disposition(download_name)
+    return response
 
 COOLDOWN_LEVELS = [60, 300, 600, 1800, 3600]
 @files_bp.route("/suggest", methods=["POST"])
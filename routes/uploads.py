@@ -1,33 +1,40 @@
 import os
-import csv
 import shutil
-import magic
 from datetime import datetime
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, abort
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, abort, jsonify
+from flask_cors import cross_origin
 
 import config
 from utils import log_event
+from archive import archive_cache
+from listing import listing_index
+from search import search_index
+from content_index import content_index, save_and_hash
+from resumable import upload_sessions, UploadSessionError, STAGING_DIRNAME
+from upload_status import upload_status, top_level_item
+from scanner import upload_scanner, CLEAN, REJECTED
 
 uploads_bp = Blueprint('uploads', __name__)
 
+MY_UPLOADS_PAGE_SIZE = 50
+REVIEW_PAGE_SIZE = 50
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in config.ALLOWED_EXTENSIONS
 
-def is_file_malicious(file_stream):
-    """
-    Checks the magic number of a file to determine if it's potentially malicious.
-    """
-    file_signature = file_stream.read(2048)  # Read the first 2048 bytes
-    file_stream.seek(0)  # Reset stream position
-    
-    file_type = magic.from_buffer(file_signature, mime=True)
-
-    # Add more sophisticated checks here if needed
-    if "executable" in file_type:
-        return True
-    
-    return False
+def safe_upload_path(upload_dir, filename):
+    """Returns where an uploaded (possibly folder-relative) filename is saved, or None if it escapes upload_dir."""
+    # Security check to prevent path traversal attacks
+    if '..' in filename.split('/') or '..' in filename.split('\\') or os.path.isabs(filename):
+        return None
+    if filename.replace('\\', '/').split('/')[0] == STAGING_DIRNAME:
+        return None
+    save_path = os.path.join(upload_dir, filename)
+    # Final security check to ensure the path doesn't escape the upload directory
+    if not os.path.abspath(save_path).startswith(os.path.abspath(upload_dir)):
+        return None
+    return save_path
 
 
 @uploads_bp.route("/upload", defaults={'subpath': ''}, methods=["GET", "POST"])
@@ -53,118 +60,212 @@ def upload_file(subpath):
                     flash(f"File type not allowed for {file.filename}", "error")
                     continue
 
-                if is_file_malicious(file.stream):
-                    flash(f"Malicious file detected: {file.filename}", "error")
-                    continue
                 # filename from the browser can include the relative path for folder uploads
                 filename = file.filename
                 
-                # Security check to prevent path traversal attacks
-                if '..' in filename.split('/') or '..' in filename.split('\\') or os.path.isabs(filename):
+                save_path = safe_upload_path(upload_dir, filename)
+                if save_path is None:
                     flash(f"Invalid path in filename: '{filename}' was skipped.", "error")
                     continue
-                
-                save_path = os.path.join(upload_dir, filename)
-
-                # Final security check to ensure the path doesn't escape the upload directory
-                if not os.path.abspath(save_path).startswith(os.path.abspath(upload_dir)):
-                    flash(f"Invalid save path for file: '{filename}' was skipped.", "error")
-                    continue
 
                 try:
                     # Create parent directories if they don't exist
                     os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                    file.save(save_path)
+                    sha256, size = save_and_hash(file.stream, save_path)
+                    content_index.record_upload(save_path, sha256, size)
+                    upload_scanner.submit(save_path, sha256)
                     
                     # The suggested path for the file after admin approval
                     final_path_suggestion = os.path.join(upload_subpath, filename).replace('\\', '/')
                     
-                    log_event(config.UPLOAD_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), session.get("email"), filename, final_path_suggestion])
+                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    log_event(config.UPLOAD_LOG_FILE, [timestamp, session.get("email"), filename, final_path_suggestion])
+                    upload_status.record_upload(session.get("email"), filename, final_path_suggestion, timestamp)
                     successful_uploads.append(filename)
                 except Exception as e:
                     flash(f"Could not upload '{filename}'. Error: {e}", "error")
 
         if successful_uploads:
-            flash(f'Successfully uploaded {len(successful_uploads)} file(s). Files are pending review.', 'success')
+            flash(f'Successfully uploaded {len(successful_uploads)} file(s). Files are pending scanning and review.', 'success')
         
         return redirect(url_for('files.downloads', subpath=upload_subpath))
 
     return render_template('upload.html', subpath=subpath)
 
+# --- Resumable Upload API ---
+# POST   /api/uploads                          create a session: {"subpath", "files": [{"name", "size"}]}
+# GET    /api/uploads/<id>                     offsets of every file in the session
+# PATCH  /api/uploads/<id>/files/<file_id>     raw chunk body, "Upload-Offset" header = current offset
+# POST   /api/uploads/<id>/finalize            validate, publish to UPLOAD_FOLDER and log
+# DELETE /api/uploads/<id>                     abandon the session
+
+@uploads_bp.errorhandler(UploadSessionError)
+def upload_session_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+@uploads_bp.route("/api/uploads", methods=["POST"])
+@cross_origin()
+def api_create_upload():
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict) or not isinstance(data.get("subpath", ""), str):
+        return jsonify({"error": "Expected a JSON object with a files list"}), 400
+    files = data.get("files") or []
+    if not isinstance(files, list):
+        return jsonify({"error": "Expected a JSON object with a files list"}), 400
+    if not files:
+        return jsonify({"error": "No files declared"}), 400
+
+    upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes",""), config.UPLOAD_FOLDER)
+    declared = []
+    for entry in files:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+            return jsonify({"error": "Every file needs a name and a size"}), 400
+        name, size = entry["name"], entry.get("size")
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            return jsonify({"error": f"Invalid size for '{name}'"}), 400
+        if not allowed_file(name):
+            return jsonify({"error": f"File type not allowed for {name}"}), 400
+        if safe_upload_path(upload_dir, name) is None:
+            return jsonify({"error": f"Invalid path in filename: '{name}'"}), 400
+        declared.append((name, size))
+
+    status = upload_sessions.create(session.get("email"), data.get("subpath", ""), declared)
+    return jsonify(status), 201
+
+@uploads_bp.route("/api/uploads/<session_id>", methods=["GET"])
+@cross_origin()
+def api_upload_status(session_id):
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(upload_sessions.status(session_id, session.get("email"))), 200
+
+@uploads_bp.route("/api/uploads/<session_id>/files/<file_id>", methods=["PATCH"])
+@cross_origin(expose_headers=["Upload-Offset"])
+def api_upload_chunk(session_id, file_id):
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    offset = request.headers.get("Upload-Offset", type=int)
+    if offset is None:
+        return jsonify({"error": "Missing Upload-Offset header"}), 400
+    # Read the raw body straight into the staging file; no form parsing or spooling
+    new_offset = upload_sessions.write_chunk(session_id, session.get("email"), file_id, offset,
+                                             request.stream, request.content_length)
+    return "", 204, {"Upload-Offset": str(new_offset)}
+
+@uploads_bp.route("/api/uploads/<session_id>/finalize", methods=["POST"])
+@cross_origin()
+def api_finalize_upload(session_id):
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    user_email = session.get("email")
+    manifest, staged = upload_sessions.completed_files(session_id, user_email)
+    upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes",""), config.UPLOAD_FOLDER)
+    upload_subpath = manifest["subpath"]
+
+    uploaded, rejected = [], []
+    for filename, staged_path, sha256 in staged:
+        if not allowed_file(filename):
+            rejected.append({"name": filename, "error": "File type not allowed"})
+            continue
+        save_path = safe_upload_path(upload_dir, filename)
+        try:
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+            os.replace(staged_path, save_path)
+            content_index.record_upload(save_path, sha256, os.path.getsize(save_path))
+            upload_scanner.submit(save_path, sha256)
+        except OSError as e:
+            rejected.append({"name": filename, "error": str(e)})
+            continue
+        final_path_suggestion = os.path.join(upload_subpath, filename).replace('\\', '/')
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        log_event(config.UPLOAD_LOG_FILE, [timestamp, user_email, filename, final_path_suggestion])
+        upload_status.record_upload(user_email, filename, final_path_suggestion, timestamp)
+        uploaded.append(filename)
+
+    upload_sessions.delete(session_id, user_email)
+    return jsonify({"uploaded": uploaded, "rejected": rejected}), 200
+
+@uploads_bp.route("/api/uploads/<session_id>", methods=["DELETE"])
+@cross_origin()
+def api_cancel_upload(session_id):
+    if not session.get("logged_in"):
+        return jsonify({"error": "Not logged in"}), 401
+    upload_sessions.delete(session_id, session.get("email"))
+    return "", 204
+
+def _my_uploads_page():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', MY_UPLOADS_PAGE_SIZE, type=int), 1), 500)
+    uploads, total = upload_status.page_for_user(session.get('email'), page, per_page)
+    return {"uploads": uploads, "page": page, "per_page": per_page, "total": total,
+            "pages": max((total + per_page - 1) // per_page, 1)}
+
 @uploads_bp.route('/my_uploads')
 def my_uploads():
     if not session.get('logged_in'):
         return redirect(url_for('auth.login'))
+    history = _my_uploads_page()
+    return render_template('my_uploads.html', uploads=history["uploads"], history=history)
 
-    upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes",""), config.UPLOAD_FOLDER)
-    user_email = session.get('email')
-    user_uploads = []
-    
-    declined_items = set()
-    try:
-        with open(config.DECLINED_UPLOAD_LOG_FILE, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['email'] == user_email:
-                    declined_items.add(row['filename'])
-    except FileNotFoundError:
-        pass
+@uploads_bp.route('/api/my_uploads')
+@cross_origin()
+def api_my_uploads():
+    if not session.get('logged_in'):
+        return jsonify({"error": "Not logged in"}), 401
+    return jsonify(_my_uploads_page()), 200
 
-    try:
-        with open(config.UPLOAD_LOG_FILE, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['email'] == user_email:
-                    full_relative_path = row['filename']
-                    top_level_item = full_relative_path.split('/')[0].split('\\')[0]
-
-                    if top_level_item in declined_items:
-                        row['status'] = 'Declined'
-                    elif os.path.exists(os.path.join(upload_dir, full_relative_path)):
-                        row['status'] = 'Pending Review'
-                    else:
-                        row['status'] = 'Approved & Moved'
-                    user_uploads.append(row)
-    except FileNotFoundError:
-        pass
+@uploads_bp.route('/api/my_uploads/<int:upload_id>')
+@cross_origin()
+def api_my_upload(upload_id):
+    if not session.get('logged_in'):
+        return jsonify({"error": "Not logged in"}), 401
+    upload = upload_status.get(session.get('email'), upload_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(upload), 200
 
-    user_uploads.reverse()
-    return render_template('my_uploads.html', uploads=user_uploads)
+def _duplicate_note(upload_item):
+    """Describes which files of a pending upload already exist in the library, or returns None."""
+    file_count, duplicates = content_index.upload_duplicates(upload_item)
+    if not duplicates:
+        return None
+    if file_count == 1:
+        return f"Already in library at {duplicates[0][1]}"
+    return f"{len(duplicates)} of {file_count} files already in library (e.g. {duplicates[0][1]})"
+
+def _review_page():
+    upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes", ""), config.UPLOAD_FOLDER)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', REVIEW_PAGE_SIZE, type=int), 1), 500)
+    entries, total = upload_status.pending_page(page, per_page)
+    for entry in entries:
+        entry["duplicate"] = _duplicate_note(os.path.join(upload_dir, entry["filename"]))
+        entry["scan"] = upload_scanner.item_state(entry["filename"])
+    return {"uploads": entries, "page": page, "per_page": per_page, "total": total,
+            "pages": max((total + per_page - 1) // per_page, 1)}
 
 @uploads_bp.route("/admin/uploads")
 def admin_uploads():
     if not session.get("is_admin"):
         abort(403)
-        
-    upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)).replace("routes", ""), config.UPLOAD_FOLDER)
-    grouped_uploads = {}
-    
-    try:
-        with open(config.UPLOAD_LOG_FILE, mode='r', newline='', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            header = next(reader, None)
-            all_uploads_logged = list(reader)
-
-        for row in reversed(all_uploads_logged):
-            timestamp, email, relative_path, suggested_full_path = row[0], row[1], row[2], row[3]
-            top_level_item = relative_path.split('/')[0].split('\\')[0]
-
-            if top_level_item not in grouped_uploads:
-                if os.path.exists(os.path.join(upload_dir, top_level_item)):
-                    is_part_of_dir_upload = '/' in relative_path or '\\' in relative_path
-                    final_approval_path = os.path.dirname(suggested_full_path) if is_part_of_dir_upload else suggested_full_path
-                    
-                    grouped_uploads[top_level_item] = {
-                        "timestamp": timestamp, 
-                        "email": email, 
-                        "filename": top_level_item,
-                        "path": final_approval_path
-                    }
-    except (FileNotFoundError, StopIteration):
-        pass
-        
-    final_uploads_list = sorted(list(grouped_uploads.values()), key=lambda x: x['timestamp'])
-    return render_template("admin_uploads.html", uploads=final_uploads_list)
+    queue = _review_page()
+    return render_template("admin_uploads.html", uploads=queue["uploads"], queue=queue)
+
+@uploads_bp.route("/admin/api/uploads")
+@cross_origin()
+def api_admin_uploads():
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(_review_page()), 200
+
+@uploads_bp.route("/admin/api/uploads/count")
+@cross_origin()
+def api_admin_uploads_count():
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({"pending": upload_status.pending_count()}), 200
 
 
 @uploads_bp.route("/admin/move_upload/<path:filename>", methods=["POST"])
@@ -182,6 +283,14 @@ def move_upload(filename):
 
     source_item = os.path.join(upload_dir, filename)
     destination_path = os.path.join(share_dir, target_path_str)
+
+    scan = upload_scanner.item_state(top_level_item(filename))
+    if scan["state"] != CLEAN:
+        if scan["state"] == REJECTED:
+            flash(f'Item "{filename}" failed the upload scan and cannot be approved.', "error")
+        else:
+            flash(f'Item "{filename}" is still being scanned; try again shortly.', "error")
+        return redirect(url_for("uploads.admin_uploads"))
     
     safe_destination = os.path.abspath(destination_path)
     if not safe_destination.startswith(os.path.abspath(share_dir)):
@@ -190,9 +299,17 @@ def move_upload(filename):
 
     try:
         os.makedirs(os.path.dirname(safe_destination), exist_ok=True)
-        shutil.move(source_item, safe_destination)
+        linked = content_index.publish(source_item, safe_destination)
+        archive_cache.invalidate(safe_destination)
+        listing_index.invalidate(safe_destination)
+        search_index.add_path(safe_destination)
+        upload_status.approve(top_level_item(filename), target_path_str)
+        upload_scanner.forget(source_item)
         flash(f'Item "{filename}" has been successfully moved to "{target_path_str}".', "success")
+        if linked:
+            flash(f'{linked} file(s) were already in the library and were linked instead of copied.', "success")
     except FileNotFoundError:
+        upload_status.dequeue(top_level_item(filename))
         flash(f'Error: Source item "{filename}" not found.', "error")
     except Exception as e:
         flash(f"An error occurred while moving the item: {e}", "error")
@@ -209,6 +326,9 @@ def decline_upload(filename):
     user_email = request.form.get("email", "unknown")
     
     log_event(config.DECLINED_UPLOAD_LOG_FILE, [datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_email, filename])
+    content_index.forget_upload(item_to_delete)
+    upload_status.decline(top_level_item(filename))
+    upload_scanner.forget(item_to_delete)
 
     try:
         if os.path.exists(item_to_delete):
@@ -0,0 +1,267 @@
+import os
+import zipfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import magic
+import config
+from utils import sqlite_connect, sqlite_transaction
+from content_index import hash_file
+
+QUEUED = 'queued'
+CLEAN = 'clean'
+REJECTED = 'rejected'
+
+ARCHIVE_MAX_ENTRIES = getattr(config, 'SCAN_ARCHIVE_MAX_ENTRIES', 10000)
+ARCHIVE_MAX_UNCOMPRESSED = getattr(config, 'SCAN_ARCHIVE_MAX_UNCOMPRESSED', 2 * 1024 * 1024 * 1024)
+ARCHIVE_MAX_RATIO = getattr(config, 'SCAN_ARCHIVE_MAX_RATIO', 100)
+
+EXECUTABLE_MIME_TYPES = {'application/x-dosexec', 'application/x-executable', 'application/x-sharedlib',
+                         'application/x-mach-binary', 'application/x-pie-executable'}
+EXECUTABLE_EXTENSIONS = {'exe', 'dll', 'scr', 'bat', 'cmd', 'com', 'msi', 'ps1', 'vbs'}
+ZIP_BASED_EXTENSIONS = {'zip', 'docx', 'xlsx', 'pptx'}
+# MIME types libmagic may report for each allowed extension.
+EXPECTED_MIME_TYPES = {
+    'pdf': {'application/pdf'},
+    'png': {'image/png'},
+    'jpg': {'image/jpeg'},
+    'jpeg': {'image/jpeg'},
+    'docx': {'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/zip',
+             'application/octet-stream'},
+    'zip': {'application/zip', 'application/x-zip-compressed'},
+    'mp4': {'video/*', 'application/octet-stream'},
+    'txt': {'text/*', 'application/json', 'application/csv', 'application/x-empty', 'inode/x-empty'},
+}
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+# --- Detectors ---
+# A detector is called as detector(path, filename, mime) and returns a reason string when the
+# file must not be published, or None. Register more with register_detector().
+
+def executable_detector(path, filename, mime):
+    if mime in EXECUTABLE_MIME_TYPES or 'executable' in mime:
+        return f"Executable content ({mime})"
+    return None
+
+
+def mime_mismatch_detector(path, filename, mime):
+    expected = EXPECTED_MIME_TYPES.get(_extension(filename))
+    if not expected or mime in expected or f"{mime.split('/')[0]}/*" in expected:
+        return None
+    return f"Content is {mime}, not a .{_extension(filename)} file"
+
+
+def archive_bomb_detector(path, filename, mime):
+    if _extension(filename) not in ZIP_BASED_EXTENSIONS and mime != 'application/zip':
+        return None
+    try:
+        with zipfile.ZipFile(path) as archive:
+            entries = archive.infolist()
+    except zipfile.BadZipFile:
+        return "Corrupt archive" if _extension(filename) == 'zip' else None
+    if len(entries) > ARCHIVE_MAX_ENTRIES:
+        return f"Archive has {len(entries)} entries (limit {ARCHIVE_MAX_ENTRIES})"
+    uncompressed = sum(entry.file_size for entry in entries)
+    if uncompressed > ARCHIVE_MAX_UNCOMPRESSED:
+        return f"Archive expands to {uncompressed} bytes (limit {ARCHIVE_MAX_UNCOMPRESSED})"
+    compressed = sum(entry.compress_size for entry in entries)
+    if compressed and uncompressed / compressed > ARCHIVE_MAX_RATIO:
+        return f"Archive compression ratio {uncompressed // compressed}:1 (limit {ARCHIVE_MAX_RATIO}:1)"
+    for entry in entries:
+        if _extension(entry.filename) in EXECUTABLE_EXTENSIONS:
+            return f"Archive contains an executable ({entry.filename})"
+    return None
+
+
+DETECTORS = [executable_detector, mime_mismatch_detector, archive_bomb_detector]
+
+
+def register_detector(detector):
+    """Adds a detector to every future scan; verdicts cached under the old detector set are not reused."""
+    DETECTORS.append(detector)
+    return detector
+
+
+def scan_file(path, filename):
+    """Runs every detector on a file; returns the first reason for rejecting it, or None."""
+    mime = magic.from_file(path, mime=True)
+    for detector in DETECTORS:
+        reason = detector(path, filename, mime)
+        if reason:
+            return reason
+    return None
+
+
+class UploadScanner:
+    """
+    Scans uploads on a worker pool after the request that stored them.
+
+    Every uploaded file enters quarantine in state `queued` and ends up
+    `clean` or `rejected`. Verdicts are cached by content hash and file
+    extension (the MIME check depends on it), so re-uploading a known file
+    is decided without scanning. Queued files are rescanned after a restart.
+    Admins can only approve an upload item once all of its files are clean.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS scan_files (
+            path      TEXT NOT NULL PRIMARY KEY,
+            top_level TEXT NOT NULL,
+            sha256    TEXT NOT NULL,
+            state     TEXT NOT NULL,
+            reason    TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_scan_files_top_level ON scan_files (top_level, state);
+        CREATE TABLE IF NOT EXISTS verdicts (
+            sha256     TEXT NOT NULL,
+            extension  TEXT NOT NULL,
+            detectors  TEXT NOT NULL,
+            state      TEXT NOT NULL,
+            reason     TEXT,
+            scanned_at TEXT NOT NULL,
+            PRIMARY KEY (sha256, extension)
+        );
+    """
+
+    def __init__(self, db_path, upload_dir, workers=2):
+        self.db_path = db_path
+        self.upload_dir = os.path.abspath(upload_dir)
+        self.workers = workers
+        self._local = threading.local()
+        self._schema_ready = False
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._outstanding = 0
+        self._idle = threading.Condition()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    def _relpath(self, abs_path):
+        return os.path.relpath(os.path.abspath(abs_path), self.upload_dir).replace(os.sep, '/')
+
+    @staticmethod
+    def _detector_set():
+        return ','.join(detector.__name__ for detector in DETECTORS)
+
+    # --- Submission ---
+    def submit(self, abs_path, sha256):
+        """Quarantines an uploaded file; returns its state (already final when the verdict was cached)."""
+        relpath = self._relpath(abs_path)
+        conn = self._conn()
+        cached = conn.execute("SELECT state, reason FROM verdicts WHERE sha256 = ? AND extension = ? AND detectors = ?",
+                              (sha256, _extension(relpath), self._detector_set())).fetchone()
+        state, reason = cached if cached else (QUEUED, None)
+        conn.execute("INSERT OR REPLACE INTO scan_files (path, top_level, sha256, state, reason) VALUES (?, ?, ?, ?, ?)",
+                     (relpath, relpath.split('/')[0], sha256, state, reason))
+        if state == QUEUED:
+            self._enqueue(relpath, sha256)
+        return state
+
+    def _enqueue(self, relpath, sha256):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload-scanner")
+        with self._idle:
+            self._outstanding += 1
+        self._executor.submit(self._scan, relpath, sha256)
+
+    def _scan(self, relpath, sha256):
+        try:
+            path = os.path.join(self.upload_dir, relpath)
+            if not os.path.isfile(path):
+                return  # Declined before it was scanned
+            try:
+                reason = scan_file(path, relpath)
+            except Exception as e:
+                reason = f"Scan failed: {e}"
+            state = REJECTED if reason else CLEAN
+            conn = self._conn()
+            with sqlite_transaction(conn):
+                conn.execute("UPDATE scan_files SET state = ?, reason = ? WHERE path = ? AND sha256 = ?",
+                             (state, reason, relpath, sha256))
+                if not (reason or '').startswith("Scan failed"):
+                    conn.execute("""
+                        INSERT OR REPLACE INTO verdicts (sha256, extension, detectors, state, reason, scanned_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (sha256, _extension(relpath), self._detector_set(), state, reason,
+                          datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        except Exception as e:
+            print(f"Error scanning upload {relpath}: {e}")
+        finally:
+            with self._idle:
+                self._outstanding -= 1
+                self._idle.notify_all()
+
+    def forget(self, abs_path):
+        """Drops the scan state of an upload item (file or folder) that left the quarantine."""
+        relpath = self._relpath(abs_path)
+        self._conn().execute("DELETE FROM scan_files WHERE path = ? OR (path >= ? AND path < ?)",
+                             (relpath, relpath + '/', relpath + '0'))
+
+    # --- State ---
+    def item_state(self, top_level):
+        """Aggregated scan state of a top-level upload item: {"state", "queued", "rejected": [(path, reason)]}."""
+        conn = self._conn()
+        queued = conn.execute("SELECT COUNT(*) FROM scan_files WHERE top_level = ? AND state = ?",
+                              (top_level, QUEUED)).fetchone()[0]
+        rejected = conn.execute("SELECT path, reason FROM scan_files WHERE top_level = ? AND state = ? ORDER BY path",
+                                (top_level, REJECTED)).fetchall()
+        known = conn.execute("SELECT 1 FROM scan_files WHERE top_level = ? LIMIT 1", (top_level,)).fetchone()
+        if rejected:
+            state = REJECTED
+        elif queued or not known:
+            state = QUEUED
+        else:
+            state = CLEAN
+        return {"state": state, "queued": queued, "rejected": [tuple(row) for row in rejected]}
+
+    def wait_idle(self, timeout=None):
+        """Blocks until every submitted scan has finished; returns False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._outstanding == 0, timeout)
+
+    def start(self, skip_dirs=()):
+        """
+        Re-queues files still waiting for a scan when the server stopped and,
+        in the background, quarantines files in UPLOAD_FOLDER that were never
+        submitted (uploads from before scanning existed).
+        """
+        rows = self._conn().execute("SELECT path, sha256 FROM scan_files WHERE state = ?", (QUEUED,)).fetchall()
+        for relpath, sha256 in rows:
+            self._enqueue(relpath, sha256)
+        threading.Thread(target=self._adopt_unscanned, args=(set(skip_dirs),), name="upload-scanner-adopt",
+                         daemon=True).start()
+
+    def _adopt_unscanned(self, skip_dirs):
+        conn = self._conn()
+        for root, dirs, files in os.walk(self.upload_dir):
+            if root == self.upload_dir:
+                dirs[:] = [d for d in dirs if d not in skip_dirs]
+            for name in files:
+                path = os.path.join(root, name)
+                if conn.execute("SELECT 1 FROM scan_files WHERE path = ?", (self._relpath(path),)).fetchone():
+                    continue
+                try:
+                    self.submit(path, hash_file(path))
+                except OSError:
+                    continue
+
+
+_project_dir = os.path.dirname(os.path.abspath(__file__))
+upload_scanner = UploadScanner(
+    getattr(config, 'SCAN_DATABASE', None) or
+    os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'scan.sqlite3'),
+    os.path.join(_project_dir, config.UPLOAD_FOLDER),
+    workers=getattr(config, 'SCAN_WORKERS', 2),
+)
@@ -0,0 +1,527 @@
+import os
+import re
+import json
+import time
+import heapq
+import pickle
+import bisect
+import tempfile
+import itertools
+import threading
+import config
+from collections import OrderedDict
+from prefork import worker_count
+
+try:
+    import fcntl
+except ImportError:  # Windows runs a single server process, which needs no change feed
+    fcntl = None
+
+_TOKEN_RE = re.compile(r'[^\W\d_]+|\d+')  # Runs of letters or of digits: "hw3_solution" -> hw, 3, solution
+INDEX_VERSION = 2
+MIN_PREFIX_LENGTH = 2  # Shorter query terms only match whole tokens
+RESULT_CACHE_SIZE = 128  # Queries whose top results are kept until the index changes
+CACHED_RESULTS = 200  # Results kept per query, i.e. the first 10 pages
+COMPACT_REMOVED = 10000  # Rebuild once this many removed paths (and a quarter of all ids) are left behind
+CHANGES_MAX_BYTES = 256 * 1024  # The change feed moves on to a new generation past this size
+
+
+def tokenize(text):
+    """Splits a name into lower-cased words and numbers; works for Hebrew as well as Latin names."""
+    return _TOKEN_RE.findall(text.casefold())
+
+
+def _size_or_zero(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class SearchIndex:
+    """
+    Token inverted index over the file and folder paths of the shared library.
+
+    Every path is a document id. `_postings` maps each token found anywhere in
+    the path to the ids containing it, `_name_postings` does the same for the
+    base name only and is used for ranking. A sorted vocabulary gives prefix
+    matching through bisect. `_order` keeps every id sorted by its static rank
+    key (depth, length, path), so a page of a large result set is read off the
+    front of it instead of sorting every hit.
+    """
+
+    def __init__(self, root, index_file, save_delay=30):
+        self.root = os.path.abspath(root)
+        self.index_file = index_file
+        self.save_delay = save_delay
+        self._lock = threading.RLock()
+        self._save_timer = None
+        self._ready = threading.Event()
+        self._replay = None       # updates made while a rebuild is walking the tree
+        self._rebuilding = False
+        # With several server processes, each one publishes its updates to a shared change feed
+        # and applies the other processes' updates before answering a search. The feed is a series
+        # of generations, <changes_file>.<n>; the newest and the one before it are kept.
+        self.changes_file = index_file + '.changes'
+        self._changes_position = None   # (generation, offset) read up to
+        self._publish_generation = 0    # newest generation this process knows of
+        self._reset()
+
+    def _reset(self):
+        self._paths = []          # id -> relative path, None once removed
+        self._folders = set()     # ids that are folders
+        self._ids = {}            # relative path -> id
+        self._postings = {}       # token -> set of ids (any path component)
+        self._name_postings = {}  # token -> set of ids (base name only)
+        self._vocab = []          # sorted tokens, for prefix lookups
+        self._keys = []           # id -> static rank key (depth, length, path, id)
+        self._order = []          # sorted static keys of every id ever added
+        self._removed = 0         # None slots in _paths
+        self._results = OrderedDict()  # sorted query terms -> (best (score, id) pairs, total hits)
+
+    # --- Lifecycle ---
+    def start(self):
+        """Loads the persisted index, then rebuilds it from disk in a background thread."""
+        if worker_count() > 1:
+            generation = self._publish_generation = self._latest_generation()
+            if generation == 0:  # So that a missing generation always means one that was dropped
+                os.close(os.open(self._changes_path(0), os.O_WRONLY | os.O_CREAT, 0o644))
+            # The rebuild covers everything before this
+            self._changes_position = (generation, _size_or_zero(self._changes_path(generation)))
+        threading.Thread(target=self._startup, name="search-index", daemon=True).start()
+
+    def _startup(self):
+        if self._load():
+            self._ready.set()
+        self.rebuild()
+        self._ready.set()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def rebuild(self):
+        """Walks the whole library and atomically replaces the index."""
+        with self._lock:
+            self._replay = []
+        fresh = SearchIndex(self.root, self.index_file)
+        try:
+            for root, dirs, files in os.walk(self.root):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for name in dirs:
+                    fresh._add(self._relative(os.path.join(root, name)), True, bulk=True)
+                for name in files:
+                    if not name.startswith('.'):
+                        fresh._add(self._relative(os.path.join(root, name)), False, bulk=True)
+            fresh._finish_bulk()
+            with self._lock:
+                self._swap(fresh)
+                replay, self._replay = self._replay, None
+                for update, abs_path in replay:
+                    update(abs_path)
+        finally:
+            with self._lock:
+                self._replay = None
+        self.save()
+
+    def _swap(self, other):
+        self._paths, self._folders, self._ids = other._paths, other._folders, other._ids
+        self._postings, self._name_postings, self._vocab = other._postings, other._name_postings, other._vocab
+        self._keys, self._order, self._removed = other._keys, other._order, other._removed
+        self._results = OrderedDict()
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def run():
+            try:
+                self.rebuild()
+            finally:
+                self._rebuilding = False
+        threading.Thread(target=run, name="search-index", daemon=True).start()
+
+    # --- Incremental Updates ---
+    def add_path(self, abs_path):
+        """Indexes a newly published file or folder (with everything inside it)."""
+        self._add_path(abs_path)
+        self._publish('add', abs_path)
+
+    def remove_path(self, abs_path):
+        """Drops a file or folder (with everything inside it) from the index."""
+        self._remove_path(abs_path)
+        self._publish('remove', abs_path)
+
+    def _add_path(self, abs_path):
+        if not os.path.exists(abs_path):
+            return
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((self._add_path, abs_path))
+            relpath = self._relative(abs_path)
+            parent = os.path.dirname(relpath)
+            while parent and parent not in self._ids:  # Folders created on the way by the move
+                self._add(parent, True)
+                parent = os.path.dirname(parent)
+            self._add(relpath, os.path.isdir(abs_path))
+            if os.path.isdir(abs_path):
+                for root, dirs, files in os.walk(abs_path):
+                    for name in dirs:
+                        self._add(self._relative(os.path.join(root, name)), True)
+                    for name in files:
+                        self._add(self._relative(os.path.join(root, name)), False)
+        self._schedule_save()
+
+    def _remove_path(self, abs_path):
+        relpath = self._relative(abs_path)
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((self._remove_path, abs_path))
+            doc_id = self._ids.get(relpath)
+            if doc_id is None:
+                return
+            if doc_id in self._folders:
+                # Everything inside the folder has all of its tokens, so only those ids need checking
+                postings = sorted((self._postings.get(token, set()) for token in set(tokenize(relpath))), key=len)
+                inside = set(postings[0]).intersection(*postings[1:]) if postings else self._ids.values()
+                prefix = relpath + '/'
+                for path in [self._paths[i] for i in inside if self._paths[i].startswith(prefix)]:
+                    self._remove(path)
+            self._remove(relpath)
+            if self._removed > COMPACT_REMOVED and self._removed * 4 > len(self._paths):
+                self._rebuild_in_background()  # Reclaims the None slots and stale _order entries
+        self._schedule_save()
+
+    # --- Change Feed ---
+    def _changes_path(self, generation):
+        return f"{self.changes_file}.{generation}"
+
+    def _latest_generation(self):
+        directory, prefix = os.path.split(self.changes_file)
+        prefix += '.'
+        try:
+            names = os.listdir(directory or '.')
+        except OSError:
+            return 0
+        return max((int(name[len(prefix):]) for name in names
+                    if name.startswith(prefix) and name[len(prefix):].isdigit()), default=0)
+
+    def _publish(self, op, abs_path):
+        if self._changes_position is None:
+            return
+        line = (json.dumps([os.getpid(), op, self._relative(abs_path)]) + '\n').encode('utf-8')
+        try:
+            generation, fd = self._open_changes()
+            try:
+                os.write(fd, line)  # One short O_APPEND write, so lines from different processes never interleave
+                if os.fstat(fd).st_size > CHANGES_MAX_BYTES:
+                    self._rotate_changes(generation, fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"Error publishing search index change: {e}")
+
+    def _open_changes(self):
+        """
+        Opens the newest generation for appending. It is share-locked until
+        closed, so no generation is ever written to after the next one exists.
+        """
+        generation = self._publish_generation
+        while True:
+            try:
+                fd = os.open(self._changes_path(generation), os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                latest = self._latest_generation()
+                if latest != generation:  # Dropped meanwhile
+                    generation = latest
+                    continue
+                fd = os.open(self._changes_path(generation), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            if not os.path.exists(self._changes_path(generation + 1)):
+                self._publish_generation = generation
+                return generation, fd
+            os.close(fd)
+            generation += 1
+
+    def _rotate_changes(self, generation, fd):
+        """Starts the next generation and drops the one before `generation`."""
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another process is writing to it; a later publish rotates
+        try:
+            os.close(os.open(self._changes_path(generation + 1), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            return
+        self._publish_generation = generation + 1
+        try:
+            os.remove(self._changes_path(generation - 1))
+        except FileNotFoundError:
+            pass
+
+    def _follow(self):
+        """Applies updates other processes published since the last call; costs two stat() calls when there are none."""
+        if self._changes_position is None:
+            return
+        with self._lock:
+            generation, offset = self._changes_position
+            lines = []
+            while True:
+                # Checked first: once the next generation exists, nothing more is written to this one
+                rotated = os.path.exists(self._changes_path(generation + 1))
+                try:
+                    size = os.path.getsize(self._changes_path(generation))
+                except FileNotFoundError:
+                    size = None
+                if size is None or size < offset:
+                    # Dropped before we read all of it; walk the tree again and go on from the newest generation
+                    self._rebuild_in_background()
+                    generation = self._latest_generation()
+                    offset = _size_or_zero(self._changes_path(generation))
+                    break
+                if size > offset:
+                    with open(self._changes_path(generation), 'rb') as f:
+                        f.seek(offset)
+                        data = f.read(size - offset)
+                    complete = data.rfind(b'\n') + 1
+                    lines.extend(data[:complete].splitlines())
+                    offset += complete
+                if not rotated:
+                    break
+                generation, offset = generation + 1, 0
+            self._changes_position = (generation, offset)
+            own_pid = os.getpid()
+            for line in lines:
+                try:
+                    pid, op, relpath = json.loads(line)
+                except ValueError:
+                    continue
+                if pid != own_pid:
+                    abs_path = os.path.join(self.root, relpath)
+                    (self._add_path if op == 'add' else self._remove_path)(abs_path)
+
+    def _relative(self, abs_path):
+        return os.path.relpath(os.path.abspath(abs_path), self.root).replace(os.sep, '/')
+
+    def _add(self, relpath, is_folder, bulk=False):
+        """Indexes one path. Bulk loads skip the sorted vocabulary and sort it once at the end."""
+        if relpath in self._ids or relpath == '.':
+            return
+        self._results.clear()
+        doc_id = len(self._paths)
+        self._paths.append(relpath)
+        self._ids[relpath] = doc_id
+        if is_folder:
+            self._folders.add(doc_id)
+        for token in set(tokenize(relpath)):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                if not bulk:
+                    bisect.insort(self._vocab, token)
+            postings.add(doc_id)
+        for token in set(tokenize(relpath.rsplit('/', 1)[-1])):
+            self._name_postings.setdefault(token, set()).add(doc_id)
+        key = (relpath.count('/'), len(relpath), relpath, doc_id)
+        self._keys.append(key)
+        if bulk:
+            self._order.append(key)
+        else:
+            bisect.insort(self._order, key)
+
+    def _finish_bulk(self):
+        self._vocab = sorted(self._postings)
+        self._order.sort()
+
+    def _bulk_load(self, docs):
+        """Indexes an iterable of (relative path, is_folder) into an empty index."""
+        for relpath, is_folder in docs:
+            self._add(relpath, is_folder, bulk=True)
+        self._finish_bulk()
+
+    def _remove(self, relpath):
+        """Unindexes one path. Its _order entry stays behind (searches skip it) until the next rebuild."""
+        doc_id = self._ids.pop(relpath, None)
+        if doc_id is None:
+            return
+        self._results.clear()
+        self._paths[doc_id] = None
+        self._removed += 1
+        self._folders.discard(doc_id)
+        for token in set(tokenize(relpath)):
+            for postings in (self._postings, self._name_postings):
+                ids = postings.get(token)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del postings[token]
+            if token not in self._postings:
+                position = bisect.bisect_left(self._vocab, token)
+                if position < len(self._vocab) and self._vocab[position] == token:
+                    del self._vocab[position]
+
+    # --- Queries ---
+    def _expand(self, term):
+        """The tokens `term` matches: itself or, for long enough terms, every token starting with it."""
+        if len(term) < MIN_PREFIX_LENGTH:
+            return [term]
+        start = bisect.bisect_left(self._vocab, term)
+        end = bisect.bisect_left(self._vocab, term + '\U0010ffff', start)
+        return self._vocab[start:end]
+
+    def _matching(self, postings, tokens, within=None):
+        """Ids having any of the tokens, limited to the ids in `within` if given."""
+        if len(tokens) == 1 and within is None:
+            return postings.get(tokens[0], set())  # Shared set; callers must not mutate it
+        matched = set()
+        for token in tokens:
+            ids = postings.get(token)
+            if ids:
+                matched.update(ids if within is None else within & ids)
+        return matched
+
+    def _first(self, ids, count):
+        """The `count` ids of `ids` with the smallest static keys: shallow, short paths first."""
+        if len(ids) * len(ids) > count * len(self._order):
+            # Many hits are likely to turn up early in the presorted order; give up if they do not
+            first = []
+            for key in itertools.islice(self._order, 2 * len(ids)):
+                if key[-1] in ids:
+                    first.append(key[-1])
+                    if len(first) == count:
+                        return first
+        return heapq.nsmallest(count, ids, key=self._keys.__getitem__)
+
+    def search(self, query, page=1, per_page=20):
+        """
+        Returns (results, total) where results is one page of
+        {"path", "name", "is_folder", "score"} dicts, best match first.
+        Every query term must match a token of the path; terms of at least
+        MIN_PREFIX_LENGTH characters also match as token prefixes.
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return [], 0
+        self._follow()
+        page = max(page, 1)
+        wanted = page * per_page
+        with self._lock:
+            key = tuple(terms)
+            cached = self._results.get(key)
+            if cached is not None and (len(cached[0]) >= wanted or len(cached[0]) == cached[1]):
+                self._results.move_to_end(key)
+                best, total = cached
+            else:
+                best, total = self._rank(terms, max(wanted, CACHED_RESULTS))
+                self._results[key] = (best, total)
+                if len(self._results) > RESULT_CACHE_SIZE:
+                    self._results.popitem(last=False)
+            results = []
+            for score, doc_id in best[(page - 1) * per_page:wanted]:
+                path = self._paths[doc_id]
+                results.append({"path": path, "name": path.rsplit('/', 1)[-1],
+                                "is_folder": doc_id in self._folders, "score": score})
+            return results, total
+
+    def _rank(self, terms, wanted):
+        """The best `wanted` (score, id) pairs for the terms, best first, and the number of hits."""
+        expanded = {term: self._expand(term) for term in terms}
+        # Narrowest term first, so the others only look at the ids it matched
+        order = sorted(terms, key=lambda term: sum(len(self._postings.get(t, ())) for t in expanded[term]))
+        candidates = self._matching(self._postings, expanded[order[0]])
+        for term in order[1:]:
+            if not candidates:
+                break
+            candidates = self._matching(self._postings, expanded[term], within=candidates)
+        if not candidates:
+            return [], 0
+
+        # Ranking: exact base-name hits (3 per term) > prefix base-name hits (2) > hits in a parent
+        # folder (1), plus 1 for folders. The hits are split into tiers by score with set operations,
+        # and only the tiers that reach the requested page are ordered.
+        bonuses = []
+        for term in terms:
+            exact = self._name_postings.get(term, set())
+            if expanded[term] in ([], [term]):
+                bonuses.append((exact, 2))
+            else:
+                prefix = self._matching(self._name_postings, expanded[term], within=candidates)  # Includes exact hits
+                bonuses.extend(((prefix, 1), (exact, 1)))
+        bonuses.append((self._folders, 1))
+        tiers = {0: candidates}  # bonus points -> hits
+        for bonus, points in bonuses:
+            if not bonus:
+                continue
+            next_tiers = {}
+            for tier, ids in tiers.items():
+                if len(ids) <= len(bonus) and ids <= bonus:
+                    inside, kept = ids, None  # Common for one-word queries; avoids copying every hit
+                else:
+                    inside = ids & bonus
+                    kept = ids - inside if inside else ids
+                for key, part in ((tier, kept), (tier + points, inside)):
+                    if part:
+                        next_tiers[key] = next_tiers[key] | part if key in next_tiers else part
+            tiers = next_tiers
+
+        best = []
+        for tier in sorted(tiers, reverse=True):
+            best.extend((len(terms) + tier, doc_id) for doc_id in self._first(tiers[tier], wanted - len(best)))
+            if len(best) >= wanted:
+                break
+        return best, len(candidates)
+
+    # --- Persistence ---
+    def save(self):
+        """Writes the index to `index_file` atomically."""
+        with self._lock:
+            live = [(path, doc_id in self._folders) for doc_id, path in enumerate(self._paths) if path is not None]
+        state = {"version": INDEX_VERSION, "root": self.root, "saved_at": time.time(), "docs": live}
+        directory = os.path.dirname(self.index_file) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.index_file)
+        except OSError as e:
+            print(f"Error saving search index: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _schedule_save(self):
+        with self._lock:
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self._delayed_save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _delayed_save(self):
+        with self._lock:
+            self._save_timer = None
+        self.save()
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if state.get("version") != INDEX_VERSION or state.get("root") != self.root:
+            return False
+        loaded = SearchIndex(self.root, self.index_file)
+        loaded._bulk_load(state["docs"])
+        with self._lock:
+            if not self._paths:  # Not already populated by live updates
+                self._swap(loaded)
+        return True
+
+
+_project_dir = os.path.dirname(os.path.abspath(__file__))
+search_index = SearchIndex(
+    os.path.join(_project_dir, config.SHARE_FOLDER),
+    os.path.join(_project_dir, getattr(config, 'SEARCH_INDEX_FILE', 'search_index.pickle')),
+)
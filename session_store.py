@@ -0,0 +1,262 @@
+import os
+import time
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from flask import request
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+import config
+from utils import sqlite_connect, sqlite_transaction
+
+# Expiry is pushed forward at most this often per session, not on every request.
+TOUCH_INTERVAL = getattr(config, 'SESSION_TOUCH_INTERVAL', 60)
+# A cached session is re-read from SQLite after this many seconds, so revocations by other processes apply.
+CACHE_SECONDS = 5
+PURGE_INTERVAL = 300
+
+
+def session_id(sid):
+    """Id under which a session is stored and shown to admins; the cookie value itself is never stored."""
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data held server-side; the cookie only carries `sid`."""
+
+    def __init__(self, initial=None, sid=None, text=None, last_seen=0.0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.text = text
+        self.last_seen = last_seen
+        self.modified = False
+        self.regenerated = False
+
+    def regenerate(self):
+        """Moves the data to a new id at the end of the request (call on login against session fixation)."""
+        self.regenerated = True
+        self.modified = True
+
+
+class _Entry:
+    __slots__ = ('text', 'last_seen', 'expires', 'checked')
+
+    def __init__(self, text, last_seen, expires, checked):
+        self.text = text
+        self.last_seen = last_seen
+        self.expires = expires
+        self.checked = checked
+
+
+class SessionStore:
+    """
+    Sessions in SQLite behind an in-memory LRU of recently used ones.
+
+    Rows are keyed by session_id(sid) and carry the serialized data plus
+    the owner's email, so admins can list and revoke sessions per user.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id         TEXT NOT NULL PRIMARY KEY,
+            email      TEXT,
+            data       TEXT NOT NULL,
+            created    REAL NOT NULL,
+            last_seen  REAL NOT NULL,
+            expires    REAL NOT NULL,
+            ip         TEXT,
+            user_agent TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_email ON sessions (email);
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires);
+    """
+
+    def __init__(self, db_path, capacity=10000):
+        self.db_path = db_path
+        self.capacity = capacity
+        self._local = threading.local()
+        self._schema_ready = False
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _forget(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def load(self, sid):
+        """Returns the live entry of a session, or None if it is unknown, expired or revoked."""
+        key = session_id(sid)
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+        if entry is None or now - entry.checked > CACHE_SECONDS:
+            row = self._conn().execute("SELECT data, last_seen, expires FROM sessions WHERE id = ?", (key,)).fetchone()
+            if row is None:
+                self._forget(key)
+                return None
+            entry = _Entry(row[0], row[1], row[2], now)
+            self._remember(key, entry)
+        if entry.expires <= now:
+            self.delete(sid)
+            return None
+        return entry
+
+    def save(self, sid, text, email, lifetime, ip=None, user_agent=None):
+        key = session_id(sid)
+        now = time.time()
+        self._conn().execute("""
+            INSERT INTO sessions (id, email, data, created, last_seen, expires, ip, user_agent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET email = excluded.email, data = excluded.data,
+                last_seen = excluded.last_seen, expires = excluded.expires
+        """, (key, email, text, now, now, now + lifetime, ip, user_agent))
+        self._remember(key, _Entry(text, now, now + lifetime, now))
+
+    def touch(self, sid, lifetime):
+        """Slides the expiry of an unchanged session forward."""
+        key = session_id(sid)
+        now = time.time()
+        self._conn().execute("UPDATE sessions SET last_seen = ?, expires = ? WHERE id = ?", (now, now + lifetime, key))
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                entry.last_seen, entry.expires = now, now + lifetime
+
+    def delete(self, sid):
+        self.revoke(session_id(sid))
+
+    # --- Admin ---
+    def list(self, email=None):
+        """Active sessions, most recently used first."""
+        query = "SELECT id, email, created, last_seen, expires, ip, user_agent FROM sessions WHERE expires > ?"
+        params = [time.time()]
+        if email:
+            query += " AND email = ?"
+            params.append(email)
+        rows = self._conn().execute(query + " ORDER BY last_seen DESC", params).fetchall()
+        return [{"id": key, "email": email, "created": _timestamp(created), "last_seen": _timestamp(last_seen),
+                 "expires": _timestamp(expires), "ip": ip, "user_agent": user_agent}
+                for key, email, created, last_seen, expires, ip, user_agent in rows]
+
+    def revoke(self, key):
+        """Ends one session by its id; returns False if there was none."""
+        revoked = self._conn().execute("DELETE FROM sessions WHERE id = ?", (key,)).rowcount
+        self._forget(key)
+        return bool(revoked)
+
+    def revoke_user(self, email):
+        """Ends every session of a user; returns how many there were."""
+        conn = self._conn()
+        with sqlite_transaction(conn):
+            keys = [row[0] for row in conn.execute("SELECT id FROM sessions WHERE email = ?", (email,))]
+            conn.execute("DELETE FROM sessions WHERE email = ?", (email,))
+        self._forget(*keys)
+        return len(keys)
+
+    def purge(self):
+        """Deletes expired sessions."""
+        return self._conn().execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._purge_loop, name="session-purge", daemon=True).start()
+
+    def _purge_loop(self):
+        while True:
+            try:
+                self.purge()
+            except Exception as e:
+                print(f"Error purging expired sessions: {e}")
+            time.sleep(PURGE_INTERVAL)
+
+
+def _timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Keeps session data in a SessionStore and only an opaque id in the cookie.
+    Every session slides to PERMANENT_SESSION_LIFETIME after its last use;
+    the store and the cookie are only rewritten when the data changed or
+    TOUCH_INTERVAL has passed since the expiry was last moved.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            entry = self.store.load(sid)
+            if entry is not None:
+                return ServerSession(self.serializer.loads(entry.text), sid, entry.text, entry.last_seen)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.sid:
+            response.vary.add("Cookie")
+
+        if not session:
+            if session.sid:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        text = self.serializer.dumps(dict(session))
+        if session.regenerated and session.sid:
+            self.store.delete(session.sid)
+            session.sid = None
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            self.store.save(session.sid, text, session.get("email"), lifetime,
+                            request.remote_addr, request.user_agent.string[:200])
+        elif text != session.text:
+            self.store.save(session.sid, text, session.get("email"), lifetime)
+        elif time.time() - session.last_seen >= TOUCH_INTERVAL:
+            self.store.touch(session.sid, lifetime)
+        else:
+            return
+        response.set_cookie(name, session.sid, expires=time.time() + lifetime, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app), partitioned=self.get_cookie_partitioned(app))
+
+
+session_store = SessionStore(
+    getattr(config, 'SESSION_DATABASE', None) or
+    os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'sessions.sqlite3'),
+    capacity=getattr(config, 'SESSION_CACHE_SIZE', 10000),
+)
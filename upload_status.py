@@ -0,0 +1,230 @@
+import os
+import threading
+from datetime import datetime
+import config
+import log_segments
+from utils import sqlite_connect, sqlite_transaction, flush_logs
+
+PENDING = 'pending'
+APPROVED = 'approved'
+DECLINED = 'declined'
+STATUS_LABELS = {PENDING: 'Pending Review', APPROVED: 'Approved & Moved', DECLINED: 'Declined'}
+
+
+def top_level_item(relative_path):
+    """The first component of an uploaded filename; folder uploads are reviewed as one item."""
+    return relative_path.split('/')[0].split('\\')[0]
+
+
+def approval_path(relative_path, suggested_path):
+    """Where a top-level item is proposed to go: the suggested folder for folder uploads, the file path otherwise."""
+    if '/' in relative_path or '\\' in relative_path:
+        return os.path.dirname(suggested_path)
+    return suggested_path
+
+
+class UploadStatusStore:
+    """
+    Materialized state of every upload, one row per uploaded file.
+
+    Rows are keyed by an upload id and indexed by user, so a user's history
+    is a paginated index lookup. The state is changed where it happens
+    (upload, approval, decline) instead of being reconstructed from the
+    upload logs and the contents of UPLOAD_FOLDER on every page view.
+    Approving or declining acts on a whole top-level item.
+
+    `review_queue` holds one entry per top-level item still waiting for an
+    admin (a folder upload is a single entry), described by its most recent
+    upload. It is appended to on upload and shrinks on approval or decline,
+    so the review page costs O(backlog) rather than O(all uploads ever).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploads (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            email       TEXT NOT NULL,
+            filename    TEXT NOT NULL,
+            top_level   TEXT NOT NULL,
+            path        TEXT NOT NULL,
+            uploaded_at TEXT NOT NULL,
+            status      TEXT NOT NULL,
+            updated_at  TEXT NOT NULL,
+            destination TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_uploads_email ON uploads (email, id);
+        CREATE INDEX IF NOT EXISTS idx_uploads_pending ON uploads (top_level) WHERE status = 'pending';
+        CREATE TABLE IF NOT EXISTS review_queue (
+            top_level TEXT NOT NULL PRIMARY KEY,
+            email     TEXT NOT NULL,
+            path      TEXT NOT NULL,
+            queued_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_review_queue_order ON review_queue (queued_at, top_level);
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT NOT NULL PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+            if not self._schema_ready:
+                conn.executescript(self.SCHEMA)
+                self._schema_ready = True
+        return conn
+
+    def record_upload(self, email, filename, path, timestamp):
+        """Adds a pending upload, queues its top-level item for review and returns the upload id."""
+        top_level = top_level_item(filename)
+        conn = self._conn()
+        with sqlite_transaction(conn):
+            cursor = conn.execute("""
+                INSERT INTO uploads (email, filename, top_level, path, uploaded_at, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (email, filename, top_level, path, timestamp, PENDING, timestamp))
+            self._enqueue(conn, top_level, email, approval_path(filename, path), timestamp)
+        return cursor.lastrowid
+
+    @staticmethod
+    def _enqueue(conn, top_level, email, path, timestamp):
+        conn.execute("""
+            INSERT INTO review_queue (top_level, email, path, queued_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (top_level) DO UPDATE SET
+                email = excluded.email, path = excluded.path, queued_at = excluded.queued_at
+        """, (top_level, email, path, timestamp))
+
+    def _resolve(self, top_level, status, destination=None):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn = self._conn()
+        with sqlite_transaction(conn):
+            cursor = conn.execute("""
+                UPDATE uploads SET status = ?, updated_at = ?, destination = ?
+                WHERE top_level = ? AND status = 'pending'
+            """, (status, now, destination, top_level))
+            conn.execute("DELETE FROM review_queue WHERE top_level = ?", (top_level,))
+        return cursor.rowcount
+
+    def approve(self, top_level, destination):
+        """Marks every pending file of a top-level upload item as approved; returns how many changed."""
+        return self._resolve(top_level, APPROVED, destination)
+
+    def decline(self, top_level):
+        return self._resolve(top_level, DECLINED)
+
+    def dequeue(self, top_level):
+        """Drops a review entry whose files are gone without changing the state of its uploads."""
+        self._conn().execute("DELETE FROM review_queue WHERE top_level = ?", (top_level,))
+
+    # --- Review queue ---
+    def pending_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM review_queue").fetchone()[0]
+
+    def pending_page(self, page, per_page):
+        """Returns (entries oldest first, total) for one page of the review queue."""
+        rows = self._conn().execute("""
+            SELECT top_level, email, path, queued_at FROM review_queue
+            ORDER BY queued_at, top_level LIMIT ? OFFSET ?
+        """, (per_page, (page - 1) * per_page))
+        entries = [{"filename": top_level, "email": email, "path": path, "timestamp": queued_at}
+                   for top_level, email, path, queued_at in rows]
+        return entries, self.pending_count()
+
+    def get(self, email, upload_id):
+        row = self._conn().execute("""
+            SELECT id, filename, path, uploaded_at, status, updated_at, destination
+            FROM uploads WHERE id = ? AND email = ?
+        """, (upload_id, email)).fetchone()
+        return _upload_dict(row) if row else None
+
+    def page_for_user(self, email, page, per_page):
+        """Returns (uploads newest first, total) for one page of a user's history."""
+        conn = self._conn()
+        total = conn.execute("SELECT COUNT(*) FROM uploads WHERE email = ?", (email,)).fetchone()[0]
+        rows = conn.execute("""
+            SELECT id, filename, path, uploaded_at, status, updated_at, destination
+            FROM uploads WHERE email = ? ORDER BY id DESC LIMIT ? OFFSET ?
+        """, (email, per_page, (page - 1) * per_page))
+        return [_upload_dict(row) for row in rows], total
+
+    def import_logs(self, upload_log, declined_log, upload_dir):
+        """
+        Fills an empty store from the upload logs, once. The state of each
+        historical upload is worked out the way it used to be on every page
+        view: declined if logged as declined, pending while still in
+        UPLOAD_FOLDER, approved otherwise.
+        """
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+            return 0
+        flush_logs()
+        declined = set()
+        for row in _log_records(declined_log):
+            declined.add((row['email'], row['filename']))
+
+        records = []
+        for row in _log_records(upload_log):
+            top_level = top_level_item(row['filename'])
+            if (row['email'], top_level) in declined:
+                status = DECLINED
+            elif os.path.exists(os.path.join(upload_dir, row['filename'])):
+                status = PENDING
+            else:
+                status = APPROVED
+            records.append((row['email'], row['filename'], top_level, row['path'],
+                            row['timestamp'], status, row['timestamp']))
+
+        with sqlite_transaction(conn):
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+                return 0
+            conn.executemany("""
+                INSERT INTO uploads (email, filename, top_level, path, uploaded_at, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, records)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)",
+                         (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+        return len(records)
+
+    def build_queue(self):
+        """Fills the review queue from the pending uploads, once (for stores created before the queue existed)."""
+        conn = self._conn()
+        with sqlite_transaction(conn):
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'queue_built'").fetchone():
+                return
+            rows = conn.execute("""
+                SELECT top_level, email, filename, path, uploaded_at FROM uploads
+                WHERE id IN (SELECT MAX(id) FROM uploads WHERE status = 'pending' GROUP BY top_level)
+            """).fetchall()
+            for top_level, email, filename, path, uploaded_at in rows:
+                self._enqueue(conn, top_level, email, approval_path(filename, path), uploaded_at)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('queue_built', ?)",
+                         (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+
+
+def _log_records(path):
+    """Rows of a log, including its rotated segments, as dicts keyed by the header."""
+    header = log_segments.header(path)
+    if header is None:
+        return
+    for row in log_segments.iter_rows(path):
+        if len(row) >= len(header):
+            yield dict(zip(header, row))
+
+
+def _upload_dict(row):
+    upload_id, filename, path, uploaded_at, status, updated_at, destination = row
+    return {"id": upload_id, "filename": filename, "path": path, "timestamp": uploaded_at,
+            "state": status, "status": STATUS_LABELS[status], "updated_at": updated_at,
+            "destination": destination}
+
+
+upload_status = UploadStatusStore(
+    getattr(config, 'UPLOAD_STATUS_DATABASE', None) or
+    os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'uploads.sqlite3'),
+)
@@ -1,9 +1,10 @@
-import csv
-import config
 from werkzeug.security import check_password_hash
+from user_store import AUTH, PENDING, DENIED, get_store
 
 # --- User Class ---
 class User:
+    __slots__ = ('email', 'password', 'role', 'status')
+
     def __init__(self, email, password, role='user', status='active'):
         self.email = email
         self.password = password  # This will now be a hashed password
@@ -22,81 +23,115 @@ class User:
         """Checks the provided password against the stored hash."""
         return check_password_hash(self.password, password_to_check)
 
+    def to_record(self):
+        return (self.email, self.password, self.role, self.status)
+
+    @staticmethod
+    def _from_record(record):
+        return User(*record) if record else None
+
     # --- Methods for Authenticated Users (auth_users.csv) ---
     @staticmethod
     def find_by_email(email):
         """Finds a user by email in the authentication database."""
-        return next((user for user in User.get_all() if user.email == email), None)
+        return User._from_record(get_store().find(AUTH, email))
 
     @staticmethod
     def get_all():
         """Reads all users from the authentication database."""
-        return User._read_users_from_file(config.AUTH_USER_DATABASE)
+        return [User(*record) for record in get_store().all(AUTH)]
 
     @staticmethod
     def save_all(users):
         """Rewrites the entire auth user database."""
-        User._save_users_to_file(config.AUTH_USER_DATABASE, users)
+        get_store().replace_all(AUTH, [user.to_record() for user in users])
 
     @staticmethod
     def get_admin_emails():
         """Returns a list of all admin email addresses."""
-        return [user.email for user in User.get_all() if user.is_admin]
+        return get_store().admin_emails()
+
+    @staticmethod
+    def get_role(email):
+        """Returns the role of an authenticated user, or None if unknown."""
+        record = get_store().find(AUTH, email)
+        return record[2] if record else None
+
+    @staticmethod
+    def get_status(email):
+        """Returns the status of an authenticated user, or None if unknown."""
+        record = get_store().find(AUTH, email)
+        return record[3] if record else None
+
+    @staticmethod
+    def email_exists(email):
+        """Checks if an email exists in auth, pending, or denied users."""
+        return get_store().exists(email)
 
     # --- Methods for Pending Users (new_users.csv) ---
     @staticmethod
     def find_pending_by_email(email):
         """Finds a user by email in the pending database."""
-        return next((user for user in User.get_pending() if user.email == email), None)
+        return User._from_record(get_store().find(PENDING, email))
 
     @staticmethod
     def get_pending():
         """Reads all users from the pending registration database."""
-        return User._read_users_from_file(config.NEW_USER_DATABASE)
+        return [User(*record) for record in get_store().all(PENDING)]
 
     @staticmethod
     def save_pending(users):
         """Rewrites the entire pending user database."""
-        User._save_users_to_file(config.NEW_USER_DATABASE, users)
+        get_store().replace_all(PENDING, [user.to_record() for user in users])
+
+    @staticmethod
+    def add_pending(user):
+        """Adds a new registration to the pending database (ValueError if the email is taken, where the store checks)."""
+        get_store().add(PENDING, user.to_record())
 
     # --- Methods for Denied Users (denied_users.csv) ---
     @staticmethod
     def find_denied_by_email(email):
         """Finds a user by email in the denied database."""
-        return next((user for user in User.get_denied() if user.email == email), None)
+        return User._from_record(get_store().find(DENIED, email))
 
     @staticmethod
     def get_denied():
         """Reads all users from the denied registration database."""
-        return User._read_users_from_file(config.DENIED_USER_DATABASE)
+        return [User(*record) for record in get_store().all(DENIED)]
 
     @staticmethod
     def save_denied(users):
         """Rewrites the entire denied user database."""
-        User._save_users_to_file(config.DENIED_USER_DATABASE, users)
-
-    # --- Private Helper Methods ---
-    @staticmethod
-    def _read_users_from_file(filepath):
-        """Helper to read users from a given CSV file."""
-        users = []
-        try:
-            with open(filepath, mode='r', newline='', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                header = next(reader, None) # Skip header
-                for row in reader:
-                    if row and len(row) >= 3:
-                        status = row[3] if len(row) > 3 else 'active'
-                        users.append(User(email=row[0], password=row[1], role=row[2], status=status))
-        except FileNotFoundError:
-            return []
-        return users
-
-    @staticmethod
-    def _save_users_to_file(filepath, users):
-        """Helper to write a list of users to a given CSV file."""
-        with open(filepath, mode='w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(["email", "password", "role", "status"]) # Write header
-            for user in users:
-                writer.writerow([user.email, user.password, user.role, user.status])
+        get_store().replace_all(DENIED, [user.to_record() for user in users])
+
+    @staticmethod
+    def set_password(email, password_hash):
+        """Replaces the password hash of an auth user. Returns the user or None."""
+        return User._from_record(get_store().update(AUTH, email, password=password_hash))
+
+    @staticmethod
+    def toggle_role(email):
+        """Switches an auth user between admin and user in a single write. Returns the user or None."""
+        return User._from_record(get_store().toggle(AUTH, email, 'role', 'admin', 'user'))
+
+    @staticmethod
+    def toggle_status(email):
+        """Switches an auth user between active and inactive in a single write. Returns the user or None."""
+        return User._from_record(get_store().toggle(AUTH, email, 'status', 'active', 'inactive'))
+
+    # --- State Moves ---
+    @staticmethod
+    def approve(email):
+        """Moves a pending user into the auth database as active. Returns the user or None."""
+        return User._from_record(get_store().move(email, PENDING, AUTH, status='active'))
+
+    @staticmethod
+    def deny(email):
+        """Moves a pending user into the denied database. Returns the user or None."""
+        return User._from_record(get_store().move(email, PENDING, DENIED))
+
+    @staticmethod
+    def re_pend(email):
+        """Moves a denied user back into the pending database. Returns the user or None."""
+        return User._from_record(get_store().move(email, DENIED, PENDING))
@@ -0,0 +1,668 @@
+import os
+import csv
+import sys
+import json
+import sqlite3
+import contextlib
+import tempfile
+import threading
+import config
+from utils import sqlite_connect, sqlite_transaction
+from instrumentation import instrumentation, timed
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only coordinated between threads
+    fcntl = None
+
+# --- Record Kinds ---
+# A user record is a plain (email, password, role, status) tuple; the User
+# class wraps records, the stores below only ever see tuples.
+AUTH = 'auth'
+PENDING = 'pending'
+DENIED = 'denied'
+KINDS = (AUTH, PENDING, DENIED)
+
+USER_HEADER = ["email", "password", "role", "status"]
+
+
+def _csv_path(kind):
+    return {
+        AUTH: config.AUTH_USER_DATABASE,
+        PENDING: config.NEW_USER_DATABASE,
+        DENIED: config.DENIED_USER_DATABASE,
+    }[kind]
+
+
+def parse_user_rows(reader):
+    """Yields (email, password, role, status) tuples from a user CSV reader."""
+    next(reader, None) # Skip header
+    for row in reader:
+        if row and len(row) >= 3:
+            status = row[3] if len(row) > 3 else 'active'
+            yield (row[0], row[1], row[2], status)
+
+
+@timed('user_csv_write')
+def write_user_rows(filepath, records):
+    """Atomically replaces a user CSV file with the given records."""
+    directory = os.path.dirname(filepath) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.csv')
+    try:
+        with os.fdopen(fd, mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(USER_HEADER)
+            writer.writerows(records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# --- Cached User Directory ---
+class UserDirectory:
+    """
+    Email-indexed, in-memory view of one user CSV file.
+
+    Records are kept as plain (email, password, role, status) tuples and the
+    file is parsed again only when its mtime or size changes, so lookups cost
+    one os.stat() plus a dict access instead of a full CSV scan.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._signature = None
+        # (records in file order, email -> first matching record, admin emails)
+        self._snapshot = ((), {}, ())
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.filepath)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self):
+        """Re-parses the backing file if it changed since the last load."""
+        signature = self._stat_signature()
+        if signature is not None and signature == self._signature:
+            return self._snapshot
+        with self._lock:
+            signature = self._stat_signature()
+            if signature is not None and signature == self._signature:
+                return self._snapshot
+            try:
+                with open(self.filepath, mode='r', newline='', encoding='utf-8') as f, \
+                        instrumentation.timer('user_csv_read'):
+                    records = tuple(parse_user_rows(csv.reader(f)))
+            except FileNotFoundError:
+                records = ()
+            index = {}
+            for record in records:
+                index.setdefault(record[0], record)
+            admin_emails = tuple(r[0] for r in records if r[2] == 'admin')
+            self._snapshot = (records, index, admin_emails)
+            self._signature = signature
+            return self._snapshot
+
+    def invalidate(self):
+        """Forces the next lookup to re-read the backing file."""
+        with self._lock:
+            self._signature = None
+
+    def find(self, email):
+        return self._load()[1].get(email)
+
+    def contains(self, email):
+        return email in self._load()[1]
+
+    def all(self):
+        return list(self._load()[0])
+
+    def admin_emails(self):
+        return list(self._load()[2])
+
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+def get_directory(filepath):
+    """Returns the process-wide UserDirectory for a user CSV file."""
+    directory = _directories.get(filepath)
+    if directory is None:
+        with _directories_lock:
+            directory = _directories.setdefault(filepath, UserDirectory(filepath))
+    return directory
+
+
+_FIELDS = {'password': 1, 'role': 2, 'status': 3}
+
+def _updated(record, fields):
+    email, password, role = record[0], record[1], record[2]
+    status = record[3] if len(record) > 3 else 'active'
+    return (email, fields.get('password', password), fields.get('role', role), fields.get('status', status))
+
+
+class _FileLock:
+    """Exclusive lock on a lock file shared between processes (a no-op without fcntl)."""
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return True
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.fd)
+            self.fd = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+# --- CSV Backend ---
+class CsvUserStore:
+    """The original storage: one CSV file per kind, read through UserDirectory."""
+
+    def __init__(self, lock_path=None):
+        # CSV files have no transactions; serialize writers within the process, and across
+        # server processes with an flock on `lock_path`.
+        self._write_lock = threading.RLock()
+        self._lock_path = lock_path
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Holds the write lock, and the lock file in the outermost call (a second flock would wait on the first)."""
+        with self._write_lock:
+            self._depth += 1
+            try:
+                if self._depth == 1 and self._lock_path:
+                    with _FileLock(self._lock_path):
+                        yield
+                else:
+                    yield
+            finally:
+                self._depth -= 1
+
+    def find(self, kind, email):
+        return get_directory(_csv_path(kind)).find(email)
+
+    def all(self, kind):
+        return get_directory(_csv_path(kind)).all()
+
+    def exists(self, email):
+        return any(get_directory(_csv_path(kind)).contains(email) for kind in KINDS)
+
+    def admin_emails(self):
+        return get_directory(_csv_path(AUTH)).admin_emails()
+
+    def replace_all(self, kind, records):
+        filepath = _csv_path(kind)
+        with self._locked():
+            write_user_rows(filepath, records)
+            get_directory(filepath).invalidate()
+
+    def add(self, kind, record):
+        filepath = _csv_path(kind)
+        with self._locked():
+            with open(filepath, mode='a', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerow(record)
+            get_directory(filepath).invalidate()
+
+    def update(self, kind, email, **fields):
+        """Changes fields (password, role, status) of one record; returns the new record or None."""
+        with self._locked():
+            records = self.all(kind)
+            for i, record in enumerate(records):
+                if record[0] == email:
+                    records[i] = _updated(record, fields)
+                    self.replace_all(kind, records)
+                    return records[i]
+            return None
+
+    def toggle(self, kind, email, field, on, off):
+        """Sets `field` (role or status) to `off` if it is `on`, else to `on`, in one write; returns the new record or None."""
+        with self._locked():
+            record = self.find(kind, email)
+            if record is None:
+                return None
+            return self.update(kind, email, **{field: off if record[_FIELDS[field]] == on else on})
+
+    def move(self, email, source, destination, status=None):
+        """
+        Moves a record between two kinds. The destination file is written
+        before the source, so a crash in between duplicates the user rather
+        than losing them.
+        """
+        with self._locked():
+            record = self.find(source, email)
+            if record is None:
+                return None
+            if status is not None:
+                record = record[:3] + (status,)
+            self.replace_all(destination, self.all(destination) + [record])
+            self.replace_all(source, [r for r in self.all(source) if r[0] != email])
+            return record
+
+
+# --- Journaled CSV Backend ---
+class JournaledUserStore:
+    """
+    The CSV files as a snapshot plus an append-only journal of record changes.
+
+    Each change appends one JSON line to the journal and updates an
+    in-memory view, so writes no longer rewrite a CSV file. Lines carry the
+    resulting records (put, delete, replace) rather than deltas, which makes
+    replaying the journal over a newer snapshot give the same view.
+    Compaction writes fresh snapshots, then atomically replaces the journal
+    with the lines appended meanwhile. Appends and compaction take an flock,
+    and readers pick up lines appended by other processes from the journal
+    size, so several server processes can share the files.
+    """
+
+    def __init__(self, journal_path, compact_bytes=1024 * 1024, fsync=True):
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._views = None          # kind -> {email: record} in file order
+        self._position = None       # (journal inode, bytes applied)
+        self._compacting = False
+
+    # --- View ---
+    def _journal_stat(self):
+        try:
+            st = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def _reload(self):
+        views = {}
+        for kind in KINDS:
+            try:
+                with open(_csv_path(kind), mode='r', newline='', encoding='utf-8') as f:
+                    views[kind] = {}
+                    for record in parse_user_rows(csv.reader(f)):
+                        views[kind].setdefault(record[0], record)
+            except FileNotFoundError:
+                views[kind] = {}
+        self._views = views
+        inode, _ = self._journal_stat()
+        self._position = (inode, 0)
+        self._replay()
+
+    def _replay(self):
+        """Applies journal lines past the current position; a partly written last line is left for later."""
+        inode, offset = self._position
+        try:
+            with open(self.journal_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_ino != inode:
+                    return self._reload()
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        complete = data.rfind(b'\n') + 1
+        for line in data[:complete].splitlines():
+            if not line.strip():
+                continue
+            try:
+                ops = json.loads(line)
+            except ValueError:
+                print(f"Skipping damaged line in {self.journal_path}: {line[:80]!r}")
+                continue
+            self._apply(ops)
+        self._position = (inode, offset + complete)
+
+    def _sync(self):
+        """Brings the view up to date with the files; costs one stat() when nothing changed."""
+        inode, size = self._journal_stat()
+        if self._views is None or inode != self._position[0] or size < self._position[1]:
+            self._reload()
+        elif size > self._position[1]:
+            self._replay()
+        return self._views
+
+    def _apply(self, ops):
+        for op in ops:
+            if op[0] == 'put':
+                _, kind, record = op
+                self._views[kind][record[0]] = tuple(record)
+            elif op[0] == 'del':
+                self._views[op[1]].pop(op[2], None)
+            elif op[0] == 'replace':
+                _, kind, records = op
+                self._views[kind] = {}
+                for record in records:
+                    self._views[kind].setdefault(record[0], tuple(record))
+
+    def _append(self, ops, torn=False):
+        data = (json.dumps(ops, separators=(',', ':')) + '\n').encode('utf-8')
+        if torn:
+            # A writer died mid-line; end that line so this one stays readable
+            data = b'\n' + data
+        with instrumentation.timer('user_journal_append'):
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                inode = os.fstat(fd).st_ino
+                while data:
+                    written = os.write(fd, data)
+                    data = data[written:]
+                if self.fsync:
+                    os.fsync(fd)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        self._apply(ops)
+        self._position = (inode, size)
+        if size >= self.compact_bytes and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, name="user-journal-compact", daemon=True).start()
+
+    def _write(self, build_ops):
+        """Runs build_ops(views) on an up-to-date view under both locks and journals what it returns."""
+        with self._lock, _FileLock(self.journal_path + '.lock'):
+            views = self._sync()
+            ops, result = build_ops(views)
+            if ops:
+                # Under the flock nobody is mid-append, so unread bytes are a torn line
+                self._append(ops, torn=self._journal_stat()[1] > self._position[1])
+            return result
+
+    # --- Reads ---
+    def find(self, kind, email):
+        with self._lock:
+            return self._sync()[kind].get(email)
+
+    def all(self, kind):
+        with self._lock:
+            return list(self._sync()[kind].values())
+
+    def exists(self, email):
+        with self._lock:
+            views = self._sync()
+            return any(email in views[kind] for kind in KINDS)
+
+    def admin_emails(self):
+        with self._lock:
+            return [r[0] for r in self._sync()[AUTH].values() if r[2] == 'admin']
+
+    # --- Writes ---
+    def replace_all(self, kind, records):
+        records = [_updated(r, {}) for r in records]
+        self._write(lambda views: ([('replace', kind, records)], None))
+
+    def add(self, kind, record):
+        record = _updated(record, {})
+        self._write(lambda views: ([('put', kind, record)], None))
+
+    def update(self, kind, email, **fields):
+        """Changes fields (password, role, status) of one record; returns the new record or None."""
+        def build(views):
+            record = views[kind].get(email)
+            if record is None:
+                return None, None
+            record = _updated(record, fields)
+            return [('put', kind, record)], record
+        return self._write(build)
+
+    def toggle(self, kind, email, field, on, off):
+        def build(views):
+            record = views[kind].get(email)
+            if record is None:
+                return None, None
+            record = _updated(record, {field: off if record[_FIELDS[field]] == on else on})
+            return [('put', kind, record)], record
+        return self._write(build)
+
+    def move(self, email, source, destination, status=None):
+        def build(views):
+            record = views[source].get(email)
+            if record is None:
+                return None, None
+            if status is not None:
+                record = record[:3] + (status,)
+            return [('del', source, email), ('put', destination, record)], record
+        return self._write(build)
+
+    # --- Compaction ---
+    def compact(self):
+        """Folds the journal into new CSV snapshots; returns False if another compaction is running."""
+        try:
+            with _FileLock(self.journal_path + '.compact.lock', blocking=False) as acquired:
+                if not acquired:
+                    return False
+                with self._lock, _FileLock(self.journal_path + '.lock'):
+                    views = {kind: list(records.values()) for kind, records in self._sync().items()}
+                    inode, offset = self._position
+                if inode is None:
+                    return True
+                # Writers keep appending while the snapshots are written
+                for kind in KINDS:
+                    write_user_rows(_csv_path(kind), views[kind])
+                    get_directory(_csv_path(kind)).invalidate()
+                with self._lock, _FileLock(self.journal_path + '.lock'):
+                    with open(self.journal_path, 'rb') as f:
+                        if os.fstat(f.fileno()).st_ino != inode:
+                            return False
+                        f.seek(offset)
+                        tail = f.read()
+                    directory = os.path.dirname(self.journal_path) or '.'
+                    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.journal')
+                    try:
+                        with os.fdopen(fd, 'wb') as f:
+                            f.write(tail)
+                            f.flush()
+                            os.fsync(f.fileno())
+                        os.replace(tmp_path, self.journal_path)
+                    except BaseException:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                        raise
+                    self._position = (os.stat(self.journal_path).st_ino, len(tail))
+                return True
+        except Exception as e:
+            print(f"Error compacting user journal: {e}")
+            return False
+        finally:
+            self._compacting = False
+
+
+# --- SQLite Backend ---
+class SqliteUserStore:
+    """
+    All three user lists in one SQLite table, keyed by email, with the list a
+    user belongs to held in the `kind` column. Moving a user between lists is
+    a single UPDATE inside one transaction.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            email    TEXT NOT NULL PRIMARY KEY,
+            password TEXT NOT NULL,
+            role     TEXT NOT NULL DEFAULT 'user',
+            status   TEXT NOT NULL DEFAULT 'active',
+            kind     TEXT NOT NULL CHECK (kind IN ('auth', 'pending', 'denied'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_kind_email ON users (kind, email);
+        CREATE INDEX IF NOT EXISTS idx_users_kind_role ON users (kind, role);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        """Returns this thread's connection, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite_connect(self.db_path)
+        return conn
+
+    def _transaction(self):
+        return sqlite_transaction(self._conn())
+
+    def find(self, kind, email):
+        row = self._conn().execute(
+            "SELECT email, password, role, status FROM users WHERE kind = ? AND email = ?",
+            (kind, email)).fetchone()
+        return tuple(row) if row else None
+
+    def all(self, kind):
+        rows = self._conn().execute(
+            "SELECT email, password, role, status FROM users WHERE kind = ? ORDER BY rowid", (kind,))
+        return [tuple(row) for row in rows]
+
+    def exists(self, email):
+        return self._conn().execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone() is not None
+
+    def admin_emails(self):
+        rows = self._conn().execute(
+            "SELECT email FROM users WHERE kind = ? AND role = 'admin' ORDER BY rowid", (AUTH,))
+        return [row[0] for row in rows]
+
+    def replace_all(self, kind, records):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM users WHERE kind = ?", (kind,))
+            self._insert(conn, kind, records)
+
+    def add(self, kind, record):
+        """Inserts a new record; raises ValueError if the email is already in any list."""
+        try:
+            with self._transaction() as conn:
+                self._insert(conn, kind, [record])
+        except sqlite3.IntegrityError:
+            raise ValueError(f"{record[0]} is already registered") from None
+
+    def update(self, kind, email, **fields):
+        columns = [name for name in ('password', 'role', 'status') if name in fields]
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE users SET {', '.join(f'{name} = ?' for name in columns)} WHERE kind = ? AND email = ?",
+                [fields[name] for name in columns] + [kind, email])
+            if cursor.rowcount == 0:
+                return None
+            row = conn.execute(
+                "SELECT email, password, role, status FROM users WHERE email = ?", (email,)).fetchone()
+            return tuple(row)
+
+    def toggle(self, kind, email, field, on, off):
+        if field not in ('role', 'status'):
+            raise ValueError(f"Cannot toggle {field!r}")
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE users SET {field} = CASE WHEN {field} = ? THEN ? ELSE ? END WHERE kind = ? AND email = ?",
+                (on, off, on, kind, email))
+            if cursor.rowcount == 0:
+                return None
+            row = conn.execute(
+                "SELECT email, password, role, status FROM users WHERE email = ?", (email,)).fetchone()
+            return tuple(row)
+
+    def move(self, email, source, destination, status=None):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET kind = ?, status = COALESCE(?, status) WHERE email = ? AND kind = ?",
+                (destination, status, email, source))
+            if cursor.rowcount == 0:
+                return None
+            row = conn.execute(
+                "SELECT email, password, role, status FROM users WHERE email = ?", (email,)).fetchone()
+            return tuple(row)
+
+    @staticmethod
+    def _insert(conn, kind, records):
+        """Plain INSERT: an email that is already in another list fails the transaction, never moves."""
+        conn.executemany(
+            "INSERT INTO users (email, password, role, status, kind) VALUES (?, ?, ?, ?, ?)",
+            [(r[0], r[1], r[2], r[3] if len(r) > 3 else 'active', kind) for r in records])
+
+
+# --- Backend Selection ---
+def default_sqlite_path():
+    return getattr(config, 'USER_SQLITE_DATABASE', None) or \
+        os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'users.sqlite3')
+
+def default_journal_path():
+    return getattr(config, 'USER_JOURNAL_FILE', None) or \
+        os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'users.journal')
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Returns the process-wide user store selected by config.USER_STORAGE_BACKEND."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = getattr(config, 'USER_STORAGE_BACKEND', 'csv')
+                if backend == 'sqlite':
+                    _store = SqliteUserStore(default_sqlite_path())
+                elif backend == 'journal':
+                    _store = JournaledUserStore(default_journal_path(),
+                                                getattr(config, 'USER_JOURNAL_COMPACT_BYTES', 1024 * 1024),
+                                                getattr(config, 'USER_JOURNAL_FSYNC', True))
+                elif backend == 'csv':
+                    _store = CsvUserStore(os.path.join(os.path.dirname(config.AUTH_USER_DATABASE), 'users.lock'))
+                else:
+                    raise ValueError(f"Unknown USER_STORAGE_BACKEND: {backend!r}")
+    return _store
+
+
+# --- CSV -> SQLite Migration ---
+def migrate_csv_to_sqlite(db_path=None):
+    """
+    Copies the auth, pending and denied CSV files into a SQLite store.
+
+    The copy replaces everything in the SQLite table, so it can run while the
+    CSV-backed server is still live and be repeated right before switching
+    USER_STORAGE_BACKEND to pick up late changes. An email present in several files keeps its most
+    advanced state (auth over pending over denied). Changes still in the
+    user journal are included. Returns per-kind counts.
+    """
+    store = SqliteUserStore(db_path or default_sqlite_path())
+    journal_path = default_journal_path()
+    csv_store = JournaledUserStore(journal_path) if os.path.exists(journal_path) else CsvUserStore()
+    counts = {}
+    seen = set()
+    with store._transaction() as conn:
+        conn.execute("DELETE FROM users")
+        for kind in KINDS:
+            records = [r for r in csv_store.all(kind) if r[0] not in seen]
+            seen.update(r[0] for r in records)
+            store._insert(conn, kind, records)
+            counts[kind] = len(records)
+    return counts
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compact"]:
+        if not JournaledUserStore(default_journal_path()).compact():
+            print("Compaction failed or is already running.")
+            sys.exit(1)
+        print(f"Compacted {default_journal_path()} into the user CSV files.")
+        sys.exit(0)
+    if sys.argv[1:2] != ["migrate"]:
+        print("Usage: python user_store.py migrate [SQLITE_PATH] | compact")
+        sys.exit(1)
+    target = sys.argv[2] if len(sys.argv) > 2 else default_sqlite_path()
+    counts = migrate_csv_to_sqlite(target)
+    print(f"Migrated to {target}: " + ", ".join(f"{kind}={n}" for kind, n in counts.items()))
@@ -1,38 +1,19 @@
 import os
 import csv
-from io import BytesIO
+import sqlite3
+from contextlib import contextmanager
 from werkzeug.security import generate_password_hash, check_password_hash
+from log_writer import writer as log_writer
+from instrumentation import timed
 
-try:
-    from openpyxl.workbook import Workbook
-except ImportError:
-    print("Warning: openpyxl not found. Excel export will not work. Run 'pip install openpyxl'.")
-    class Workbook: pass
-
+@timed('log_event')
 def log_event(filename, data):
-    """Appends a new row to a specified CSV log file."""
-    with open(filename, mode='a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(data)
+    """Queues a new row for a specified CSV log file; it is appended in the background."""
+    log_writer.write(filename, data)
 
-def csv_to_xlsx_in_memory(csv_filepath):
-    """Converts a CSV file to an XLSX file in memory (BytesIO)."""
-    if 'Workbook' not in globals():
-        raise RuntimeError("openpyxl library is missing.")
-    wb = Workbook()
-    ws = wb.active
-    ws.title = os.path.basename(csv_filepath).replace('.csv', '').title()
-    try:
-        with open(csv_filepath, 'r', encoding='utf-8', newline='') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                ws.append(row)
-    except FileNotFoundError:
-        ws.append(["Error", "File Not Found"])
-    memory_file = BytesIO()
-    wb.save(memory_file)
-    memory_file.seek(0)
-    return memory_file
+def flush_logs():
+    """Blocks until every queued log row has been written to disk."""
+    log_writer.flush()
 
 def create_file_with_header(filename, header):
     """Creates a file with a header if it doesn't exist."""
@@ -41,3 +22,23 @@ def create_file_with_header(filename, header):
         with open(filename, mode='w', newline='', encoding='utf-8') as f:
             csv.writer(f).writerow(header)
         print(f"Created file: {filename}")
+
+def sqlite_connect(db_path):
+    """Opens a SQLite connection in autocommit mode with WAL for concurrent readers."""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+@contextmanager
+def sqlite_transaction(conn):
+    """BEGIN IMMEDIATE ... COMMIT, or ROLLBACK if the block raises."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")